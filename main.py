@@ -8,6 +8,17 @@ import os
 import time
 import math
 import asyncio
+import atexit
+import bisect
+import hashlib
+import json
+import mmap
+import struct
+import zlib
+from array import array
+from collections import OrderedDict, deque
+try: import numpy as np # Optional: only the batched engines need it
+except ImportError: np = None
 
 # --- 基本設定 ---
 SCREEN_WIDTH = 800
@@ -29,12 +40,179 @@ PLAYER_INVINCIBILITY_DURATION = 2000
 TRIPLE_CLICK_INTERVAL = 2.0
 SKILL_DAMAGE = 4 # MODIFIED: Renamed from POMERANIAN_DAMAGE
 
+# --- 執行參數 (命令列旗標或環境變數) ---
+def get_option(flag, env_name, default=False):
+    if flag in sys.argv: return True
+    value = os.environ.get(env_name)
+    if value is None: return default
+    return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+def get_option_value(flag, env_name, default, cast=int): # --flag=value, --flag value or the environment variable
+    for i, arg in enumerate(sys.argv):
+        if arg.startswith(flag + '='): return cast(arg.split('=', 1)[1])
+        if arg == flag and i + 1 < len(sys.argv): return cast(sys.argv[i + 1])
+    value = os.environ.get(env_name)
+    return cast(value) if value not in (None, '') else default
+
+# --- 記錄 ---
+# log.info(key, fmt, *args) instead of print(): fmt is %-formatted only when the record is flushed, a call below the
+# level returns after one comparison, and each key is rate-limited (records over the limit are only counted). Records
+# wait in a ring buffer that an asyncio task writes out every LOG_FLUSH_INTERVAL with a single stdout write; outside the
+# event loop (startup, headless runs, tools) the buffer is written whenever it fills and at exit. Pass values, not live
+# objects, as args: they are formatted later. --log-jsonl PATH also appends every record as a JSON line (desktop only).
+IS_WEB = sys.platform == 'emscripten'
+LOG_LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40, 'off': 100}
+LOG_LEVEL = get_option_value('--log-level', 'WEBGAME_LOG_LEVEL', 'info', cast=str) # 'off' for a silent production build
+LOG_JSONL_PATH = get_option_value('--log-jsonl', 'WEBGAME_LOG_JSONL', None, cast=str)
+LOG_RING_SIZE = 256
+LOG_RATE_LIMIT = 5; LOG_RATE_WINDOW = 1.0 # Records per key per window; wall-clock seconds, so logging never reads game state
+LOG_FLUSH_INTERVAL = 0.25
+
+class Logger:
+    def __init__(self, level=LOG_LEVEL, jsonl_path=LOG_JSONL_PATH, ring_size=LOG_RING_SIZE):
+        self.buffer = deque(maxlen=ring_size); self.windows = {} # key -> [window_start, count, suppressed]
+        self.jsonl_path = None if IS_WEB else jsonl_path; self.jsonl_file = None; self.pumping = False; self.start = time.perf_counter()
+        self.level_names = {value: name for name, value in LOG_LEVELS.items()}; self.stats = {'emitted': 0, 'rate_limited': 0, 'dropped': 0, 'flushes': 0}
+        self.set_level(level)
+    def set_level(self, name): self.level = LOG_LEVELS.get(str(name).lower(), LOG_LEVELS['info'])
+    def debug(self, key, msg, *args):
+        if self.level <= 10: self._emit(10, key, msg, args)
+    def info(self, key, msg, *args):
+        if self.level <= 20: self._emit(20, key, msg, args)
+    def warning(self, key, msg, *args):
+        if self.level <= 30: self._emit(30, key, msg, args)
+    def error(self, key, msg, *args):
+        if self.level <= 40: self._emit(40, key, msg, args)
+    def _emit(self, level, key, msg, args):
+        now = time.perf_counter(); window = self.windows.get(key)
+        if window is None: window = self.windows[key] = [now, 0, 0]
+        elif now - window[0] >= LOG_RATE_WINDOW: window[0] = now; window[1] = 0
+        if window[1] >= LOG_RATE_LIMIT: window[2] += 1; self.stats['rate_limited'] += 1; return
+        window[1] += 1; suppressed = window[2]; window[2] = 0; self.stats['emitted'] += 1
+        if len(self.buffer) == self.buffer.maxlen:
+            if self.pumping: self.stats['dropped'] += 1 # The ring overwrites its oldest record
+            else: self.flush()
+        self.buffer.append((now, level, key, msg, args, suppressed))
+    def flush(self):
+        if not self.buffer: return
+        if self.jsonl_path and not self.jsonl_file:
+            try: self.jsonl_file = open(self.jsonl_path, 'a', encoding='utf-8')
+            except OSError as e: self.buffer.append((time.perf_counter(), 30, 'log.jsonl', "警告: 無法開啟記錄檔 %s: %s", (self.jsonl_path, e), 0)); self.jsonl_path = None
+        lines = []; self.stats['flushes'] += 1
+        while self.buffer:
+            t, level, key, msg, args, suppressed = self.buffer.popleft()
+            try: text = msg % args if args else msg
+            except (TypeError, ValueError) as e: text = f"{msg!r} % {args!r} ({e})"
+            if suppressed: text += f" (此前略過 {suppressed} 則)"
+            lines.append(text)
+            if self.jsonl_file: self.jsonl_file.write(json.dumps({'t': round(t - self.start, 4), 'level': self.level_names[level], 'key': key, 'msg': text, 'suppressed': suppressed}, ensure_ascii=False) + "\n")
+        sys.stdout.write("\n".join(lines) + "\n")
+    async def pump(self, interval=LOG_FLUSH_INTERVAL): # Task beside main(): the game loop never waits on the console
+        self.pumping = True
+        try:
+            while True: self.flush(); await asyncio.sleep(interval)
+        finally: self.pumping = False
+    def close(self):
+        self.flush()
+        if self.jsonl_file: self.jsonl_file.close(); self.jsonl_file = None
+
+log = Logger(); atexit.register(log.close)
+
+# --- 髒矩形渲染 ---
+DIRTY_RENDERING = get_option('--dirty-render', 'WEBGAME_DIRTY_RENDER') # Only push changed regions instead of flipping all 800x600 pixels
+DIRTY_FULL_FLIP_RATIO = 0.5 # Fall back to a full flip once the dirty area covers this fraction of the screen
+
+# --- NumPy 子彈引擎 ---
+NUMPY_PROJECTILES = get_option('--numpy-projectiles', 'WEBGAME_NUMPY_PROJECTILES') # Struct-of-arrays bullets instead of one Sprite per shot
+
+# --- NumPy 敵人引擎 ---
+NUMPY_ENEMIES = get_option('--numpy-enemies', 'WEBGAME_NUMPY_ENEMIES') # Struct-of-arrays enemy AI; Enemy sprites become views
+
 # --- 資源路徑 ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # --- 使用者指定的資料夾名稱 ---
 IMG_DIR = os.path.join(BASE_DIR, 'img') # Using 'img' as per user's structure
 SND_DIR = os.path.join(BASE_DIR, 'snd') # Using 'snd' as per user's structure
 FONT_DIR = os.path.join(BASE_DIR, 'fonts') # Assuming 'fonts' for custom font
+BUNDLE_DIR = os.path.join(BASE_DIR, 'web_bundle') # Written by tools/build_web_bundle.py; optional
+BUNDLE_MANIFEST = 'manifest.json'
+
+# --- 解碼資源快取 ---
+# Desktop only. Post-conversion artifacts (display-format pixels, the pre-scaled cover, collision mask planes and SFX
+# decoded to mixer-format PCM) are written to ASSET_CACHE_DIR, named by a hash of the source file's bytes plus
+# whatever else shaped them (screen size, atlas rect, mixer format). Later launches mmap them back: images are
+# zero-copy frombuffer() views of the mapping, sounds go through Sound(buffer=), which SDL_mixer copies once.
+# An edited source hashes differently, so its old entry is never read again and is replaced on the next write.
+ASSET_CACHE_ENABLED = not IS_WEB and not get_option('--no-asset-cache', 'WEBGAME_NO_ASSET_CACHE')
+ASSET_CACHE_DIR = get_option_value('--asset-cache', 'WEBGAME_ASSET_CACHE', os.path.join(BASE_DIR, '.asset_cache'), cast=str)
+ASSET_CACHE_MAGIC = b'DQAC'; ASSET_CACHE_VERSION = 1
+ASSET_CACHE_HEADER = struct.Struct('<4sBBHIII') # magic, version, flags, reserved, width, height, data length
+ASSET_CACHE_ALPHA = 1 # flags: per-pixel alpha (convert_alpha); otherwise opaque and converted back with convert()
+CACHE_PIXEL_MASKS = (0xFF0000, 0xFF00, 0xFF) # 'BGRA' byte order; surfaces in any other layout are not cached
+
+class DecodedAssetCache:
+    def __init__(self, directory=ASSET_CACHE_DIR, enabled=ASSET_CACHE_ENABLED):
+        self.directory = directory; self.enabled = enabled; self.hashes = {} # source path -> content hash, once per run
+        self.counts = {'hits': 0, 'misses': 0, 'writes': 0, 'errors': 0}; self.load_ms = 0.0
+    def source_hash(self, path):
+        digest = self.hashes.get(path)
+        if digest is None:
+            with open(path, 'rb') as f: digest = self.hashes[path] = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+        return digest
+    def _path(self, name, kind, source, variant): # Raises OSError when the source cannot be read
+        tag = hashlib.blake2b(f"{self.source_hash(source)}|{variant}".encode('utf-8'), digest_size=8).hexdigest()
+        return os.path.join(self.directory, f"{name}.{tag}.{kind}")
+    def _map(self, name, kind, source, variant): # (flags, width, height, memoryview of the payload) or None on a miss
+        if not self.enabled or not source: return None
+        try:
+            with open(self._path(name, kind, source, variant), 'rb') as f: mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY) # Copy-on-write: frombuffer wants a writable buffer
+        except (OSError, ValueError): self.counts['misses'] += 1; return None # Not cached yet (or an empty file, which cannot be mapped)
+        if len(mapping) < ASSET_CACHE_HEADER.size: self.counts['misses'] += 1; return None
+        magic, version, flags, _, width, height, length = ASSET_CACHE_HEADER.unpack_from(mapping)
+        if magic != ASSET_CACHE_MAGIC or version != ASSET_CACHE_VERSION or len(mapping) != ASSET_CACHE_HEADER.size + length: self.counts['misses'] += 1; return None
+        self.counts['hits'] += 1; return flags, width, height, memoryview(mapping)[ASSET_CACHE_HEADER.size:]
+    def _write(self, name, kind, source, variant, flags, width, height, data):
+        if not self.enabled or not source: return
+        try:
+            path = self._path(name, kind, source, variant); os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp" # Batch-sim workers may write the same entry at once; the rename is atomic
+            with open(tmp_path, 'wb') as f: f.write(ASSET_CACHE_HEADER.pack(ASSET_CACHE_MAGIC, ASSET_CACHE_VERSION, flags, 0, width, height, len(data))); f.write(data)
+            os.replace(tmp_path, path); self.counts['writes'] += 1
+        except OSError as e: self.counts['errors'] += 1; log.warning('assets.cache', "警告: 無法寫入資源快取 %s.%s (%s)", name, kind, e); return
+        for stale in os.listdir(self.directory): # Entries of older versions of the same source
+            if stale.startswith(name + '.') and stale.endswith('.' + kind) and stale != os.path.basename(path):
+                try: os.remove(os.path.join(self.directory, stale))
+                except OSError: pass # Still mapped on Windows; replaced next time
+    def load_image(self, name, source, variant=''):
+        start = time.perf_counter(); entry = self._map(name, 'img', source, variant)
+        if entry is None: return None
+        flags, width, height, pixels = entry; image = pygame.image.frombuffer(pixels, (width, height), 'BGRA') # Keeps the mapping alive
+        if not flags & ASSET_CACHE_ALPHA: image = image.convert() # Opaque images go back to the display's alpha-less format (one copy)
+        self.load_ms += (time.perf_counter() - start) * 1000.0; return image
+    def store_image(self, name, source, variant, image):
+        if image.get_bitsize() != 32 or image.get_masks()[:3] != CACHE_PIXEL_MASKS: return
+        self._write(name, 'img', source, variant, ASSET_CACHE_ALPHA if image.get_masks()[3] else 0, image.get_width(), image.get_height(), pygame.image.tobytes(image, 'BGRA'))
+    def load_mask(self, name, source, variant=''): # Stored as one 0/1 byte per pixel, like the web bundle's masks
+        start = time.perf_counter(); entry = self._map(name, 'mask', source, variant)
+        if entry is None: return None
+        _, width, height, plane = entry; plane = pygame.image.frombuffer(plane, (width, height), 'P'); plane.set_colorkey(0)
+        mask = pygame.mask.from_surface(plane); self.load_ms += (time.perf_counter() - start) * 1000.0; return mask
+    def store_mask(self, name, source, variant, mask):
+        plane = pygame.image.tobytes(mask.to_surface(setcolor=(1, 1, 1, 255), unsetcolor=(0, 0, 0, 255)), 'RGBA')[0::4]
+        self._write(name, 'mask', source, variant, 0, mask.get_size()[0], mask.get_size()[1], plane)
+    def load_sound(self, name, source):
+        start = time.perf_counter(); entry = self._map(name, 'pcm', source, f"mixer {pygame.mixer.get_init()}")
+        if entry is None: return None
+        sound = pygame.mixer.Sound(buffer=entry[3]); self.load_ms += (time.perf_counter() - start) * 1000.0; return sound
+    def store_sound(self, name, source, sound): self._write(name, 'pcm', source, f"mixer {pygame.mixer.get_init()}", 0, 0, 0, sound.get_raw())
+    def clear(self):
+        if not os.path.isdir(self.directory): return 0
+        names = [n for n in os.listdir(self.directory) if n.endswith(('.img', '.mask', '.pcm', '.tmp'))]
+        for n in names: os.remove(os.path.join(self.directory, n))
+        return len(names)
+    def stats(self): return dict(self.counts, enabled=self.enabled, load_ms=round(self.load_ms, 1))
+
+asset_cache = DecodedAssetCache()
 
 # --- 全螢幕相關 ---
 is_fullscreen = False
@@ -45,132 +223,298 @@ FULLSCREEN_BUTTON_SIZE = (30, 30)
 FULLSCREEN_BUTTON_MARGIN = 5
 
 # --- Asset Loading Variables ---
-assets = {}
+assets = {} # Decoded images by key; filled on demand by asset_manager
 sounds = {}
-background_sound = None # Use a Sound object for BGM
-cover_sound = None # MODIFIED: For cover music (dq.ogg)
-main_font_path = None
-
-# --- Asset Loading Function ---
-def load_assets():
-    print("開始載入圖片資源...")
-    # Keeping original filenames as per user request for "套皮"
-    img_files = {
-        'player': 'zg.png', 'skill_icon': 'bog01.png', 'skill_anim1': 'bog02.png', # MODIFIED: Renamed keys for clarity
-        'skill_anim2': 'bog03.png', 'cover': 'start_screen.jpg'
-    }
-    img_files.update({f'p{i:02d}': f'p{i:02d}.png' for i in range(1, 10)})
-    img_files.update({f'boss{i*10}': f'boss{i*10}.png' for i in range(1, 6)})
-    for key, filename in img_files.items():
-        path = os.path.join(IMG_DIR, filename); assets[key] = None
-        if not os.path.exists(path): print(f"  錯誤：檔案不存在 {filename} 在路徑 {path}"); continue
+music_paths = {} # 'background' / 'cover' -> OGG path, streamed with pygame.mixer.music instead of decoded to PCM
+main_font_path = None; full_font_path = None # full_font_path is set only while main_font_path is the subset
+
+# --- 圖片資源管理 ---
+# Only the start menu's images are decoded up front. Everything else is decoded the first time it is asked for,
+# the next level's enemies/boss are prefetched as an asyncio task during the LEVEL_TRANSITION delay, and boss
+# images (the largest PNGs) are evicted once the level being entered no longer needs them.
+IMAGE_FILES = { # Keeping original filenames as per user request for "套皮"
+    'player': 'zg.png', 'skill_icon': 'bog01.png', 'skill_anim1': 'bog02.png', # MODIFIED: Renamed keys for clarity
+    'skill_anim2': 'bog03.png', 'cover': 'start_screen.jpg'}
+IMAGE_FILES.update({f'p{i:02d}': f'p{i:02d}.png' for i in range(1, 10)})
+IMAGE_FILES.update({f'boss{i*10}': f'boss{i*10}.png' for i in range(1, 6)})
+STARTUP_IMAGES = ('cover',)
+
+def load_image_file(path): # Decoded and converted to the display format (alpha kept when there is one)
+    image = pygame.image.load(path)
+    try: return image.convert_alpha()
+    except ValueError: return image.convert()
+
+class AssetManager:
+    def __init__(self):
+        self.decoded = 0; self.evicted = 0; self.prefetched = 0; self.decode_ms = 0.0; self.prefetch_task = None; self.cache_hits = 0
+        self.manifest = None; self.mask_blob = b''; self.pages = {}
+    def load_manifest(self): # Packed atlases, masks and SFX from tools/build_web_bundle.py; loose files stay the fallback
+        path = os.path.join(BUNDLE_DIR, BUNDLE_MANIFEST)
+        if self.manifest or not os.path.exists(path): return bool(self.manifest)
+        try:
+            with open(path, encoding='utf-8') as f: manifest = json.load(f)
+            with open(os.path.join(BUNDLE_DIR, manifest['masks']), 'rb') as f: mask_blob = f.read()
+        except Exception as e: log.warning('assets.manifest', "警告: 資源包清單讀取失敗 (%s), 改用個別檔案.", e); return False
+        self.manifest = manifest; self.mask_blob = mask_blob
+        log.info('assets.manifest', "使用資源包: %d 張圖片 / %d 張圖集, %d 個音效.", len(manifest['images']), len(manifest['pages']), len(manifest.get('sounds', {}))); return True
+    def _page(self, name):
+        page = self.pages.get(name)
+        if page is None: page = self.pages[name] = load_image_file(os.path.join(BUNDLE_DIR, self.manifest['pages'][name]['file']))
+        return page
+    def _from_bundle(self, key):
+        entry = self.manifest['images'].get(key) if self.manifest else None
+        if not entry: return None
         try:
-            image = pygame.image.load(path)
-            try: assets[key] = image.convert_alpha()
-            except ValueError: assets[key] = image.convert()
-        except Exception as e: print(f"  錯誤：載入圖片 {filename}: {e}"); assets[key] = None
-
-    # Fallback for skill animation images if missing, using skill_icon or placeholder
-    if not assets.get('skill_anim1') or not assets.get('skill_anim2'):
-        print("警告: 缺少技能動畫圖，使用備用圖。")
-        if not assets.get('skill_anim1') and assets.get('skill_icon'): assets['skill_anim1'] = assets['skill_icon']
-        if not assets.get('skill_anim2') and assets.get('skill_anim1'): assets['skill_anim2'] = assets['skill_anim1']
-        elif not assets.get('skill_anim2') and assets.get('skill_icon'): assets['skill_anim2'] = assets['skill_icon']
-
-    if assets.get('player') is None:
-        print("警告: 無玩家圖, 使用備用"); assets['player_fallback'] = pygame.Surface([50, 60]); assets['player_fallback'].fill(GREEN); assets['player'] = assets['player_fallback']
-    if assets.get('cover'):
-        try: assets['cover'] = pygame.transform.scale(assets['cover'], (SCREEN_WIDTH, SCREEN_HEIGHT))
-        except Exception as e: print(f"錯誤: 縮放封面失敗: {e}"); assets['cover'] = None
-    print("圖片資源載入完成.")
+            page = self.manifest['pages'][entry['page']]
+            if tuple(page['size']) == tuple(entry['rect'][2:]): return load_image_file(os.path.join(BUNDLE_DIR, page['file'])) # A one-image page is the image: no copy, nothing resident
+            return self._page(entry['page']).subsurface(entry['rect']).copy() # A copy, so evicting the page frees it
+        except Exception as e: log.warning('assets.atlas', "  警告: 圖集讀取 %s 失敗 (%s), 改用個別檔案.", key, e); return None
+    def mask(self, key, size, image=None): # Serialized or cached collision mask for key; None lets SpritePrototype build one
+        entry = self.manifest['images'].get(key) if self.manifest else None
+        if not entry or 'mask' not in entry or tuple(entry['rect'][2:]) != tuple(size): return self._cached_mask(key, size, image)
+        offset, length = entry['mask'] # zlib-compressed plane of one 0/1 byte per pixel
+        try: plane = pygame.image.frombytes(zlib.decompress(self.mask_blob[offset:offset + length]), size, 'P')
+        except Exception as e: log.warning('assets.mask', "  警告: %s 遮罩讀取失敗 (%s)", key, e); return None
+        plane.set_colorkey(0); return pygame.mask.from_surface(plane) # Colorkeyed 8-bit surface: every non-zero byte is set
+    def _cached_mask(self, key, size, image):
+        source, variant = self._source(key); variant += f" {size[0]}x{size[1]}"
+        mask = asset_cache.load_mask(key, source, variant)
+        if mask is None and image is not None and image.get_size() == tuple(size) and assets.get(key) is image: # Only the real image, not a fallback
+            mask = pygame.mask.from_surface(image); asset_cache.store_mask(key, source, variant, mask) # Same threshold as SpritePrototype
+        return mask
+    def _source(self, key): # (file the decoded pixels come from, what else shapes them) for the decoded-asset cache
+        entry = self.manifest['images'].get(key) if self.manifest else None
+        if entry: return os.path.join(BUNDLE_DIR, self.manifest['pages'][entry['page']]['file']), f"atlas {entry['rect']}"
+        filename = IMAGE_FILES.get(key)
+        return (os.path.join(IMG_DIR, filename) if filename else None), ('' if key != 'cover' else f"scaled {SCREEN_WIDTH}x{SCREEN_HEIGHT}")
+    def sound_path(self, key, filename):
+        bundled = self.manifest.get('sounds', {}).get(key) if self.manifest else None
+        if bundled and os.path.exists(os.path.join(BUNDLE_DIR, bundled)): return os.path.join(BUNDLE_DIR, bundled)
+        return os.path.join(SND_DIR, filename)
+    def _decode(self, key):
+        start = time.perf_counter(); source, variant = self._source(key); image = asset_cache.load_image(key, source, variant)
+        if image is not None: self.cache_hits += 1; self.decoded += 1; self.decode_ms += (time.perf_counter() - start) * 1000.0; return image
+        image = self._from_bundle(key)
+        if image is None:
+            filename = IMAGE_FILES.get(key)
+            if not filename: return None
+            path = os.path.join(IMG_DIR, filename)
+            if not os.path.exists(path): log.error('assets.missing', "  錯誤：檔案不存在 %s 在路徑 %s", filename, path); return None
+            try: image = load_image_file(path)
+            except Exception as e: log.error('assets.decode', "  錯誤：載入圖片 %s: %s", filename, e); return None
+        if key == 'cover':
+            try: image = pygame.transform.scale(image, (SCREEN_WIDTH, SCREEN_HEIGHT))
+            except Exception as e: log.error('assets.cover', "錯誤: 縮放封面失敗: %s", e); image = None
+        if image is not None: asset_cache.store_image(key, source, variant, image)
+        self.decoded += 1; self.decode_ms += (time.perf_counter() - start) * 1000.0
+        return image
+    def image(self, key): # Decoded image or its fallback; None only when there is nothing to show at all
+        if key in assets: return assets[key]
+        image = self._decode(key)
+        if image is None: # Fallback for skill animation images if missing, using skill_icon or placeholder
+            if key == 'skill_anim1': log.warning('assets.fallback', "警告: 缺少技能動畫圖，使用備用圖。"); image = self.image('skill_icon')
+            elif key == 'skill_anim2': log.warning('assets.fallback', "警告: 缺少技能動畫圖，使用備用圖。"); image = self.image('skill_anim1')
+            elif key == 'player': log.warning('assets.fallback', "警告: 無玩家圖, 使用備用"); image = pygame.Surface([50, 60]); image.fill(GREEN)
+        assets[key] = image; return image
+    def level_keys(self, level): # Images a base level can need, boss summons included
+        if not 0 < level <= MAX_LEVELS: return []
+        data = level_data[level - 1]; keys = list(data['enemies'])
+        if data['boss']: keys.append(data['boss']); keys.extend(k for k in BOSS_SUMMON_LISTS.get(level, {}) if k not in keys)
+        return keys
+    def _build(self, key): self.image(key); prototypes.boss(key) if key.startswith('boss') else prototypes.enemy(key)
+    def enter_level(self, level): # Synchronously completes whatever the prefetch did not get to, then evicts stale bosses
+        needed = self.level_keys(level)
+        for key in needed: self._build(key)
+        for key in [k for k in assets if k.startswith('boss') and k not in needed]:
+            del assets[key]; prototypes.bosses.pop(key, None); self.evicted += 1; log.info('assets.evict', "  釋放 Boss 資源: %s", key)
+        for name in list(self.pages): # Drop atlas pages none of whose images are still resident
+            if not any(entry['page'] == name and k in assets for k, entry in self.manifest['images'].items()): del self.pages[name]
+    def schedule_prefetch(self, level):
+        keys = [k for k in self.level_keys(level) if k not in assets]
+        if not keys: return
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: return # Headless and tool runs have no loop; enter_level loads on demand instead
+        self.prefetch_task = loop.create_task(self._prefetch(keys))
+    async def _prefetch(self, keys):
+        for key in keys:
+            if key not in assets: self._build(key); self.prefetched += 1
+            await asyncio.sleep(0) # At most one decode per frame
+    def stats(self): return {'decoded': self.decoded, 'cache_hits': self.cache_hits, 'prefetched': self.prefetched, 'evicted': self.evicted, 'resident': len(assets), 'decode_ms': round(self.decode_ms, 1)}
+
+asset_manager = AssetManager()
+
+def load_assets(): # Start-menu images only; see AssetManager
+    log.info('assets.load', "開始載入圖片資源..."); asset_manager.load_manifest()
+    for key in STARTUP_IMAGES: asset_manager.image(key)
+    log.info('assets.load', "圖片資源載入完成 (%d 張, %.1f ms, 快取命中 %d).", asset_manager.decoded, asset_manager.decode_ms, asset_manager.cache_hits)
 
 # --- 音效載入 ---
+SOUND_FILES = {
+    'player_shoot': 'ax01.ogg', 'boss_spawn': 'boss01.ogg', 'boss_defeat': 'boss02.ogg',
+    'enemy_shoot': 'bg01.ogg', 'enemy_explosion': 'bg02.ogg', 'enemy_dive': 'bg03.ogg',
+    'powerup': 'cz01.ogg', 'skill_activate': 'dx01.ogg', 'player_hit': 'ga01.ogg', # MODIFIED: pom_skill -> skill_activate
+    'game_over': 'gg.ogg', 'ui_click': 'kc.ogg'
+}
 def load_sounds():
-    global background_sound, cover_sound # MODIFIED: Added cover_sound
-    print("開始載入音效資源 (OGG)...")
-    sound_files = {
-        'player_shoot': 'ax01.ogg', 'boss_spawn': 'boss01.ogg', 'boss_defeat': 'boss02.ogg',
-        'enemy_shoot': 'bg01.ogg', 'enemy_explosion': 'bg02.ogg', 'enemy_dive': 'bg03.ogg',
-        'powerup': 'cz01.ogg', 'skill_activate': 'dx01.ogg', 'player_hit': 'ga01.ogg', # MODIFIED: pom_skill -> skill_activate
-        'game_over': 'gg.ogg', 'ui_click': 'kc.ogg'
-    }
-    for key, filename in sound_files.items():
-        path = os.path.join(SND_DIR, filename); sounds[key] = None
-        if not os.path.exists(path): print(f"  警告：音效檔不存在 {filename} (預期為 .ogg)"); continue
+    log.info('sounds.load', "開始載入音效資源 (OGG)..."); start = time.perf_counter(); cached = 0
+    for key, filename in SOUND_FILES.items():
+        path = asset_manager.sound_path(key, filename); sounds[key] = None # Re-encoded bundle copy when there is one
+        if not os.path.exists(path): log.warning('sounds.missing', "  警告：音效檔不存在 %s (預期為 .ogg)", filename); continue
         try:
-            sound_obj = pygame.mixer.Sound(path)
+            sound_obj = asset_cache.load_sound(key, path) # PCM decoded on an earlier launch
+            if sound_obj is None: sound_obj = pygame.mixer.Sound(path); asset_cache.store_sound(key, path, sound_obj)
+            else: cached += 1
             # Volume adjustments from original code
             if key == 'ui_click': sound_obj.set_volume(0.7)
             elif key == 'player_shoot': sound_obj.set_volume(0.5)
             elif key == 'enemy_explosion': sound_obj.set_volume(0.6)
             elif key == 'skill_activate': sound_obj.set_volume(0.7) # Assuming similar volume for skill
             sounds[key] = sound_obj
-        except Exception as e: print(f"  錯誤：載入音效 {filename}: {e}"); sounds[key] = None
+        except Exception as e: log.error('sounds.decode', "  錯誤：載入音效 %s: %s", filename, e); sounds[key] = None
 
-    # Load game background music
-    game_music_file = 'background.ogg'
-    _path_game_music = os.path.join(SND_DIR, game_music_file)
-    if os.path.exists(_path_game_music):
-        try:
-            background_sound = pygame.mixer.Sound(_path_game_music)
-            print(f"  遊戲背景音樂加載為 Sound 對象: {game_music_file}")
-        except Exception as e:
-             print(f"  錯誤：將遊戲背景音樂加載為 Sound 對象失敗 {game_music_file}: {e}")
-             background_sound = None
-    else:
-        print(f"  警告：遊戲背景音樂檔不存在 {game_music_file} (預期為 .ogg)")
-        background_sound = None
+    # Music is streamed through pygame.mixer.music, so only the paths are resolved here
+    for name, music_file in (('background', 'background.ogg'), ('cover', 'dq.ogg')): # MODIFIED: cover music (dq.ogg)
+        path = os.path.join(SND_DIR, music_file)
+        if os.path.exists(path): music_paths[name] = path; log.info('sounds.music', "  音樂將以串流播放: %s", music_file)
+        else: log.warning('sounds.music', "  警告：音樂檔不存在 %s (預期為 .ogg)", music_file)
+
+    log.info('sounds.load', "音效資源載入完成 (%.1f ms, 快取命中 %d).", (time.perf_counter() - start) * 1000.0, cached)
 
-    # MODIFIED: Load cover music (dq.ogg)
-    cover_music_file = 'dq.ogg'
-    _path_cover_music = os.path.join(SND_DIR, cover_music_file)
-    if os.path.exists(_path_cover_music):
+# --- 音效管理 ---
+# Music is streamed by pygame.mixer.music and the playing track is tracked here, so nothing has to scan the mixer.
+# Sound effects share every mixer channel under per-sound limits: at most max_voices at once (a new
+# trigger restarts that sound's oldest voice) and min_interval_ms between triggers. When every channel is
+# busy, the lowest-priority, oldest voice is stolen if it does not outrank the new sound.
+MUSIC_VOLUME = {'background': 1.0, 'cover': 0.6}
+AUDIO_SFX_VOICES = 14 # SFX mixed at once; one mixer channel each, since music streams outside the channels
+SOUND_POLICIES = { # key: (max_voices, min_interval_ms, priority)
+    'player_shoot': (2, 60, 1), 'enemy_shoot': (3, 50, 1), 'enemy_explosion': (4, 40, 2), 'enemy_dive': (2, 120, 2),
+    'powerup': (2, 0, 4), 'ui_click': (2, 0, 5), 'player_hit': (1, 0, 5), 'skill_activate': (1, 0, 5),
+    'boss_spawn': (1, 0, 5), 'boss_defeat': (1, 0, 6), 'game_over': (1, 0, 6)}
+DEFAULT_SOUND_POLICY = (2, 0, 3)
+
+class AudioManager:
+    def __init__(self):
+        self.channels = []; self.owners = [] # Per SFX channel: (key, priority, start_ms) of the last sound played on it
+        self.last_trigger = {}; self.music = None
+        self.counters = {'played': 0, 'throttled': 0, 'restarted': 0, 'stolen': 0, 'dropped': 0}
+    def init(self): # Called once the mixer is up; headless runs never call it and every method becomes a no-op
+        pygame.mixer.set_num_channels(AUDIO_SFX_VOICES); self.channels = [pygame.mixer.Channel(i) for i in range(AUDIO_SFX_VOICES)]
+        self.owners = [None] * len(self.channels); self.music = None
+    def play(self, key):
+        sound = sounds.get(key)
+        if not sound or not self.channels: return None
+        max_voices, min_interval_ms, priority = SOUND_POLICIES.get(key, DEFAULT_SOUND_POLICY); now = pygame.time.get_ticks()
+        if quality.sfx_throttle and priority <= QUALITY_SFX_MAX_PRIORITY: max_voices = 1; min_interval_ms = max(min_interval_ms, QUALITY_SFX_MIN_INTERVAL_MS)
+        if min_interval_ms and now - self.last_trigger.get(key, -min_interval_ms) < min_interval_ms: self.counters['throttled'] += 1; return None
+        own = []; free = None; victim = None
+        for i, channel in enumerate(self.channels):
+            owner = self.owners[i]
+            if owner is None or not channel.get_busy():
+                if free is None: free = i
+                continue
+            if owner[0] == key: own.append(i)
+            if owner[1] <= priority and (victim is None or (owner[1], owner[2]) < (self.owners[victim][1], self.owners[victim][2])): victim = i
+        if len(own) >= max_voices: index = min(own, key=lambda i: self.owners[i][2]); self.counters['restarted'] += 1 # Voice limit: restart the oldest
+        elif free is not None: index = free
+        elif victim is not None: index = victim; self.counters['stolen'] += 1
+        else: self.counters['dropped'] += 1; return None
+        self.channels[index].play(sound); self.owners[index] = (key, priority, now); self.last_trigger[key] = now; self.counters['played'] += 1
+        return self.channels[index]
+    def play_music(self, name): # Streams the track, replacing whichever one is playing
+        if not self.channels: return
+        self.stop_music(); path = music_paths.get(name)
+        if path is None: log.warning('audio.music', "%s 音樂未載入, 無法播放.", name); return
         try:
-            cover_sound = pygame.mixer.Sound(_path_cover_music)
-            cover_sound.set_volume(0.6) # Example volume, adjust as needed
-            print(f"  封面音樂加載為 Sound 對象: {cover_music_file}")
-        except Exception as e:
-            print(f"  錯誤：將封面音樂加載為 Sound 對象失敗 {cover_music_file}: {e}")
-            cover_sound = None
-    else:
-        print(f"  警告：封面音樂檔不存在 {cover_music_file} (預期為 .ogg)")
-        cover_sound = None
+            pygame.mixer.music.load(path); pygame.mixer.music.set_volume(MUSIC_VOLUME.get(name, 1.0)); pygame.mixer.music.play(loops=-1)
+            self.music = name; log.info('audio.music', "%s音樂已開始.", '遊戲背景' if name == 'background' else '封面')
+        except Exception as e: log.error('audio.music', "錯誤：播放%s音樂失敗: %s", name, e)
+    def stop_music(self):
+        if self.music is None or not self.channels: return
+        pygame.mixer.music.stop(); self.music = None
+    def stats(self): return dict(self.counters, music=self.music, busy_sfx=sum(1 for c in self.channels if c.get_busy()))
 
-    print("音效資源載入完成.")
+audio = AudioManager()
 
 # --- 字體設定 ---
 CUSTOM_FONT_FILENAME = "Cubic_11_1.000_R.ttf" # Keeping original font settings
+SUBSET_FONT_FILENAME = "Cubic_11_1.000_R.subset.ttf" # Written by tools/subset_font.py: only the glyphs main.py draws
+TEXT_CACHE_MAX_ENTRIES = 256 # 已渲染文字 Surface 的 LRU 上限 (分數等變動字串會持續淘汰舊項)
 def init_font():
-    global main_font_path
-    prospective_font_path = os.path.join(FONT_DIR, CUSTOM_FONT_FILENAME)
-    if os.path.exists(prospective_font_path): main_font_path = prospective_font_path; print(f"使用自訂字體: {main_font_path}")
+    global main_font_path, full_font_path, _subset_face
+    prospective_font_path = os.path.join(FONT_DIR, CUSTOM_FONT_FILENAME); subset_font_path = os.path.join(FONT_DIR, SUBSET_FONT_FILENAME)
+    full_font_path = prospective_font_path if os.path.exists(prospective_font_path) else None # Only opened for glyphs the subset lacks
+    if os.path.exists(subset_font_path): main_font_path = subset_font_path; log.info('font', "使用子集字體: %s%s", main_font_path, "" if full_font_path else " (無完整字體可備援)")
+    elif full_font_path: main_font_path = prospective_font_path; full_font_path = None; log.info('font', "使用自訂字體: %s", main_font_path)
     else:
-        print(f"警告：自訂字體文件 '{prospective_font_path}' 未找到！"); print("將嘗試使用 Pygame 預設字體 (可能無法顯示中文)。")
+        log.warning('font', "警告：自訂字體文件 '%s' 未找到！", prospective_font_path); log.warning('font', "將嘗試使用 Pygame 預設字體 (可能無法顯示中文)。")
         main_font_path = pygame.font.get_default_font()
-        if main_font_path: print(f"使用 Pygame 預設字體: {main_font_path}")
-        else: print("警告：無法找到任何可用字型！文字可能無法顯示。"); main_font_path = None
+        if main_font_path: log.info('font', "使用 Pygame 預設字體: %s", main_font_path)
+        else: log.warning('font', "警告：無法找到任何可用字型！文字可能無法顯示。"); main_font_path = None
+    text_cache.clear(); _font_objects.clear(); _subset_glyphs.clear(); _subset_face = None # Cached surfaces/fonts belong to the previous font (and pygame.font session)
+
+# --- 文字渲染快取 ---
+# Parsing the 2.7 MB TTF is the most expensive thing draw_text used to do every call,
+# so each (path, size) pair is opened once and rendered strings are kept in a bounded LRU.
+_font_objects = {} # (font_path, size) -> pygame.font.Font
+
+def get_font(font_path, size):
+    key = (font_path, size); font = _font_objects.get(key)
+    if font is None: font = pygame.font.Font(font_path, size); _font_objects[key] = font
+    return font
+
+_subset_glyphs = {} # char -> whether the subset font has it
+_subset_face = None
+def subset_has_glyphs(text): # pygame.font reports .notdef metrics for missing glyphs; pygame.freetype reports None
+    global _subset_face
+    unknown = [c for c in set(text) if c not in _subset_glyphs]
+    if unknown:
+        try:
+            if _subset_face is None: import pygame.freetype; pygame.freetype.init(); _subset_face = pygame.freetype.Font(main_font_path)
+            for c, metrics in zip(unknown, _subset_face.get_metrics("".join(unknown), size=12)): _subset_glyphs[c] = metrics is not None or c.isspace()
+        except Exception as e: log.warning('font.subset', "警告: 無法檢查子集字體字元 (%s)", e); _subset_glyphs.update(dict.fromkeys(unknown, True))
+    return all(_subset_glyphs[c] for c in text)
+
+class TextCache:
+    def __init__(self, max_entries=TEXT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries; self.entries = OrderedDict() # (text, size, color) -> Surface
+        self.hits = 0; self.misses = 0; self.evictions = 0; self.full_font_renders = 0
+    def render(self, text, size, color=WHITE): # Returned surfaces are shared: blit them, never draw on them
+        key = (text, size, tuple(color)); text_surface = self.entries.get(key)
+        if text_surface is not None: self.hits += 1; self.entries.move_to_end(key); return text_surface
+        self.misses += 1; font = get_font(main_font_path, size)
+        if full_font_path and not subset_has_glyphs(text): font = get_font(full_font_path, size); self.full_font_renders += 1
+        elif not full_font_path and main_font_path and main_font_path.endswith(SUBSET_FONT_FILENAME) and not subset_has_glyphs(text): log.warning('font.missing', "警告: 子集字體缺少 '%s' 的字元, 且無完整字體可備援.", text)
+        text_surface = font.render(text, True, color); self.entries[key] = text_surface
+        if len(self.entries) > self.max_entries: self.entries.popitem(last=False); self.evictions += 1
+        return text_surface
+    def clear(self): self.entries.clear()
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'entries': len(self.entries), 'fonts': len(_font_objects), 'full_font_renders': self.full_font_renders, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+text_cache = TextCache()
 
 def draw_text(surf, text, size, x, y, color=WHITE, align="midtop"):
     if not main_font_path: return
     try:
-        font = pygame.font.Font(main_font_path, size); text_surface = font.render(text, True, color)
-        align_dict = {align: (x, y)}; text_rect = text_surface.get_rect(**align_dict); surf.blit(text_surface, text_rect)
+        text_surface = text_cache.render(text, size, color)
+        align_dict = {align: (x, y)}; text_rect = text_surface.get_rect(**align_dict); surf.blit(text_surface, text_rect); return text_rect
     except Exception as e:
-        print(f"繪製文字 '{text}' (字體: {main_font_path}) 時發生錯誤: {e}")
+        log.error('draw_text', "繪製文字 '%s' (字體: %s) 時發生錯誤: %s", text, main_font_path, e)
         try:
-            fallback_font = pygame.font.Font(None, size); text_surface = fallback_font.render(text, True, color)
-            align_dict = {align: (x, y)}; text_rect = text_surface.get_rect(**align_dict); surf.blit(text_surface, text_rect)
-        except Exception as e_fallback: print(f"備用字體繪製 '{text}' 也失敗: {e_fallback}")
+            fallback_font = get_font(None, size); text_surface = fallback_font.render(text, True, color)
+            align_dict = {align: (x, y)}; text_rect = text_surface.get_rect(**align_dict); surf.blit(text_surface, text_rect); return text_rect
+        except Exception as e_fallback: log.error('draw_text.fallback', "備用字體繪製 '%s' 也失敗: %s", text, e_fallback)
 
-def draw_ui(surf, level_disp, score_disp, lives_disp, skill_charges_disp, loop_count_disp): # MODIFIED: pom_charges_disp -> skill_charges_disp
+def paint_hud(surf, display_level_val, score_disp, lives_disp, skill_charges_disp, skill_icon): # Onto UILayer's cached bar; draw_ui blits that
     global fullscreen_button_rect
-    ui_bar_height = 30; pygame.draw.rect(surf, BLACK, (0, 0, SCREEN_WIDTH, ui_bar_height))
-    display_level_val = level_disp + loop_count_disp * MAX_LEVELS
+    ui_bar_height = HUD_BAR_HEIGHT
     draw_text(surf, f"關卡:{display_level_val}", 18, 10, 5, align="topleft")
     draw_text(surf, f"分數:{score_disp}", 18, SCREEN_WIDTH / 2, 5, align="midtop")
     button_x = SCREEN_WIDTH - FULLSCREEN_BUTTON_SIZE[0] - FULLSCREEN_BUTTON_MARGIN
     button_y = (ui_bar_height - FULLSCREEN_BUTTON_SIZE[1]) // 2
-    fullscreen_button_rect = pygame.Rect(button_x, button_y, FULLSCREEN_BUTTON_SIZE[0], FULLSCREEN_BUTTON_SIZE[1])
+    fullscreen_button_rect = pygame.Rect(button_x, button_y, FULLSCREEN_BUTTON_SIZE[0], FULLSCREEN_BUTTON_SIZE[1]) # The bar sits at (0, 0), so bar and screen coordinates agree
     pygame.draw.rect(surf, FULLSCREEN_BUTTON_COLOR, fullscreen_button_rect)
     button_text = "F" if not is_fullscreen else "W"
     draw_text(surf, button_text, 18, fullscreen_button_rect.centerx, fullscreen_button_rect.centery, FULLSCREEN_BUTTON_TEXT_COLOR, align="center")
@@ -179,61 +523,395 @@ def draw_ui(surf, level_disp, score_disp, lives_disp, skill_charges_disp, loop_c
 
     # MODIFIED: UI for skill charges
     skill_icon_width_estimate = 80; skill_icon_x_pos = lives_x_pos - skill_icon_width_estimate - 10
-    if assets.get('skill_icon'): # Using the renamed 'skill_icon' key
-        try:
-            icon = pygame.transform.scale(assets['skill_icon'], (25, 25)); surf.blit(icon, (skill_icon_x_pos, 5))
-            draw_text(surf, f"x {skill_charges_disp}", 18, skill_icon_x_pos + 30, 8, align="topleft")
-        except Exception as e: print(f"繪製技能圖示錯誤: {e}"); draw_text(surf, f"技能:{skill_charges_disp}", 18, skill_icon_x_pos, 5, align="topleft")
+    if skill_icon: surf.blit(skill_icon, (skill_icon_x_pos, 5)); draw_text(surf, f"x {skill_charges_disp}", 18, skill_icon_x_pos + 30, 8, align="topleft")
     else: draw_text(surf, f"技能:{skill_charges_disp}", 18, skill_icon_x_pos, 5, align="topleft")
 
+def draw_ui(surf, level_disp, score_disp, lives_disp, skill_charges_disp, loop_count_disp): # MODIFIED: pom_charges_disp -> skill_charges_disp
+    surf.blit(ui_layer.hud_surface(level_disp + loop_count_disp * MAX_LEVELS, score_disp, lives_disp, skill_charges_disp), (0, 0))
+    return pygame.Rect(0, 0, SCREEN_WIDTH, HUD_BAR_HEIGHT)
+
 def draw_health_bar(surf, x, y, pct, bar_length=100, bar_height=10, color_stages=True):
     pct = max(0, min(pct, 100)); fill_width = (pct / 100) * bar_length
     outline_rect = pygame.Rect(x, y, bar_length, bar_height); fill_rect = pygame.Rect(x, y, fill_width, bar_height)
     bar_color = RED;
     if color_stages: bar_color = GREEN if pct > 60 else YELLOW if pct > 30 else RED
-    pygame.draw.rect(surf, bar_color, fill_rect); pygame.draw.rect(surf, WHITE, outline_rect, 2)
+    pygame.draw.rect(surf, bar_color, fill_rect); pygame.draw.rect(surf, WHITE, outline_rect, 2); return outline_rect
+
+# --- 保留模式介面 ---
+# The HUD bar and each static screen (menus, GAME OVER) are composited once into cached surfaces and rebuilt only
+# when what they show changes: level, score, lives, skill charges, fullscreen state, or which screen it is.
+# Static screens also tick at an idle frame rate until the next input event.
+HUD_BAR_HEIGHT = 30
+STATIC_SCREENS = ("START_MENU", "POST_VICTORY_CHOICE", "GAME_OVER", "WIN_SCREEN")
+UI_IDLE_FPS = 10 # Raised in main() if the fixed step could not keep up at this rate
+UI_IDLE_AFTER_MS = 1000 # Full frame rate for this long after the last input event
+UI_INPUT_EVENTS = (pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.KEYDOWN, pygame.KEYUP, pygame.WINDOWFOCUSGAINED)
+class UILayer:
+    def __init__(self):
+        self.hud = None; self.hud_key = None; self.screen = None; self.screen_key = None; self.icon = None; self.icon_source = None
+        self.last_input = 0; self.counts = {'hud_builds': 0, 'hud_blits': 0, 'screen_builds': 0, 'screen_blits': 0, 'idle_frames': 0}
+    def invalidate(self): self.hud = self.screen = self.hud_key = self.screen_key = None # New display surface (fullscreen toggle)
+    def skill_icon(self): # Scaled once per source image instead of every frame
+        source = asset_manager.image('skill_icon')
+        if source is not self.icon_source:
+            self.icon_source = source
+            try: self.icon = pygame.transform.scale(source, (25, 25)) if source else None
+            except Exception as e: log.error('draw_ui.skill_icon', "繪製技能圖示錯誤: %s", e); self.icon = None
+        return self.icon
+    def hud_surface(self, display_level, score_disp, lives_disp, skill_charges_disp):
+        key = (display_level, score_disp, lives_disp, skill_charges_disp, is_fullscreen); self.counts['hud_blits'] += 1
+        if key != self.hud_key:
+            if self.hud is None: self.hud = pygame.Surface((SCREEN_WIDTH, HUD_BAR_HEIGHT)).convert()
+            self.hud.fill(BLACK); paint_hud(self.hud, display_level, score_disp, lives_disp, skill_charges_disp, self.skill_icon())
+            self.hud_key = key; self.counts['hud_builds'] += 1
+        return self.hud
+    def screen_surface(self, state): # The whole static screen, HUD bar included
+        lives = player.lives if player and hasattr(player, 'lives') else 0; charges = player.skill_charges if player and hasattr(player, 'skill_charges') else 0
+        key = (state, current_level, loop_count, score, lives, charges, is_fullscreen); self.counts['screen_blits'] += 1
+        if key != self.screen_key:
+            if self.screen is None: self.screen = pygame.Surface((SCREEN_WIDTH, SCREEN_HEIGHT)).convert()
+            self.screen.fill(BLACK); paint_static_screen(self.screen, state); self.screen_key = key; self.counts['screen_builds'] += 1
+        return self.screen
+    def note_input(self, event):
+        if event.type in UI_INPUT_EVENTS: self.last_input = pygame.time.get_ticks()
+    def is_idle(self, state):
+        idle = state in STATIC_SCREENS and pygame.time.get_ticks() - self.last_input > UI_IDLE_AFTER_MS
+        if idle: self.counts['idle_frames'] += 1
+        return idle
+    def stats(self): return dict(self.counts)
+
+ui_layer = UILayer()
+
+# --- 髒矩形渲染器 ---
+# Sprite states clear the previous sprite/overlay rects and redraw on top; static screens
+# (menus, GAME OVER) are only redrawn when the state changes or the renderer is invalidated.
+SPRITE_DRAW_STATES = ("PLAYING", "LEVEL_TRANSITION")
+def _clear_to_black(surf, rect): surf.fill(BLACK, rect)
+
+class DirtyRectRenderer:
+    def __init__(self, full_flip_ratio=DIRTY_FULL_FLIP_RATIO):
+        self.full_flip_ratio = full_flip_ratio; self.screen_rect = pygame.Rect(0, 0, SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.full_redraw = True; self.last_state = None; self.last_surface = None
+        self.frame_rects = []; self.overlay_rects = []; self.prev_overlay_rects = []
+        self.last_pixels = 0; self.last_full = True; self.total_pixels = 0; self.frames = 0; self.full_frames = 0
+    def invalidate(self): self.full_redraw = True
+    def begin_frame(self, surf, state, sprite_group): # Returns False when the current screen is already up to date
+        self.frame_rects = []; self.overlay_rects = []
+        if state != self.last_state or surf is not self.last_surface: self.full_redraw = True; self.last_state = state; self.last_surface = surf
+        if self.full_redraw: surf.fill(BLACK); self.prev_overlay_rects = []; return True
+        if state not in SPRITE_DRAW_STATES: return False
+        sprite_group.clear(surf, _clear_to_black)
+        for rect in self.prev_overlay_rects: surf.fill(BLACK, rect); self.frame_rects.append(rect)
+        return True
+    def add_rects(self, rects):
+        if rects: self.frame_rects.extend(rects)
+    def add_overlay(self, rect): # HUD, health bar and text drawn over the sprites; cleared again next frame
+        if rect: self.overlay_rects.append(rect); self.frame_rects.append(rect)
+    def add_overlays(self, rects): # Cleared again next frame, like add_overlay (used for array-drawn bullets)
+        if rects: self.overlay_rects.extend(rects); self.frame_rects.extend(rects)
+    def present(self):
+        self.prev_overlay_rects = self.overlay_rects; full_area = self.screen_rect.width * self.screen_rect.height
+        full = self.full_redraw
+        if full: pixels = full_area; pygame.display.flip(); self.full_redraw = False
+        else:
+            rects = [r.clip(self.screen_rect) for r in self.frame_rects]; rects = [r for r in rects if r.width and r.height]
+            pixels = sum(r.width * r.height for r in rects)
+            full = pixels > full_area * self.full_flip_ratio
+            if full: pixels = full_area; pygame.display.flip()
+            elif rects: pygame.display.update(rects)
+        self.last_pixels = pixels; self.last_full = full; self.total_pixels += pixels; self.frames += 1; self.full_frames += full
+        return pixels, full
+    def stats(self):
+        full_area = self.screen_rect.width * self.screen_rect.height; avg = self.total_pixels / self.frames if self.frames else 0
+        return {'frames': self.frames, 'full_frames': self.full_frames, 'last_pixels': self.last_pixels, 'avg_pixels': avg, 'avg_ratio': avg / full_area}
 
 # --- Enemy and Level Data (Copied from v8.2.16, no change in structure) ---
 enemy_data={'p01':{'hp':1,'score':10,'behavior':'normal_slow'},'p02':{'hp':1,'score':20,'behavior':'normal_fast'},'p03':{'hp':2,'score':30,'behavior':'shooter_single'},'p04':{'hp':2,'score':40,'behavior':'diver_curve'},'p05':{'hp':2,'score':50,'behavior':'shooter_burst'},'p06':{'hp':3,'score':60,'behavior':'diver_fast'},'p07':{'hp':3,'score':70,'behavior':'shooter_spread'},'p08':{'hp':3,'score':80,'behavior':'hybrid'},'p09':{'hp':3,'score':90,'behavior':'item'}}
 level_data=[{'enemies':{'p01':8,'p02':2},'boss':None},{'enemies':{'p01':8,'p02':4,'p09':1},'boss':None},{'enemies':{'p01':10,'p02':4,'p09':1},'boss':None},{'enemies':{'p01':12,'p02':6,'p09':2},'boss':None},{'enemies':{'p01':10,'p02':6,'p03':2},'boss':None},{'enemies':{'p01':6,'p02':6,'p03':4,'p09':2},'boss':None},{'enemies':{'p01':4,'p02':8,'p03':4,'p09':2},'boss':None},{'enemies':{'p01':4,'p02':8,'p03':4,'p09':2},'boss':None},{'enemies':{'p01':4,'p02':8,'p03':6,'p09':2},'boss':None},{'enemies':{},'boss':'boss10'},{'enemies':{'p02':8,'p03':2},'boss':None},{'enemies':{'p02':8,'p03':4,'p09':1},'boss':None},{'enemies':{'p02':10,'p03':4,'p09':1},'boss':None},{'enemies':{'p02':12,'p03':6,'p09':2},'boss':None},{'enemies':{'p02':10,'p03':6,'p04':2},'boss':None},{'enemies':{'p02':6,'p03':6,'p04':4,'p09':2},'boss':None},{'enemies':{'p02':4,'p03':8,'p04':4,'p09':2},'boss':None},{'enemies':{'p02':4,'p03':8,'p04':4,'p09':2},'boss':None},{'enemies':{'p02':4,'p03':8,'p04':6,'p09':2},'boss':None},{'enemies':{'p01':8,'p02':8,'p03':8},'boss':'boss20'},{'enemies':{'p02':8,'p03':2},'boss':None},{'enemies':{'p02':8,'p03':4,'p09':2},'boss':None},{'enemies':{'p02':10,'p03':4,'p09':2},'boss':None},{'enemies':{'p02':12,'p03':6,'p09':2},'boss':None},{'enemies':{'p02':10,'p03':6,'p04':2},'boss':None},{'enemies':{'p02':6,'p03':6,'p04':4,'p09':2},'boss':None},{'enemies':{'p02':4,'p03':8,'p04':4,'p09':2},'boss':None},{'enemies':{'p02':4,'p03':8,'p04':4,'p09':2},'boss':None},{'enemies':{'p02':4,'p03':8,'p04':6,'p09':2},'boss':None},{'enemies':{'p02':8,'p04':8,'p05':8},'boss':'boss30'},{'enemies':{'p02':4,'p03':6,'p04':4,'p09':2},'boss':None},{'enemies':{'p04':8,'p05':8,'p09':2},'boss':None},{'enemies':{'p05':12,'p06':6,'p09':2},'boss':None},{'enemies':{'p05':12,'p07':8,'p09':2},'boss':None},{'enemies':{'p06':12,'p07':10,'p03':2},'boss':None},{'enemies':{'p04':8,'p05':6,'p06':4,'p07':4,'p09':2},'boss':None},{'enemies':{'p04':8,'p05':8,'p06':6,'p07':4,'p09':2},'boss':None},{'enemies':{'p04':6,'p05':8,'p06':6,'p07':6,'p09':2},'boss':None},{'enemies':{'p04':6,'p05':8,'p06':8,'p07':6,'p09':2},'boss':None},{'enemies':{'p05':8,'p06':8,'p07':8},'boss':'boss40'},{'enemies':{'p03':4,'p06':6,'p07':4,'p09':2},'boss':None},{'enemies':{'p05':8,'p06':8,'p09':2},'boss':None},{'enemies':{'p07':12,'p08':6,'p09':2},'boss':None},{'enemies':{'p07':10,'p08':8,'p09':2},'boss':None},{'enemies':{'p07':12,'p08':10,'p03':2},'boss':None},{'enemies':{'p06':8,'p07':6,'p08':8,'p09':2},'boss':None},{'enemies':{'p07':14,'p08':12,'p09':2},'boss':None},{'enemies':{'p07':10,'p08':16,'p09':2},'boss':None},{'enemies':{'p08':28,'p09':2},'boss':None},{'enemies':{'p07':12,'p08':12},'boss':'boss50'}]
 MAX_LEVELS = len(level_data)
+BOSS_SUMMON_LISTS = {20: {'p01': 4, 'p02': 4, 'p03': 2}, 30: {'p02': 4, 'p04': 4, 'p05': 2}, 40: {'p05': 4, 'p06': 4, 'p07': 2}, 50: {'p07': 6, 'p08': 6}}
 FORMATION_COLS=10; FORMATION_ROWS=5; FORMATION_START_X=100; FORMATION_START_Y=60; FORMATION_SPACING_X=60; FORMATION_SPACING_Y=50
 
+# --- 俯衝路徑庫 ---
+# Each dive type is a smooth Catmull-Rom template precomputed once and resampled at fixed arc length.
+# A dive is an affine map of its template (origin + u/v axes) plus a progress value t in [0, 1], so
+# per-frame evaluation is a table lookup. Template space: start at (0, 0), v points "down the dive",
+# u is the lateral axis (mirrored towards the screen centre). Marks are the old waypoints, where
+# shooter enemies may fire.
+DIVE_TABLE_SAMPLES = 64
+DIVE_SCREEN_MARGINS = {'swoop': 50, 'loop': 30, 'straight_ish': 50, 'cross_screen': 50} # px from the screen edges, as start_dive's waypoints were clamped
+DIVE_TEMPLATE_POINTS = {
+    'swoop': [(0, 0), (0.8, 0.35), (0.2, 1.0), (-0.2, 0.55)],
+    'loop': [(0, 0), (1.0, 0.52), (0, 1.0), (-1.0, 0.52)],
+    'straight_ish': [(0, 0), (0.3, 0.5), (0, 1.0)],
+    'cross_screen': [(0, 0), (0.05, 0.7), (0.35, 1.0), (1.0, 1.0)],
+}
+
+def _catmull_rom(points, steps_per_span=16):
+    padded = [points[0]] + list(points) + [points[-1]]; dense = []; control_indices = [0]
+    for i in range(1, len(padded) - 2):
+        (x0, y0), (x1, y1), (x2, y2), (x3, y3) = padded[i - 1], padded[i], padded[i + 1], padded[i + 2]
+        for step in range(steps_per_span):
+            t = step / steps_per_span; t2 = t * t; t3 = t2 * t
+            dense.append((0.5 * (2 * x1 + (x2 - x0) * t + (2 * x0 - 5 * x1 + 4 * x2 - x3) * t2 + (3 * x1 - x0 - 3 * x2 + x3) * t3),
+                          0.5 * (2 * y1 + (y2 - y0) * t + (2 * y0 - 5 * y1 + 4 * y2 - y3) * t2 + (3 * y1 - y0 - 3 * y2 + y3) * t3)))
+        control_indices.append(len(dense))
+    dense.append(points[-1]); return dense, control_indices
+
+class DivePathTemplate:
+    def __init__(self, name, control_points, samples=DIVE_TABLE_SAMPLES):
+        self.name = name; dense, control_indices = _catmull_rom(control_points); cumulative = [0.0]
+        for (xa, ya), (xb, yb) in zip(dense, dense[1:]): cumulative.append(cumulative[-1] + math.hypot(xb - xa, yb - ya))
+        total = cumulative[-1]; self.u = array('f'); self.v = array('f')
+        for i in range(samples): # Fixed arc-length resampling
+            target = total * i / (samples - 1); j = min(max(1, bisect.bisect_left(cumulative, target)), len(dense) - 1)
+            seg = cumulative[j] - cumulative[j - 1]; f = (target - cumulative[j - 1]) / seg if seg else 0.0
+            self.u.append(dense[j - 1][0] + (dense[j][0] - dense[j - 1][0]) * f); self.v.append(dense[j - 1][1] + (dense[j][1] - dense[j - 1][1]) * f)
+        self.marks = tuple(cumulative[i] / total for i in control_indices[1:]) # Arc fractions of the original waypoints
+
+class DiveTrajectory:
+    __slots__ = ('template', 'ox', 'oy', 'ux', 'uy', 'vx', 'vy', 't', 'rate', 'next_mark')
+    def __init__(self, template, origin, u_axis, v_axis):
+        self.template = template; self.ox, self.oy = origin; self.ux, self.uy = u_axis; self.vx, self.vy = v_axis
+        self.t = 0.0; self.rate = 0.0; self.next_mark = 0
+    def set_speed(self, speed_pps): # Pixel length of the mapped table, measured once per dive
+        u = self.template.u; v = self.template.v; length = 0.0
+        for i in range(1, len(u)):
+            du = u[i] - u[i - 1]; dv = v[i] - v[i - 1]; length += math.hypot(self.ux * du + self.vx * dv, self.uy * du + self.vy * dv)
+        self.rate = speed_pps / length if length > 0 else 1.0
+    def advance(self, dt): # Returns how many marks were passed this step
+        self.t = min(1.0, self.t + self.rate * dt); marks = self.template.marks; crossed = 0
+        while self.next_mark < len(marks) and self.t >= marks[self.next_mark]: self.next_mark += 1; crossed += 1
+        return crossed
+    @property
+    def done(self): return self.t >= 1.0
+    def position(self):
+        u = self.template.u; v = self.template.v; f = self.t * (len(u) - 1); i = min(int(f), len(u) - 2); f -= i
+        tu = u[i] + (u[i + 1] - u[i]) * f; tv = v[i] + (v[i + 1] - v[i]) * f
+        return (self.ox + self.ux * tu + self.vx * tv, self.oy + self.uy * tu + self.vy * tv)
+
+class DivePathLibrary:
+    def __init__(self):
+        self.names = list(DIVE_TEMPLATE_POINTS); self.templates = {name: DivePathTemplate(name, pts) for name, pts in DIVE_TEMPLATE_POINTS.items()}
+        self.table_u = self.table_v = None
+        if np is not None: # Stacked tables for evaluate_batch
+            self.table_u = np.array([self.templates[n].u for n in self.names], dtype=np.float32); self.table_v = np.array([self.templates[n].v for n in self.names], dtype=np.float32)
+    def create(self, path_type, start_pos, player_center):
+        sx, sy = start_pos; side = 1 if sx < SCREEN_WIDTH / 2 else -1 # Lateral moves head towards the screen centre first
+        stretch = random.uniform(0.85, 1.15); lateral = random.uniform(0.8, 1.2)
+        if path_type == 'swoop': u_axis = (side * 100 * lateral, 0); v_axis = ((player_center[0] - sx) * stretch, max(200, player_center[1] - sy) * stretch)
+        elif path_type == 'loop': u_axis = (side * 75 * lateral, 0); v_axis = (0, 240 * stretch)
+        elif path_type == 'cross_screen': u_axis = ((SCREEN_WIDTH - 2 * sx) * lateral, 0); v_axis = (0, 200 * stretch)
+        else: path_type = 'straight_ish'; u_axis = (side * 60 * lateral, 0); v_axis = ((player_center[0] - sx) * stretch, max(150, player_center[1] + 100 - sy) * stretch)
+        template = self.templates[path_type]; u_axis, v_axis = self._fit_horizontal(template, sx, u_axis, v_axis, DIVE_SCREEN_MARGINS[path_type])
+        return DiveTrajectory(template, start_pos, u_axis, v_axis)
+    def _fit_horizontal(self, template, sx, u_axis, v_axis, margin): # Keeps the whole path within the waypoint clamps the hand-built dives used
+        offsets = [u_axis[0] * tu + v_axis[0] * tv for tu, tv in zip(template.u, template.v)] # x - sx along the table
+        left = min(margin, sx); right = max(SCREEN_WIDTH - margin, sx); lo = min(offsets); hi = max(offsets); scale = 1.0
+        if sx + lo < left: scale = (left - sx) / lo
+        if sx + hi > right: scale = min(scale, (right - sx) / hi)
+        if scale >= 1.0: return u_axis, v_axis
+        return (u_axis[0] * scale, u_axis[1]), (v_axis[0] * scale, v_axis[1]) # Horizontal components only: the dive keeps its depth
+    def evaluate_batch(self, template_index, t, origin, u_axis, v_axis): # NumPy arrays: (N,), (N,), (N,2) x3 -> (N,2) positions
+        f = np.clip(t, 0.0, 1.0) * (DIVE_TABLE_SAMPLES - 1); i = np.minimum(f.astype(np.int32), DIVE_TABLE_SAMPLES - 2); f = (f - i)[:, None]
+        tu = self.table_u[template_index, i][:, None]; tu = tu + (self.table_u[template_index, i + 1][:, None] - tu) * f
+        tv = self.table_v[template_index, i][:, None]; tv = tv + (self.table_v[template_index, i + 1][:, None] - tv) * f
+        return origin + u_axis * tu + v_axis * tv
+
+dive_library = DivePathLibrary()
+
+# --- 陣型格位配置 ---
+# Occupancy bitmap over FORMATION_COLS x FORMATION_ROWS (slot = row * FORMATION_COLS + col).
+# Enemies claim a slot on spawn and release it in kill(), so free-slot queries never scan the enemy group.
+SUMMON_SLOT_POLICY = 'nearest' # 'first', 'spread' (emptiest column) or 'nearest' (column closest to the boss)
+class FormationGrid:
+    def __init__(self, cols=FORMATION_COLS, rows=FORMATION_ROWS):
+        self.cols = cols; self.rows = rows; self.full_mask = (1 << (cols * rows)) - 1; self.reset()
+    def reset(self): self.occupied = 0; self.column_occupied = [0] * self.cols; self.count = 0 # column_occupied[c] has one bit per row
+    def is_free(self, slot): return not (self.occupied >> slot) & 1
+    def claim(self, slot):
+        if slot is None or not 0 <= slot < self.cols * self.rows or not self.is_free(slot): return False
+        row, col = divmod(slot, self.cols); self.occupied |= 1 << slot; self.column_occupied[col] |= 1 << row; self.count += 1; return True
+    def release(self, slot):
+        if slot is None or self.is_free(slot): return
+        row, col = divmod(slot, self.cols); self.occupied &= ~(1 << slot); self.column_occupied[col] &= ~(1 << row); self.count -= 1
+    def next_free(self): # Lowest free slot via the lowest-set-bit trick
+        free = ~self.occupied & self.full_mask
+        return (free & -free).bit_length() - 1 if free else None
+    def _free_row_in_column(self, col):
+        free = ~self.column_occupied[col] & ((1 << self.rows) - 1)
+        return (free & -free).bit_length() - 1 if free else None
+    def claim_next(self, policy='first', near_x=None):
+        slot = None
+        if policy == 'spread': # Column with the most free rows, then its top free row
+            col = max(range(self.cols), key=lambda c: (self.rows - bin(self.column_occupied[c]).count('1'), -c))
+            row = self._free_row_in_column(col); slot = row * self.cols + col if row is not None else None
+        elif policy == 'nearest' and near_x is not None:
+            target_col = min(self.cols - 1, max(0, round((near_x - FORMATION_START_X) / FORMATION_SPACING_X)))
+            for col in sorted(range(self.cols), key=lambda c: abs(c - target_col)):
+                row = self._free_row_in_column(col)
+                if row is not None: slot = row * self.cols + col; break
+        else: slot = self.next_free()
+        return slot if self.claim(slot) else None
+    def slot_target(self, slot): # Jittered, clamped screen position of a slot (same formula the waves always used)
+        row, col = divmod(slot, self.cols)
+        pos_x = FORMATION_START_X + col * FORMATION_SPACING_X + random.randint(-5, 5); pos_y = FORMATION_START_Y + row * FORMATION_SPACING_Y + random.randint(-5, 5)
+        return (max(30, min(SCREEN_WIDTH - 30, pos_x)), max(30, min(SCREEN_HEIGHT - 150, pos_y)))
+
+formation_grid = FormationGrid()
+
+# --- 敵人狀態索引 ---
+# Secondary indexes over the enemies group, kept up to date by Enemy's group hooks and its `state` setter: one bucket
+# per state and one per behavior. Buckets are dicts used as insertion-ordered sets, so iterating them is reproducible.
+# Per-frame queries ("diving enemies touching the player", "shooters") only touch the sprites in the matching bucket.
+ENEMY_STATES = ('entering', 'formation', 'diving', 'returning'); ENEMY_STATE_CODES = {name: code for code, name in enumerate(ENEMY_STATES)}
+ENEMY_SHOOTERS = ('shooter_single', 'shooter_burst', 'shooter_spread', 'hybrid')
+ENEMY_DIVERS = ('diver_curve', 'diver_fast')
+ENEMY_ITEM_CARRIERS = ('item',)
+class EnemyIndex:
+    def __init__(self): self.by_state = {state: {} for state in ENEMY_STATES}; self.by_behavior = {}
+    def clear(self):
+        for bucket in self.by_state.values(): bucket.clear()
+        self.by_behavior.clear()
+    def __len__(self): return sum(len(bucket) for bucket in self.by_state.values())
+    def add(self, enemy): self.by_state[enemy.state][enemy] = None; self.by_behavior.setdefault(enemy.behavior, {})[enemy] = None
+    def remove(self, enemy): # Safe to call twice (kill() and remove_internal() can both fire)
+        self.by_state[enemy.state].pop(enemy, None); bucket = self.by_behavior.get(enemy.behavior)
+        if bucket: bucket.pop(enemy, None)
+    def moved(self, enemy, old_state, new_state): # From Enemy.state's setter; enemies outside the group are not indexed
+        bucket = self.by_state[old_state]
+        if enemy in bucket: del bucket[enemy]; self.by_state[new_state][enemy] = None
+    def in_state(self, state): return list(self.by_state[state]) # Copy: callers may kill or re-state what they iterate
+    def with_behavior(self, *behaviors): return [enemy for b in behaviors for enemy in self.by_behavior.get(b, ())]
+    def shooters(self): return self.with_behavior(*ENEMY_SHOOTERS)
+    def divers(self): return self.with_behavior(*ENEMY_DIVERS)
+    def item_carriers(self): return self.with_behavior(*ENEMY_ITEM_CARRIERS)
+    def diving_near(self, rect): return [enemy for enemy in self.by_state['diving'] if rect.colliderect(enemy.rect)] # Rect pre-test before any mask check
+    def counts(self): return {state: len(bucket) for state, bucket in self.by_state.items()}
+
+enemy_index = EnemyIndex()
+
+# --- 精靈原型 (共用圖像/遮罩) ---
+# Built on first use (see AssetManager): every Enemy/Boss/bullet of a given type points at the same
+# immutable image and mask, and the hit flash swaps to a precomputed alpha-dimmed variant.
+HIT_FLASH_ALPHA = 100
+class SpritePrototype:
+    def __init__(self, image, mask=None, label=""):
+        self.image = image
+        if mask is None:
+            try: mask = pygame.mask.from_surface(image)
+            except Exception as e: log.warning('prototype.mask', "警告:%s mask創建失敗:%s", label, e); mask = None
+        self.mask = mask; self.flash_image = image.copy()
+        if hasattr(self.flash_image, 'set_alpha'): self.flash_image.set_alpha(HIT_FLASH_ALPHA)
+
+class PrototypeRegistry:
+    def __init__(self): self.enemies = {}; self.bosses = {}; self.bullets = {}; self.powerups = {}
+    def enemy(self, enemy_id):
+        proto = self.enemies.get(enemy_id)
+        if proto is None:
+            image = asset_manager.image(enemy_id)
+            if not image: log.warning('prototype.image', "警告:Enemy %s 無圖", enemy_id); image = pygame.Surface([40, 30]); image.fill(RED); draw_text(image, enemy_id, 12, 20, 15, WHITE, align="center")
+            proto = self.enemies[enemy_id] = SpritePrototype(image, mask=asset_manager.mask(enemy_id, image.get_size(), image), label=f"Enemy {enemy_id}")
+        return proto
+    def boss(self, boss_id):
+        proto = self.bosses.get(boss_id)
+        if proto is None:
+            image = asset_manager.image(boss_id)
+            if not image: log.warning('prototype.image', "警告: Boss %s 無圖", boss_id); image = pygame.Surface([150, 100]); image.fill(PURPLE); draw_text(image, boss_id, 18, 75, 50, WHITE, align="center")
+            proto = self.bosses[boss_id] = SpritePrototype(image, mask=asset_manager.mask(boss_id, image.get_size(), image), label=f"Boss {boss_id}")
+        return proto
+    def bullet(self, color, width, height): # Plain rectangles: the mask is simply full
+        key = (tuple(color), width, height); proto = self.bullets.get(key)
+        if proto is None:
+            image = pygame.Surface([width, height]); image.fill(color)
+            proto = self.bullets[key] = SpritePrototype(image, mask=pygame.mask.Mask((width, height), fill=True))
+        return proto
+    def powerup(self, type_char): # The letter badge depends only on the type, so each is drawn once
+        image = self.powerups.get(type_char)
+        if image is None:
+            image = self.powerups[type_char] = pygame.Surface((30, 30), pygame.SRCALPHA)
+            pygame.draw.circle(image, YELLOW, (15, 15), 14); pygame.draw.circle(image, ORANGE, (15, 15), 14, 2)
+            if main_font_path:
+                 try: text_surf = text_cache.render(type_char, 20, BLACK); text_rect = text_surf.get_rect(center=(15, 15)); image.blit(text_surf, text_rect)
+                 except Exception as e: log.error('prototype.powerup', "繪製道具字母 '%s' 使用自訂字體錯誤: %s", type_char, e); self._render_powerup_fallback(image, type_char)
+            else: log.warning('prototype.powerup', "警告: PowerUp 字體無法設定 (main_font_path is None)"); pygame.draw.rect(image, RED, (5, 5, 20, 20)) # Fallback if no font at all
+        return image
+    def _render_powerup_fallback(self, image, type_char): # Fallback if custom font fails
+         try: font = get_font(None, 20); text_surf = font.render(type_char, True, BLACK); text_rect = text_surf.get_rect(center=(15,15)); image.blit(text_surf, text_rect)
+         except Exception as e: log.error('prototype.powerup', "備用字體繪製道具字母 '%s' 也失敗: %s", type_char, e); pygame.draw.rect(image, RED, (5, 5, 20, 20)) # Ultimate fallback
+    def build_all(self): # Bullets only: enemy and boss prototypes follow their images, which load per level
+        for color in (WHITE, CYAN, YELLOW, MAGENTA): self.bullet(color, 4, 12) # Player bullet colours by upgrade level
+        for color in (RED, ORANGE, CYAN, PURPLE): self.bullet(color, 6, 12)
+        self.bullet(MAGENTA, 8, 16) # Boss spread
+        log.info('prototype', "精靈原型建立完成: %d 子彈.", len(self.bullets))
+    def clear(self): self.enemies.clear(); self.bosses.clear(); self.bullets.clear(); self.powerups.clear()
+
+prototypes = PrototypeRegistry()
+
 # --- Global Game State Variables ---
 player = None; all_sprites = None; enemies = None; player_bullets = None; enemy_bullets = None; boss_group = None; powerups = None
 game_state = ""; current_level = 0; score = 0; click_times = []; level_transition_timer = 0; loop_count = 0; difficulty_multiplier = 1.0
+combat_stats = {'hits_taken': {}, 'powerups': {}} # Per game, for tools/batch_sim.py: lives lost by cause, powerups collected by type
+
+# --- 物件池 (子彈/道具) ---
+# Projectiles and pickups are recycled instead of re-allocated: kill() hands the sprite back
+# to its pool and acquire() re-initialises it through reset().
+POOL_MAX_SIZES = {'Bullet': 256, 'EnemyBullet': 512, 'PowerUp': 16}
+class SpritePool:
+    def __init__(self, sprite_cls, max_size):
+        self.sprite_cls = sprite_cls; self.max_size = max_size; self.free = []
+        self.hits = 0; self.misses = 0; self.released = 0; self.dropped = 0
+    def acquire(self, *args, **kwargs):
+        if self.free: sprite = self.free.pop(); sprite.in_pool = False; sprite.reset(*args, **kwargs); self.hits += 1; return sprite
+        self.misses += 1; return self.sprite_cls(*args, **kwargs)
+    def release(self, sprite):
+        if sprite.in_pool: return # Already returned (e.g. killed twice in one frame)
+        sprite.in_pool = True
+        if len(self.free) < self.max_size: self.free.append(sprite); self.released += 1
+        else: self.dropped += 1
+    def stats(self):
+        acquired = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'released': self.released, 'dropped': self.dropped, 'free': len(self.free), 'hit_rate': self.hits / acquired if acquired else 0.0}
+
+class PooledSprite(pygame.sprite.Sprite):
+    pool = None; in_pool = False
+    def kill(self):
+        super().kill()
+        if self.pool is not None: self.pool.release(self)
+
+def pool_stats(): return {cls.__name__: cls.pool.stats() for cls in (Bullet, EnemyBullet, PowerUp) if cls.pool}
 
 # --- Classes ---
 class Player(pygame.sprite.Sprite):
     def __init__(self):
-        super().__init__(); self.image_orig = assets.get('player') # Uses 'zg.png'
+        super().__init__(); self.image_orig = asset_manager.image('player') # Uses 'zg.png'
         if self.image_orig: self.image = self.image_orig.copy()
-        else: print("警告:Player無圖"); self.image_orig = pygame.Surface([50,60]); self.image_orig.fill(GREEN); self.image = self.image_orig.copy()
+        else: log.warning('player.image', "警告:Player無圖"); self.image_orig = pygame.Surface([50,60]); self.image_orig.fill(GREEN); self.image = self.image_orig.copy()
         self.rect = self.image.get_rect()
         try: self.mask = pygame.mask.from_surface(self.image)
-        except Exception as e: print(f"警告:Player mask創建失敗:{e}"); self.mask = None
+        except Exception as e: log.warning('player.mask', "警告:Player mask創建失敗:%s", e); self.mask = None
         self.rect.centerx = SCREEN_WIDTH // 2; self.rect.bottom = SCREEN_HEIGHT - 10; self.lives = PLAYER_INITIAL_LIVES
         self.skill_charges = PLAYER_INITIAL_SKILL_CHARGES # MODIFIED: Renamed from pomeranian_charges
         self.score_for_next_life = PLAYER_SCORE_PER_LIFE
         self.current_score_progress = 0; self.shoot_delay = PLAYER_INITIAL_SHOOT_DELAY
-        self.last_shot_time = pygame.time.get_ticks(); self.hidden = False; self.hide_timer = pygame.time.get_ticks()
+        self.last_shot_time = game_clock.get_ticks(); self.hidden = False; self.hide_timer = game_clock.get_ticks()
         self.bullet_level_n = 0; self.bullet_level_w = 0
         self.max_bullet_level_n = 3; self.max_bullet_level_w = 5
 
     def update(self, dt):
-        now = pygame.time.get_ticks()
+        now = game_clock.get_ticks()
         if self.hidden:
             if now - self.hide_timer > PLAYER_INVINCIBILITY_DURATION: self.hidden = False; self.image.set_alpha(255) if hasattr(self.image, 'set_alpha') else None
-            elif hasattr(self.image, 'set_alpha'): self.image.set_alpha(255 if (now // 100) % 2 == 0 else 100)
+            elif hasattr(self.image, 'set_alpha'): self.image.set_alpha(255 if not quality.hit_flash or (now // 100) % 2 == 0 else 100)
         else:
             if hasattr(self.image, 'set_alpha'): self.image.set_alpha(255) # Ensure full alpha when not hidden
-            mouse_x, _ = pygame.mouse.get_pos(); self.rect.centerx = mouse_x
+            mouse_x, _ = input_source.get_mouse_pos(); self.rect.centerx = mouse_x
             if self.rect.left < 0: self.rect.left = 0
             if self.rect.right > SCREEN_WIDTH: self.rect.right = SCREEN_WIDTH
             self.auto_shoot()
 
     def auto_shoot(self):
-        global all_sprites, player_bullets; now = pygame.time.get_ticks()
+        global all_sprites, player_bullets; now = game_clock.get_ticks()
         if now - self.last_shot_time > self.shoot_delay:
             self.last_shot_time = now; num_bullets = self.bullet_level_n + 1; spread_pixels = self.bullet_level_w * 7
             start_x = self.rect.centerx - spread_pixels * (num_bullets - 1) / 2.0 if num_bullets > 1 else self.rect.centerx
@@ -242,119 +920,134 @@ class Player(pygame.sprite.Sprite):
             for i in range(num_bullets):
                 bullet_x = max(2, min(SCREEN_WIDTH - 2, start_x + i * spread_pixels))
                 bullet_y = self.rect.top - 15
-                bullet = Bullet(bullet_x, bullet_y, c=bullet_color)
-                if all_sprites is not None: all_sprites.add(bullet)
-                if player_bullets is not None: player_bullets.add(bullet)
-            if sounds.get('player_shoot'): sounds['player_shoot'].play()
+                spawn_player_bullet(bullet_x, bullet_y, bullet_color)
+            audio.play('player_shoot')
 
     def hide(self):
-        if not self.hidden: self.hidden = True; self.hide_timer = pygame.time.get_ticks(); print("玩家受傷, 暫時無敵!"); sounds['player_hit'].play() if sounds.get('player_hit') else None # MODIFIED: Player hit message
-    def add_life(self): self.lives += 1; print(f"生命增加! 生命: {self.lives}")
-    def add_skill_charge(self): self.skill_charges += 1; print(f"技能充能增加! 充能: {self.skill_charges}") # MODIFIED
+        if not self.hidden: self.hidden = True; self.hide_timer = game_clock.get_ticks(); log.info('player.hit', "玩家受傷, 暫時無敵!"); audio.play('player_hit') # MODIFIED: Player hit message
+    def add_life(self): self.lives += 1; log.info('player.life', "生命增加! 生命: %d", self.lives)
+    def add_skill_charge(self): self.skill_charges += 1; log.info('player.skill', "技能充能增加! 充能: %d", self.skill_charges) # MODIFIED
     def check_score_for_life(self, gained_score):
         self.current_score_progress += gained_score
         if self.current_score_progress >= self.score_for_next_life:
             lives_to_add = self.current_score_progress // self.score_for_next_life; self.current_score_progress %= self.score_for_next_life
             for _ in range(lives_to_add): self.add_life()
     def apply_powerup(self, type_char):
-        global score; print(f"玩家拾取強化道具: {type_char}"); sounds['powerup'].play() if sounds.get('powerup') else None
+        global score; log.info('player.powerup', "玩家拾取強化道具: %s", type_char); audio.play('powerup'); combat_stats['powerups'][type_char] = combat_stats['powerups'].get(type_char, 0) + 1
         if type_char == 'H': self.add_life()
         elif type_char == 'P': self.add_skill_charge() # MODIFIED: 'P' now adds skill charge
-        elif type_char == 'S': self.shoot_delay = max(80, self.shoot_delay - 40); print(f"射速提升! 新延遲: {self.shoot_delay}")
+        elif type_char == 'S': self.shoot_delay = max(80, self.shoot_delay - 40); log.info('player.powerup', "射速提升! 新延遲: %d", self.shoot_delay)
         elif type_char == 'N':
-             if self.bullet_level_n < self.max_bullet_level_n: self.bullet_level_n += 1; print(f"子彈數量等級提升至 {self.bullet_level_n+1}!")
-             else: print("子彈數量已達上限!"); score += 50 if score is not None else 0
+             if self.bullet_level_n < self.max_bullet_level_n: self.bullet_level_n += 1; log.info('player.powerup', "子彈數量等級提升至 %d!", self.bullet_level_n + 1)
+             else: log.info('player.powerup', "子彈數量已達上限!"); score += 50 if score is not None else 0
         elif type_char == 'W':
-             if self.bullet_level_w < self.max_bullet_level_w: self.bullet_level_w += 1; print(f"子彈擴散等級提升至 {self.bullet_level_w}!")
-             else: print("子彈擴散已達上限!"); score += 50 if score is not None else 0
+             if self.bullet_level_w < self.max_bullet_level_w: self.bullet_level_w += 1; log.info('player.powerup', "子彈擴散等級提升至 %d!", self.bullet_level_w)
+             else: log.info('player.powerup', "子彈擴散已達上限!"); score += 50 if score is not None else 0
 
-class Bullet(pygame.sprite.Sprite): # Player bullet
+class Bullet(PooledSprite): # Player bullet
     def __init__(self,x,y,s=-10 * FPS,c=WHITE,w=4,h=12): # s is speed in pixels per second
-        super().__init__(); self.image=pygame.Surface([w,h]); self.image.fill(c)
+        super().__init__(); self.reset(x, y, s, c, w, h)
+    def reset(self,x,y,s=-10 * FPS,c=WHITE,w=4,h=12):
+        proto = prototypes.bullet(c, w, h); self.image = proto.image; self.mask = proto.mask
         self.rect=self.image.get_rect(centerx=x, top=y)
         self.speedy_per_sec = s
     def update(self, dt): # dt is delta time in seconds
         self.rect.y += self.speedy_per_sec * dt;
         self.kill() if self.rect.bottom < 0 else None
 
-class EnemyBullet(pygame.sprite.Sprite):
-    def __init__(self, x, y, s=5 * FPS, speed_x=0 * FPS, color=RED, width=6, height=12):
-        super().__init__(); self.image = pygame.Surface([width, height]); self.image.fill(color)
-        self.rect = self.image.get_rect(centerx=x, top=y); self.speedy_per_sec = s; self.speedx_per_sec = speed_x
-        try: self.mask = pygame.mask.from_surface(self.image)
-        except Exception as e: self.mask = None; print(f"警告: EnemyBullet mask創建失敗: {e}")
+class EnemyBullet(PooledSprite):
+    def __init__(self, x, y, s=5 * FPS, speed_x=0 * FPS, color=RED, width=6, height=12, source=None):
+        super().__init__(); self.reset(x, y, s, speed_x, color, width, height, source)
+    def reset(self, x, y, s=5 * FPS, speed_x=0 * FPS, color=RED, width=6, height=12, source=None): # source: behavior of the shooter ('boss' for the boss)
+        proto = prototypes.bullet(color, width, height); self.image = proto.image; self.mask = proto.mask
+        self.rect = self.image.get_rect(centerx=x, top=y); self.speedy_per_sec = s; self.speedx_per_sec = speed_x; self.source = source
     def update(self, dt):
         self.rect.x += self.speedx_per_sec * dt; self.rect.y += self.speedy_per_sec * dt
         if self.rect.top > SCREEN_HEIGHT or self.rect.bottom < 0 or self.rect.left > SCREEN_WIDTH or self.rect.right < 0: self.kill()
 
 class SkillAnimation(pygame.sprite.Sprite): # MODIFIED: Renamed from Pomeranian to SkillAnimation
     def __init__(self, position_key="bottomleft"):
-        super().__init__(); self.frames = []; f1 = assets.get('skill_anim1'); f2 = assets.get('skill_anim2') # Using renamed keys
+        super().__init__(); self.frames = []; f1 = asset_manager.image('skill_anim1'); f2 = asset_manager.image('skill_anim2') # Using renamed keys
         if f1: self.frames.append(f1)
         if f2: self.frames.append(f2)
-        if not self.frames: f_icon = assets.get('skill_icon'); self.frames.append(f_icon) if f_icon else self.frames.append(pygame.Surface([30,30]).fill(ORANGE)) # Fallback
+        if not self.frames: f_icon = asset_manager.image('skill_icon'); self.frames.append(f_icon) if f_icon else self.frames.append(pygame.Surface([30,30]).fill(ORANGE)) # Fallback
         self.current_frame = 0; self.image = self.frames[self.current_frame]; self.rect = self.image.get_rect()
         setattr(self.rect, position_key, (10, SCREEN_HEIGHT - 10) if position_key=="bottomleft" else (SCREEN_WIDTH - 10, SCREEN_HEIGHT - 10))
-        self.spawn_time = pygame.time.get_ticks(); self.lifetime = 600; self.anim_delay = 150; self.last_anim_update = self.spawn_time
+        self.spawn_time = game_clock.get_ticks(); self.lifetime = 600; self.anim_delay = 150; self.last_anim_update = self.spawn_time
     def update(self, dt):
-        now = pygame.time.get_ticks()
+        now = game_clock.get_ticks()
         if now - self.spawn_time > self.lifetime: self.kill(); return
         if len(self.frames) > 1 and (now - self.last_anim_update > self.anim_delay):
             self.last_anim_update = now; self.current_frame = (self.current_frame + 1) % len(self.frames)
             center = self.rect.center; self.image = self.frames[self.current_frame]; self.rect = self.image.get_rect(center=center)
 
 class Enemy(pygame.sprite.Sprite): # (No changes needed in Enemy class logic for "套皮" if filenames are same)
-    def __init__(self, enemy_id_str, formation_pos_tuple):
-        super().__init__(); self.enemy_id = enemy_id_str; self.formation_pos = formation_pos_tuple
-        self.image_orig = assets.get(enemy_id_str)
-        if not self.image_orig: print(f"警告:Enemy {enemy_id_str} 無圖"); self.image_orig = pygame.Surface([40, 30]); self.image_orig.fill(RED); draw_text(self.image_orig, enemy_id_str, 12, 20, 15, WHITE, align="center")
-        self.image = self.image_orig.copy(); self.rect = self.image.get_rect()
-        try: self.mask = pygame.mask.from_surface(self.image)
-        except Exception as e: print(f"警告:Enemy {enemy_id_str} mask創建失敗:{e}"); self.mask = None
+    def __init__(self, enemy_id_str, formation_pos_tuple, slot=None):
+        super().__init__(); self.enemy_id = enemy_id_str; self.formation_pos = formation_pos_tuple; self.slot = slot # Claimed formation_grid slot
+        self.index = None # Row in enemy_swarm while in the enemies group (NumPy enemy engine only)
+        self.prototype = prototypes.enemy(enemy_id_str); self.image_orig = self.prototype.image
+        self.image = self.image_orig; self.rect = self.image.get_rect(); self.mask = self.prototype.mask
         self.rect.centerx = random.randint(self.rect.width // 2, SCREEN_WIDTH - self.rect.width // 2); self.rect.bottom = random.randint(-150, -self.rect.height - 20)
         data = enemy_data.get(enemy_id_str, {'hp': 1, 'score': 10, 'behavior': 'normal_slow'}); base_hp = data['hp']; base_score_val = data['score']
         self.hp = max(1, round(base_hp * difficulty_multiplier)); self.max_hp = self.hp; self.score_value = round(base_score_val * (1.0 + loop_count * 0.2))
-        self.behavior = data['behavior']; self.state = 'entering'
+        self.behavior = data['behavior']; self._state = 'entering' # Not indexed yet: enemy_index picks it up when it joins the enemies group
         self.enter_speed_pps = random.uniform(2.5 * FPS, 4.5 * FPS); self.dive_speed_pps = random.uniform(4 * FPS, 8 * FPS); self.return_speed_pps = 3 * FPS
-        self.dive_path = None; self.dive_path_index = 0; self.last_action_time = pygame.time.get_ticks() + random.randint(800, 2000)
+        self.dive = None; self.last_action_time = game_clock.get_ticks() + random.randint(800, 2000)
         self.action_delay = random.randint(3000, 6000); self.is_hit = False; self.hit_timer = 0
+    @property
+    def state(self): return self._state
+    @state.setter
+    def state(self, new_state):
+        old_state = self._state; self._state = new_state
+        if new_state != old_state: enemy_index.moved(self, old_state, new_state)
+    def add_internal(self, group):
+        super().add_internal(group)
+        if group is enemies:
+            enemy_index.add(self)
+            if enemy_swarm is not None: enemy_swarm.add(self)
+    def remove_internal(self, group):
+        super().remove_internal(group)
+        if group is enemies:
+            enemy_index.remove(self)
+            if self.index is not None: enemy_swarm.remove(self)
+    def update_flash(self, now):
+        hit_duration = 150
+        if now - self.hit_timer < hit_duration: self.image = self.prototype.flash_image if quality.hit_flash and (now // 50) % 2 else self.image_orig
+        else: self.is_hit = False; self.image = self.image_orig
     def update(self, dt): # Logic remains the same
-        now = pygame.time.get_ticks()
-        if self.is_hit:
-            hit_duration = 150
-            if now - self.hit_timer < hit_duration: self.image.set_alpha(255 if (now // 50) % 2 == 0 else 100) if hasattr(self.image, 'set_alpha') else None
-            else: self.is_hit = False; self.image = self.image_orig.copy(); self.image.set_alpha(255) if hasattr(self.image, 'set_alpha') else None
-        if self.state == 'entering':
+        if self.index is not None: # Moved and steered by enemy_swarm.step()
+            if self.is_hit: self.update_flash(game_clock.get_ticks())
+            return
+        now = game_clock.get_ticks()
+        if self.is_hit: self.update_flash(now)
+        state = self._state # Writes below go through the indexed setter
+        if state == 'entering':
             target_x, target_y = self.formation_pos; dx = target_x - self.rect.centerx; dy = target_y - self.rect.centery; distance = math.hypot(dx, dy)
             move_dist_this_frame = self.enter_speed_pps * dt
             if distance < move_dist_this_frame * 1.1: self.rect.center = self.formation_pos; self.state = 'formation'; self.last_action_time = now + random.randint(500, 2000)
             else: move_x = (dx / distance) * move_dist_this_frame; move_y = (dy / distance) * move_dist_this_frame; self.rect.x += move_x; self.rect.y += move_y
-        elif self.state == 'formation':
+        elif state == 'formation':
             idle_offset_x = math.sin(now / 700.0 + self.formation_pos[0] / 60.0) * 3; idle_offset_y = math.sin(now / 800.0 + self.formation_pos[1] / 70.0) * 2
             self.rect.centerx = self.formation_pos[0] + idle_offset_x; self.rect.centery = self.formation_pos[1] + idle_offset_y
             if now - self.last_action_time > self.action_delay: self.decide_action()
             else:
                 can_shoot = self.behavior in ['shooter_single', 'shooter_burst', 'shooter_spread', 'hybrid']
                 if can_shoot and random.random() < 0.002 : self.shoot(); self.last_action_time = now + random.randint(1500, 2500) # Reduced random shoot chance a bit
-        elif self.state == 'diving':
-            if self.dive_path and self.dive_path_index < len(self.dive_path):
-                target_pos = self.dive_path[self.dive_path_index]; dx = target_pos[0] - self.rect.centerx; dy = target_pos[1] - self.rect.centery; distance = math.hypot(dx, dy)
-                move_dist_this_frame = self.dive_speed_pps * dt
-                if distance < move_dist_this_frame * 1.1:
-                    self.dive_path_index += 1
-                    if self.behavior in ['shooter_single', 'shooter_burst', 'shooter_spread', 'hybrid'] and random.random() < 0.35: self.shoot()
-                else: move_x = (dx / distance) * move_dist_this_frame; move_y = (dy / distance) * move_dist_this_frame; self.rect.x += move_x; self.rect.y += move_y
-                if self.dive_path_index >= len(self.dive_path): self.state = 'returning'; self.dive_path = None
-            else: self.state = 'returning'; self.dive_path = None
-            if self.rect.top > SCREEN_HEIGHT + 50 : self.state = 'returning'; self.dive_path = None # Ensure it returns if goes too far off screen
-        elif self.state == 'returning':
+        elif state == 'diving':
+            if self.dive:
+                crossed_marks = self.dive.advance(dt); self.rect.center = self.dive.position()
+                if crossed_marks and self.behavior in ['shooter_single', 'shooter_burst', 'shooter_spread', 'hybrid'] and random.random() < 0.35: self.shoot()
+                if self.dive.done: self.state = 'returning'; self.dive = None
+            else: self.state = 'returning'
+            if self.rect.top > SCREEN_HEIGHT + 50 : self.state = 'returning'; self.dive = None # Ensure it returns if goes too far off screen
+        elif state == 'returning':
             target_x, target_y = self.formation_pos; dx = target_x - self.rect.centerx; dy = target_y - self.rect.centery; distance = math.hypot(dx, dy)
             move_dist_this_frame = self.return_speed_pps * dt
             if distance < move_dist_this_frame * 1.1: self.rect.center = self.formation_pos; self.state = 'formation'; self.last_action_time = now + random.randint(1000, 3000)
             else: move_x = (dx / distance) * move_dist_this_frame; move_y = (dy / distance) * move_dist_this_frame; self.rect.x += move_x; self.rect.y += move_y
-            if self.rect.bottom < -20 : self.rect.center = self.formation_pos; self.state = 'formation'; print(f"{self.enemy_id} Flew too high returning, reset.") # Failsafe
+            if self.rect.bottom < -20 : self.rect.center = self.formation_pos; self.state = 'formation'; log.debug('enemy.failsafe', "%s Flew too high returning, reset.", self.enemy_id) # Failsafe
     def decide_action(self): # Logic remains the same
-        self.last_action_time = pygame.time.get_ticks(); self.action_delay = random.randint(3000, 6000) # Reset action delay
+        self.last_action_time = game_clock.get_ticks(); self.action_delay = random.randint(3000, 6000) # Reset action delay
         can_shoot = self.behavior in ['shooter_single', 'shooter_burst', 'shooter_spread', 'hybrid']; can_dive = self.behavior != 'item'; action_roll = random.random(); dive_chance = 0.30
         if self.behavior == 'diver_curve': dive_chance = 0.50
         elif self.behavior == 'diver_fast': dive_chance = 0.55
@@ -366,380 +1059,1056 @@ class Enemy(pygame.sprite.Sprite): # (No changes needed in Enemy class logic for
         elif can_shoot and random.random() < shoot_chance_after_dive_check: self.shoot()
     def start_dive(self, target_sprite): # Logic remains the same
         if self.state == 'formation' and target_sprite and target_sprite.alive():
-            self.state = 'diving'; self.dive_path = self.generate_dive_path(target_sprite); self.dive_path_index = 0
+            self.state = 'diving'; self.dive = self.generate_dive_path(target_sprite)
             if self.behavior == 'diver_fast': self.dive_speed_pps = random.uniform(7 * FPS, 10 * FPS)
             elif self.behavior == 'diver_curve': self.dive_speed_pps = random.uniform(5 * FPS, 7 * FPS)
             else: self.dive_speed_pps = random.uniform(4 * FPS, 6 * FPS)
-            if not self.dive_path: self.state = 'formation'; return
-            if sounds.get('enemy_dive'): sounds['enemy_dive'].play()
-    def generate_dive_path(self, target_sprite): # Logic remains the same
-        path = []; start_pos = self.rect.center
+            if not self.dive: self.state = 'formation'; return
+            self.dive.set_speed(self.dive_speed_pps)
+            audio.play('enemy_dive')
+    def generate_dive_path(self, target_sprite): # Affine instance of a precomputed template (see DivePathLibrary)
         player_center = target_sprite.rect.center if target_sprite and target_sprite.alive() else (SCREEN_WIDTH/2, SCREEN_HEIGHT * 0.8)
         path_type = random.choice(['swoop', 'loop', 'straight_ish', 'cross_screen'])
         if self.behavior == 'diver_curve': path_type = random.choice(['swoop', 'loop', 'cross_screen'])
         elif self.behavior == 'diver_fast': path_type = random.choice(['straight_ish', 'swoop'])
-        if path_type == 'swoop':
-            p1_y = start_pos[1] + 150 + random.randint(-30, 30); p1_x_direction = 1 if start_pos[0] < SCREEN_WIDTH/2 else -1; p1_x = start_pos[0] + random.randint(-80, 80) * p1_x_direction; p1 = (max(50, min(SCREEN_WIDTH - 50, p1_x)), p1_y)
-            p2_y = player_center[1] + random.randint(-40, 80); p2_x = player_center[0] + random.randint(-100, 100); p2 = (max(50, min(SCREEN_WIDTH - 50, p2_x)), max(p1_y + 50, p2_y))
-            p3_y = SCREEN_HEIGHT * 0.6 + random.randint(-50, 50); p3_x = start_pos[0] + random.randint(-100, 100); p3 = (max(50, min(SCREEN_WIDTH - 50, p3_x)), min(max(start_pos[1] + 50, p1_y + 20), p2_y - 50, p3_y)); path.extend([p1, p2, p3])
-        elif path_type == 'loop':
-            p1_y = start_pos[1] + 100 + random.randint(0, 50); p1_x_direction = 1 if start_pos[0] < SCREEN_WIDTH/2 else -1; p1_x = start_pos[0] + random.randint(50, 100) * p1_x_direction; p1 = (max(30, min(SCREEN_WIDTH - 30, p1_x)), p1_y)
-            p2_y = p1_y + random.randint(80, 150); p2_x = start_pos[0]; p2 = (max(30, min(SCREEN_WIDTH - 30, p2_x)), p2_y)
-            p3_y = p1_y; p3_x_direction = -1 if start_pos[0] < SCREEN_WIDTH/2 else 1; p3_x = start_pos[0] + random.randint(50, 100) * p3_x_direction; p3 = (max(30, min(SCREEN_WIDTH - 30, p3_x)), p3_y); path.extend([p1, p2, p3])
-        elif path_type == 'cross_screen':
-            p1_y = start_pos[1] + 200 + random.randint(-20, 20); p1_x = start_pos[0] + random.randint(-50, 50); p1 = (max(50, min(SCREEN_WIDTH - 50, p1_x)), max(start_pos[1] + 100, p1_y))
-            p2_y = p1_y + random.randint(-10, 10); p2_x = SCREEN_WIDTH - start_pos[0] + random.randint(-80, 80); p2 = (max(50, min(SCREEN_WIDTH - 50, p2_x)), p2_y); path.extend([p1, p2])
-        else: p1_y = player_center[1] + random.randint(50, 150); p1_x = player_center[0] + random.randint(-80, 80); p1 = (max(50, min(SCREEN_WIDTH - 50, p1_x)), p1_y); path.append(p1)
-        return path
+        return dive_library.create(path_type, self.rect.center, player_center)
     def shoot(self): # Logic remains the same
         global all_sprites, enemy_bullets;
-        if self.state not in ['formation', 'diving']: return; sounds['enemy_shoot'].play() if sounds.get('enemy_shoot') else None
-        if self.behavior == 'shooter_single' or (self.behavior == 'hybrid' and random.random() < 0.7): bullet = EnemyBullet(self.rect.centerx, self.rect.bottom + 5, color=RED); all_sprites.add(bullet); enemy_bullets.add(bullet)
+        if self.state not in ['formation', 'diving']: return; audio.play('enemy_shoot')
+        if self.behavior == 'shooter_single' or (self.behavior == 'hybrid' and random.random() < 0.7): spawn_enemy_bullet(self.rect.centerx, self.rect.bottom + 5, color=RED, source=self.behavior)
         elif self.behavior == 'shooter_burst':
-            for i in range(3): bullet = EnemyBullet(self.rect.centerx + random.randint(-3, 3), self.rect.bottom + 5 + i*10, s=7*FPS, color=ORANGE); all_sprites.add(bullet); enemy_bullets.add(bullet)
+            for i in range(3): spawn_enemy_bullet(self.rect.centerx + random.randint(-3, 3), self.rect.bottom + 5 + i*10, s=7*FPS, color=ORANGE, source=self.behavior)
             self.action_delay += 500
         elif self.behavior == 'shooter_spread':
             num_bullets = 3; spread_angle = math.pi / 5; bullet_speed_pps = 6 * FPS
             for i in range(num_bullets):
                 angle = -spread_angle/2 + (i*spread_angle/(num_bullets-1)) if num_bullets>1 else 0
                 b_speed_x_pps = bullet_speed_pps * math.sin(angle); b_speed_y_pps = bullet_speed_pps * math.cos(angle)
-                bullet = EnemyBullet(self.rect.centerx, self.rect.bottom+5, s=b_speed_y_pps, speed_x=b_speed_x_pps, color=CYAN); all_sprites.add(bullet); enemy_bullets.add(bullet)
+                spawn_enemy_bullet(self.rect.centerx, self.rect.bottom+5, s=b_speed_y_pps, speed_x=b_speed_x_pps, color=CYAN, source=self.behavior)
             self.action_delay += 800
         elif self.behavior == 'hybrid' and random.random() < 0.4:
             num_bullets = 3; spread_angle = math.pi / 6; bullet_speed_pps = 5 * FPS
             for i in range(num_bullets):
                 angle = -spread_angle/2 + (i*spread_angle/(num_bullets-1)) if num_bullets>1 else 0
                 b_speed_x_pps = bullet_speed_pps * math.sin(angle); b_speed_y_pps = bullet_speed_pps * math.cos(angle)
-                bullet = EnemyBullet(self.rect.centerx, self.rect.bottom+5, s=b_speed_y_pps, speed_x=b_speed_x_pps, color=PURPLE); all_sprites.add(bullet); enemy_bullets.add(bullet)
+                spawn_enemy_bullet(self.rect.centerx, self.rect.bottom+5, s=b_speed_y_pps, speed_x=b_speed_x_pps, color=PURPLE, source=self.behavior)
             self.action_delay += 600
-        self.last_action_time = pygame.time.get_ticks()
+        self.last_action_time = game_clock.get_ticks()
     def take_damage(self, amount): # Logic remains the same
         if self.is_hit: return
-        self.hp -= amount; self.is_hit = True; self.hit_timer = pygame.time.get_ticks()
+        self.hp -= amount; self.is_hit = True; self.hit_timer = game_clock.get_ticks()
         if self.hp <= 0: self.kill_enemy()
     def kill_enemy(self): # Logic remains the same
         global score, player;
-        if not self.alive(): return; sounds['enemy_explosion'].play() if sounds.get('enemy_explosion') else None
+        if not self.alive(): return; audio.play('enemy_explosion')
         if player and score is not None: score += self.score_value; player.check_score_for_life(self.score_value)
         if self.enemy_id == 'p09': spawn_powerup(self.rect.center) # p09 is the item dropper
         self.kill()
+    def kill(self):
+        super().kill() # Sprite.kill() skips remove_internal() on the sprite side
+        enemy_index.remove(self)
+        if self.index is not None: enemy_swarm.remove(self)
+        if self.slot is not None: formation_grid.release(self.slot); self.slot = None
 
 class Boss(pygame.sprite.Sprite): # (No changes needed in Boss class logic for "套皮" if filenames are same)
     def __init__(self, boss_id_str):
-        super().__init__(); self.boss_id = boss_id_str; self.image_orig = assets.get(boss_id_str)
-        if not self.image_orig: print(f"警告: Boss {boss_id_str} 無圖"); self.image_orig=pygame.Surface([150,100]); self.image_orig.fill(PURPLE); draw_text(self.image_orig,boss_id_str,18,75,50,WHITE,align="center")
-        self.image = self.image_orig.copy(); self.rect = self.image.get_rect()
-        try: self.mask = pygame.mask.from_surface(self.image)
-        except Exception as e: print(f"警告: Boss {boss_id_str} mask創建失敗:{e}"); self.mask = None
+        super().__init__(); self.boss_id = boss_id_str; self.prototype = prototypes.boss(boss_id_str); self.image_orig = self.prototype.image
+        self.image = self.image_orig; self.rect = self.image.get_rect(); self.mask = self.prototype.mask
         self.rect.centerx=SCREEN_WIDTH/2; self.rect.top=-self.rect.height-20; boss_level_num = int(boss_id_str[-2:]); hp_map={ 10: 30, 20: 60, 30: 90, 40: 120, 50: 150 }; base_hp = hp_map.get(boss_level_num, 50)
         self.max_hp = max(10, round(base_hp * difficulty_multiplier)); self.hp = self.max_hp; self.score_value = round(1000 * (boss_level_num // 10) * (1.0 + loop_count * 0.2)); self.state='entering'
         self.speedx_pps=3.5 * FPS; self.speedy_pps=1.5 * FPS; self.shot_delay=1800; self.entry_target_y=80; self.first_attack_delay=800
-        self.can_attack=False; self.last_shot_time=pygame.time.get_ticks(); self.num_bullets_spread = 9; self.is_hit = False; self.hit_timer = 0
-        self.summon_timer = pygame.time.get_ticks(); self.summon_delay = 10000
+        self.can_attack=False; self.last_shot_time=game_clock.get_ticks(); self.num_bullets_spread = 9; self.is_hit = False; self.hit_timer = 0
+        self.summon_timer = game_clock.get_ticks(); self.summon_delay = 10000; self.summon_queue = deque() # Minion ids still to create
     def update(self, dt): # Logic remains the same
-        now=pygame.time.get_ticks()
+        now=game_clock.get_ticks()
         if self.is_hit:
             hit_duration = 100
-            if now - self.hit_timer < hit_duration: self.image.set_alpha(255 if (now // 40) % 2 == 0 else 100) if hasattr(self.image, 'set_alpha') else None
-            else: self.is_hit = False; self.image = self.image_orig.copy(); self.image.set_alpha(255) if hasattr(self.image, 'set_alpha') else None
+            if now - self.hit_timer < hit_duration: self.image = self.prototype.flash_image if quality.hit_flash and (now // 40) % 2 else self.image_orig
+            else: self.is_hit = False; self.image = self.image_orig
         if self.state=='entering':
             self.rect.y += self.speedy_pps * dt
             if self.rect.top >= self.entry_target_y:
-                self.rect.top = self.entry_target_y; print(f"Boss {self.boss_id} reached active pos. State: active"); self.state = 'active'; self.speedy_pps = 0
+                self.rect.top = self.entry_target_y; log.info('boss.state', "Boss %s reached active pos. State: active", self.boss_id); self.state = 'active'; self.speedy_pps = 0
                 self.can_attack = True; self.last_shot_time = now + self.first_attack_delay; self.summon_timer = now
-                sounds['boss_spawn'].play() if sounds.get('boss_spawn') else None
+                audio.play('boss_spawn')
         elif self.state=='active':
             self.rect.x += self.speedx_pps * dt
             if self.rect.left < 10 or self.rect.right > SCREEN_WIDTH - 10: self.speedx_pps *= -1
             if self.can_attack and (now - self.last_shot_time > self.shot_delay): self.shoot(); self.last_shot_time = now
             boss_level_num = int(self.boss_id[-2:])
             if boss_level_num >= 20 and now - self.summon_timer > self.summon_delay: self.summon_minions(boss_level_num); self.summon_timer = now
+            for _ in range(min(SUMMONS_PER_STEP, len(self.summon_queue))): self.summon_one(self.summon_queue.popleft())
     def shoot(self): # Logic remains the same
-        global all_sprites, enemy_bullets; sounds['enemy_shoot'].play() if sounds.get('enemy_shoot') else None
+        global all_sprites, enemy_bullets; audio.play('enemy_shoot')
         spread_angle = math.pi * (2/3); bullet_speed_pps = 5.5 * FPS; center_angle = math.pi / 2
         start_angle = center_angle - spread_angle / 2 if self.num_bullets_spread > 1 else center_angle
         for i in range(self.num_bullets_spread):
             angle = start_angle + (i * spread_angle / (self.num_bullets_spread - 1)) if self.num_bullets_spread > 1 else start_angle
             b_speed_x_pps = bullet_speed_pps * math.cos(angle); b_speed_y_pps = bullet_speed_pps * math.sin(angle)
             if abs(b_speed_y_pps) <= bullet_speed_pps * 0.1 : b_speed_y_pps = bullet_speed_pps * 0.8 ; b_speed_x_pps = 0 # Prevent horizontal-only bullets, ensure some downward movement
-            bullet = EnemyBullet(self.rect.centerx, self.rect.centery + self.rect.height / 3, s=b_speed_y_pps, speed_x=b_speed_x_pps, color=MAGENTA, width=8, height=16)
-            all_sprites.add(bullet); enemy_bullets.add(bullet)
+            spawn_enemy_bullet(self.rect.centerx, self.rect.centery + self.rect.height / 3, s=b_speed_y_pps, speed_x=b_speed_x_pps, color=MAGENTA, width=8, height=16, source='boss')
     def summon_minions(self, boss_level_num): # Logic remains the same
-        global all_sprites, enemies; print(f"Boss {self.boss_id} summons minions!")
-        summon_list = {20: {'p01': 4, 'p02': 4, 'p03': 2}, 30: {'p02': 4, 'p04': 4, 'p05': 2}, 40: {'p05': 4, 'p06': 4, 'p07': 2}, 50: {'p07': 6, 'p08': 6}}.get(boss_level_num, {})
-        if not summon_list: print("  No summon list defined."); return
-        max_enemies = FORMATION_COLS * FORMATION_ROWS
-        for enemy_id, count in summon_list.items():
-            for _ in range(count):
-                if len(enemies) >= max_enemies * 0.8: print("  Too many enemies, skipping summon."); continue # Limit total enemies
-                current_count = len(enemies); row = current_count // FORMATION_COLS; col = current_count % FORMATION_COLS; row = min(row, FORMATION_ROWS - 1); col = min(col, FORMATION_COLS - 1) # Simple placement
-                pos_x = FORMATION_START_X + col * FORMATION_SPACING_X + random.randint(-5, 5); pos_y = FORMATION_START_Y + row * FORMATION_SPACING_Y + random.randint(-5, 5)
-                formation_target = (max(30, min(SCREEN_WIDTH - 30, pos_x)), max(30, min(SCREEN_HEIGHT - 150, pos_y)))
-                # Check if position is occupied and find new one if so (simple horizontal scan)
-                is_occ = any(e.formation_pos == formation_target for e in enemies if hasattr(e, 'formation_pos'))
-                if is_occ:
-                    for _attempt in range(FORMATION_COLS): # Try to find an empty slot in the current row or nearby
-                        temp_col = (_attempt + col) % FORMATION_COLS
-                        new_pos_x = FORMATION_START_X + temp_col * FORMATION_SPACING_X; new_pos_y = FORMATION_START_Y + row * FORMATION_SPACING_Y
-                        candidate_target = (max(30, min(SCREEN_WIDTH - 30, new_pos_x)), max(30, min(SCREEN_HEIGHT - 150, new_pos_y)))
-                        if not any(e.formation_pos == candidate_target for e in enemies if hasattr(e, 'formation_pos')): formation_target = candidate_target; break
-                minion = Enemy(enemy_id, formation_target)
-                minion.rect.centerx = self.rect.centerx + random.randint(-self.rect.width//3, self.rect.width//3); minion.rect.bottom = self.rect.bottom + random.randint(10, 30); minion.state = 'entering'
-                all_sprites.add(minion); enemies.add(minion)
+        global all_sprites, enemies; log.info('boss.summon', "Boss %s summons minions!", self.boss_id)
+        summon_list = BOSS_SUMMON_LISTS.get(boss_level_num, {})
+        if not summon_list: log.debug('boss.summon_skip', "  No summon list defined."); return
+        self.summon_queue.extend(enemy_id for enemy_id, count in summon_list.items() for _ in range(count)) # Created SUMMONS_PER_STEP per update
+    def summon_one(self, enemy_id):
+        if len(enemies) >= FORMATION_COLS * FORMATION_ROWS * 0.8: log.debug('boss.summon_skip', "  Too many enemies, skipping summon."); return # Limit total enemies
+        slot = formation_grid.claim_next(SUMMON_SLOT_POLICY, near_x=self.rect.centerx)
+        if slot is None: log.debug('boss.summon_skip', "  No free formation slot, skipping summon."); return
+        formation_target = formation_grid.slot_target(slot)
+        minion = Enemy(enemy_id, formation_target, slot)
+        minion.rect.centerx = self.rect.centerx + random.randint(-self.rect.width//3, self.rect.width//3); minion.rect.bottom = self.rect.bottom + random.randint(10, 30); minion.state = 'entering'
+        all_sprites.add(minion); enemies.add(minion)
     def take_damage(self, amount): # Logic remains the same
-        if self.state == 'entering': print(f"Boss {self.boss_id} in 'entering' state, no damage taken."); return
+        if self.state == 'entering': log.debug('boss.entering_hit', "Boss %s in 'entering' state, no damage taken.", self.boss_id); return
         if self.is_hit: return
-        self.hp -= amount; self.is_hit = True; self.hit_timer = pygame.time.get_ticks()
+        self.hp -= amount; self.is_hit = True; self.hit_timer = game_clock.get_ticks()
         if self.hp <= 0: self.kill_boss()
     def kill_boss(self): # Logic remains the same
         global score, player, enemies, enemy_bullets;
-        if not self.alive(): return; print(f"Boss {self.boss_id} defeated!"); sounds['boss_defeat'].play() if sounds.get('boss_defeat') else None
+        if not self.alive(): return; log.info('boss.defeated', "Boss %s defeated!", self.boss_id); audio.play('boss_defeat')
         if player and score is not None: score += self.score_value; player.check_score_for_life(self.score_value);
         for enemy in enemies: enemy.kill() # Clear remaining minions
         for bullet in enemy_bullets: bullet.kill() # Clear boss bullets
+        if projectile_engine: projectile_engine.enemy.clear()
         self.kill()
 
-class PowerUp(pygame.sprite.Sprite): # (No changes needed in PowerUp class logic for "套皮" if filenames are same)
-    def __init__(self, center_pos):
-        super().__init__(); self.type = random.choice(['S', 'N', 'W', 'H', 'P']); self.image = pygame.Surface((30, 30), pygame.SRCALPHA)
-        pygame.draw.circle(self.image, YELLOW, (15, 15), 14); pygame.draw.circle(self.image, ORANGE, (15, 15), 14, 2)
-        if main_font_path:
-             try: font = pygame.font.Font(main_font_path, 20); text_surf = font.render(self.type, True, BLACK); text_rect = text_surf.get_rect(center=(15, 15)); self.image.blit(text_surf, text_rect)
-             except Exception as e: print(f"繪製道具字母 '{self.type}' 使用自訂字體錯誤: {e}"); self.render_fallback_text()
-        else: print("警告: PowerUp 字體無法設定 (main_font_path is None)"); pygame.draw.rect(self.image, RED, (5, 5, 20, 20)) # Fallback if no font at all
+class PowerUp(PooledSprite): # (No changes needed in PowerUp class logic for "套皮" if filenames are same)
+    def __init__(self, center_pos): super().__init__(); self.reset(center_pos)
+    def reset(self, center_pos):
+        self.type = random.choice(['S', 'N', 'W', 'H', 'P']); self.image = prototypes.powerup(self.type)
         self.rect = self.image.get_rect(center=center_pos); self.speedy_pps = 2.5 * FPS
-    def render_fallback_text(self): # Fallback if custom font fails
-         try: font = pygame.font.Font(None, 20); text_surf = font.render(self.type, True, BLACK); text_rect = text_surf.get_rect(center=(15,15)); self.image.blit(text_surf, text_rect)
-         except Exception as e: print(f"備用字體繪製道具字母 '{self.type}' 也失敗: {e}"); pygame.draw.rect(self.image, RED, (5, 5, 20, 20)) # Ultimate fallback
     def update(self, dt): self.rect.y += self.speedy_pps * dt; self.kill() if self.rect.top > SCREEN_HEIGHT else None
 
+Bullet.pool = SpritePool(Bullet, POOL_MAX_SIZES['Bullet']); EnemyBullet.pool = SpritePool(EnemyBullet, POOL_MAX_SIZES['EnemyBullet']); PowerUp.pool = SpritePool(PowerUp, POOL_MAX_SIZES['PowerUp'])
+
+# --- NumPy 子彈引擎 ---
+# All bullets of one side live in contiguous arrays: motion and off-screen culling are one
+# vectorised step, collisions are a batched bounding-box test (targets x bullets) before the
+# per-pair mask check, and drawing is a single blits()/fblits() call.
+class ProjectileBuffer:
+    FIELDS = ('x', 'y', 'vx', 'vy', 'w', 'h', 'kind') # x/y are the top-left corner, kind indexes self.prototypes / self.sources
+    def __init__(self, capacity=256):
+        self.n = 0; self.prototypes = []; self.sources = []; self.prototype_index = {}; self.hit_sources = []; self._allocate(capacity)
+    def _allocate(self, capacity):
+        old_n = self.n; old = {f: getattr(self, f, None) for f in self.FIELDS}
+        for f in self.FIELDS:
+            arr = np.zeros(capacity, dtype=np.int16 if f == 'kind' else np.float32)
+            if old[f] is not None: arr[:old_n] = old[f][:old_n]
+            setattr(self, f, arr)
+        self.capacity = capacity
+    def __len__(self): return self.n
+    def spawn(self, left, top, vx, vy, proto, source=None):
+        kind = self.prototype_index.get((id(proto), source))
+        if kind is None: kind = self.prototype_index[(id(proto), source)] = len(self.prototypes); self.prototypes.append(proto); self.sources.append(source)
+        if self.n == self.capacity: self._allocate(self.capacity * 2)
+        i = self.n; w, h = proto.image.get_size()
+        self.x[i] = left; self.y[i] = top; self.vx[i] = vx; self.vy[i] = vy; self.w[i] = w; self.h[i] = h; self.kind[i] = kind; self.n += 1
+    def clear(self): self.n = 0
+    def _keep(self, keep):
+        idx = np.flatnonzero(keep); m = len(idx)
+        for f in self.FIELDS: arr = getattr(self, f); arr[:m] = arr[idx]
+        self.n = m
+    def step(self, dt):
+        n = self.n
+        if not n: return
+        x = self.x[:n]; y = self.y[:n]; x += self.vx[:n] * dt; y += self.vy[:n] * dt
+        keep = (y <= SCREEN_HEIGHT) & (y + self.h[:n] >= 0) & (x <= SCREEN_WIDTH) & (x + self.w[:n] >= 0)
+        if not keep.all(): self._keep(keep)
+    def collide_sprites(self, sprites, use_masks=True): # Hit bullets are removed; returns {sprite: bullets_hit}, their sources in self.hit_sources
+        n = self.n; hits = {}; self.hit_sources = []
+        if not n or not sprites: return hits
+        rects = np.array([(sp.rect.left, sp.rect.top, sp.rect.right, sp.rect.bottom) for sp in sprites], dtype=np.float32)
+        x = self.x[:n]; y = self.y[:n]; right = x + self.w[:n]; bottom = y + self.h[:n]
+        overlap = (x < rects[:, 2:3]) & (right > rects[:, 0:1]) & (y < rects[:, 3:4]) & (bottom > rects[:, 1:2])
+        if not overlap.any(): return hits
+        consumed = np.zeros(n, dtype=bool)
+        for t, b in zip(*np.nonzero(overlap)): # Row-major, so targets are resolved in group order like groupcollide
+            if consumed[b]: continue
+            sprite = sprites[t]; mask = getattr(sprite, 'mask', None) if use_masks else None
+            if mask is not None:
+                proto = self.prototypes[self.kind[b]]
+                if proto.mask is None or not mask.overlap(proto.mask, (int(x[b]) - sprite.rect.left, int(y[b]) - sprite.rect.top)): continue
+            consumed[b] = True; hits[sprite] = hits.get(sprite, 0) + 1; self.hit_sources.append(self.sources[self.kind[b]])
+        if hits: self._keep(~consumed)
+        return hits
+    def draw(self, surf, want_rects=False, lag=0.0): # lag: seconds to draw behind the simulated position (render interpolation)
+        n = self.n
+        if not n: return []
+        x = self.x[:n]; y = self.y[:n]
+        if lag: x = x - self.vx[:n] * lag; y = y - self.vy[:n] * lag
+        images = [p.image for p in self.prototypes]; xs = x.astype(np.int32).tolist(); ys = y.astype(np.int32).tolist()
+        sequence = list(zip(map(images.__getitem__, self.kind[:n].tolist()), zip(xs, ys)))
+        blit_many = getattr(surf, 'fblits', None) # pygame-ce only
+        if blit_many: blit_many(sequence)
+        else: surf.blits(sequence, doreturn=False)
+        if not want_rects: return []
+        return [pygame.Rect(px, py, pw, ph) for px, py, pw, ph in zip(xs, ys, self.w[:n].astype(np.int32).tolist(), self.h[:n].astype(np.int32).tolist())]
+
+class ProjectileEngine:
+    def __init__(self): self.player = ProjectileBuffer(); self.enemy = ProjectileBuffer()
+    def step(self, dt): self.player.step(dt); self.enemy.step(dt)
+    def clear(self): self.player.clear(); self.enemy.clear()
+    def draw(self, surf, want_rects=False, lag=0.0): return self.player.draw(surf, want_rects, lag) + self.enemy.draw(surf, want_rects, lag)
+
+projectile_engine = None # Created in main() when NUMPY_PROJECTILES is enabled
+
+# --- NumPy 敵人引擎 ---
+# Positions, formation targets, state and behavior codes, action timers and dive paths of every enemy live in one
+# struct of arrays: idle bob, steering, dive evaluation (DivePathLibrary.evaluate_batch), state changes and the
+# per-frame shoot/dive rolls are batched passes, and each Enemy is a thin view whose rect is synced after the step.
+# A row is added when a sprite joins the enemies group and swap-removed when it leaves. The few enemies a roll picks
+# still run their own shoot()/start_dive(). Rolls come from a NumPy generator seeded from `random`, so runs are
+# reproducible with this engine but not identical to the per-sprite one (replays record which engine was used).
+ENTERING, FORMATION, DIVING, RETURNING = range(len(ENEMY_STATES)) # Codes of ENEMY_STATES (see the enemy state index)
+ENEMY_BEHAVIORS = ('normal_slow', 'normal_fast', 'shooter_single', 'diver_curve', 'shooter_burst', 'diver_fast', 'shooter_spread', 'hybrid', 'item')
+ENEMY_DIVE_CHANCES = {'diver_curve': 0.50, 'diver_fast': 0.55, 'hybrid': 0.45, 'normal_fast': 0.35, 'shooter_single': 0.25} # Others 0.30, as in decide_action
+
+class EnemySwarm:
+    FIELDS = ('x', 'y', 'cx', 'cy', 'fx', 'fy', 'half_h', 'state', 'behavior', 'enter_speed', 'return_speed', 'last_action', 'action_delay',
+              'path', 't', 'rate', 'next_mark', 'origin', 'u_axis', 'v_axis') # x/y: centre, cx/cy: the rect centre last synced; path..v_axis: the dive (see DiveTrajectory)
+    DTYPES = {'cx': np.int32, 'cy': np.int32, 'state': np.int8, 'behavior': np.int8, 'path': np.int8, 'next_mark': np.int8, 'last_action': np.int64, 'action_delay': np.int64} if np else {}
+    PAIRS = ('origin', 'u_axis', 'v_axis')
+    def __init__(self, capacity=64):
+        self.n = 0; self.sprites = []; self.rng = np.random.default_rng(random.getrandbits(64)); self._allocate(capacity)
+        self.can_shoot = np.array([b in ENEMY_SHOOTERS for b in ENEMY_BEHAVIORS]); self.can_dive = np.array([b != 'item' for b in ENEMY_BEHAVIORS])
+        self.dive_chance = np.array([ENEMY_DIVE_CHANCES.get(b, 0.30) for b in ENEMY_BEHAVIORS]); self.behavior_codes = {b: code for code, b in enumerate(ENEMY_BEHAVIORS)}
+        self.path_index = {name: i for i, name in enumerate(dive_library.names)}; marks = [dive_library.templates[name].marks for name in dive_library.names]
+        self.mark_table = np.full((len(marks), max(map(len, marks)) + 1), np.inf) # inf after the last mark, so next_mark can index one past it
+        for i, row in enumerate(marks): self.mark_table[i, :len(row)] = row
+    def _allocate(self, capacity):
+        old_n = self.n; old = {f: getattr(self, f, None) for f in self.FIELDS}
+        for f in self.FIELDS:
+            arr = np.zeros((capacity, 2) if f in self.PAIRS else capacity, dtype=self.DTYPES.get(f, np.float64))
+            if old[f] is not None: arr[:old_n] = old[f][:old_n]
+            setattr(self, f, arr)
+        self.capacity = capacity
+    def __len__(self): return self.n
+    def add(self, sprite): # Called when the sprite joins the enemies group; its attributes seed the row
+        if self.n == self.capacity: self._allocate(self.capacity * 2)
+        i = self.n; self.n += 1; self.sprites.append(sprite); sprite.index = i
+        self.x[i], self.y[i] = self.cx[i], self.cy[i] = sprite.rect.center; self.fx[i], self.fy[i] = sprite.formation_pos; self.half_h[i] = sprite.rect.height / 2
+        self.behavior[i] = self.behavior_codes.get(sprite.behavior, 0); self.enter_speed[i] = sprite.enter_speed_pps; self.return_speed[i] = sprite.return_speed_pps
+        self.last_action[i] = sprite.last_action_time; self.action_delay[i] = sprite.action_delay
+        state = ENEMY_STATE_CODES[sprite.state]
+        if state == DIVING and not self._set_dive(i, sprite): state = RETURNING; sprite.state = 'returning' # As the sprite engine does without a path
+        self.state[i] = state
+    def remove(self, sprite): # Called when it leaves the group; timers go back onto the sprite, the last row fills the hole
+        i = sprite.index; sprite.last_action_time = int(self.last_action[i]); sprite.action_delay = int(self.action_delay[i]); sprite.index = None
+        last = self.n - 1
+        if i != last:
+            for f in self.FIELDS: arr = getattr(self, f); arr[i] = arr[last]
+            moved = self.sprites[last]; self.sprites[i] = moved; moved.index = i
+        self.sprites.pop(); self.n = last
+    def _set_dive(self, i, sprite): # Copies the DiveTrajectory start_dive() made into row i
+        dive = sprite.dive; sprite.dive = None
+        if dive is None: return False
+        self.path[i] = self.path_index[dive.template.name]; self.t[i] = dive.t; self.rate[i] = dive.rate; self.next_mark[i] = dive.next_mark
+        self.origin[i] = (dive.ox, dive.oy); self.u_axis[i] = (dive.ux, dive.uy); self.v_axis[i] = (dive.vx, dive.vy); return True
+    def _set_state(self, rows, code):
+        self.state[rows] = code; name = ENEMY_STATES[code]
+        for i in rows.tolist(): self.sprites[i].state = name
+    def _steer(self, rows, speed, dt, now, settle_ms): # Entering/returning: straight at the formation slot; returns the rows that arrived
+        x = self.x; y = self.y; dx = self.fx[rows] - x[rows]; dy = self.fy[rows] - y[rows]; distance = np.hypot(dx, dy); move = speed[rows] * dt
+        arrived = distance < move * 1.1; scale = np.where(arrived, 0.0, move / np.where(arrived, 1.0, distance))
+        x[rows] += dx * scale; y[rows] += dy * scale; done = rows[arrived]
+        if len(done): x[done] = self.fx[done]; y[done] = self.fy[done]; self._set_state(done, FORMATION); self.last_action[done] = now + self.rng.integers(*settle_ms, len(done), endpoint=True)
+        return arrived
+    def _shoot(self, i, then=None): # The sprite's own shoot(); it adjusts the timers, which are copied back
+        sprite = self.sprites[i]; sprite.action_delay = int(self.action_delay[i]); sprite.last_action_time = int(self.last_action[i]); sprite.shoot()
+        self.action_delay[i] = sprite.action_delay; self.last_action[i] = sprite.last_action_time if then is None else then
+    def step(self, dt, now):
+        n = self.n
+        if not n: return
+        x = self.x; y = self.y; rng = self.rng; state = self.state[:n] # Each enemy runs the branch of the state it started the step in
+        order = np.argsort(state, kind='stable'); ends = np.cumsum(np.bincount(state, minlength=len(ENEMY_STATES))).tolist() # Rows grouped by state, in row order
+        entering = order[:ends[ENTERING]]; idle = order[ends[ENTERING]:ends[FORMATION]]; diving = order[ends[FORMATION]:ends[DIVING]]; returning = order[ends[DIVING]:ends[RETURNING]]
+        if len(entering): self._steer(entering, self.enter_speed, dt, now, (500, 2000))
+        if len(returning):
+            arrived = self._steer(returning, self.return_speed, dt, now, (1000, 3000))
+            escaped = returning[~arrived & (y[returning] + self.half_h[returning] < -20)] # Failsafe: flew off the top
+            if len(escaped): x[escaped] = self.fx[escaped]; y[escaped] = self.fy[escaped]; self._set_state(escaped, FORMATION)
+        if len(idle):
+            fx = self.fx[idle]; fy = self.fy[idle]; x[idle] = fx + np.sin(now / 700.0 + fx / 60.0) * 3; y[idle] = fy + np.sin(now / 800.0 + fy / 70.0) * 2
+        mark_shots = (); finished = None
+        if len(diving):
+            t = np.minimum(1.0, self.t[diving] + self.rate[diving] * dt); self.t[diving] = t; path = self.path[diving]; next_mark = self.next_mark[diving].astype(np.int32); crossed = np.zeros(len(diving), dtype=bool)
+            while True:
+                passed = self.mark_table[path, next_mark] <= t
+                if not passed.any(): break
+                next_mark += passed; crossed |= passed
+            self.next_mark[diving] = next_mark
+            position = dive_library.evaluate_batch(path, t, self.origin[diving], self.u_axis[diving], self.v_axis[diving]); x[diving] = position[:, 0]; y[diving] = position[:, 1]
+            shooters = diving[crossed & self.can_shoot[self.behavior[diving]]]
+            if len(shooters): mark_shots = shooters[rng.random(len(shooters)) < 0.35].tolist()
+            finished = diving[(t >= 1.0) | (y[diving] - self.half_h[diving] > SCREEN_HEIGHT + 50)]
+        cx = np.rint(x[:n]).astype(np.int32); cy = np.rint(y[:n]).astype(np.int32); moved = np.flatnonzero((cx != self.cx[:n]) | (cy != self.cy[:n])) # The idle bob only shifts a few rects per frame
+        if len(moved):
+            self.cx[moved] = cx[moved]; self.cy[moved] = cy[moved]; sprites = self.sprites
+            for i, px, py in zip(moved.tolist(), cx[moved].tolist(), cy[moved].tolist()): sprites[i].rect.center = (px, py)
+        for i in mark_shots: self._shoot(i) # Fired from the new position, before a finished dive turns into 'returning'
+        if finished is not None and len(finished): self._set_state(finished, RETURNING)
+        if not len(idle): return
+        due = now - self.last_action[idle] > self.action_delay[idle]; deciding = idle[due]; waiting = idle[~due & self.can_shoot[self.behavior[idle]]]
+        if len(waiting): # Random potshots between decisions
+            for i in waiting[rng.random(len(waiting)) < 0.002].tolist(): self._shoot(i, then=now + int(rng.integers(1500, 2500, endpoint=True)))
+        if not len(deciding): return
+        self.last_action[deciding] = now; self.action_delay[deciding] = rng.integers(3000, 6000, len(deciding), endpoint=True) # decide_action, batched
+        behavior = self.behavior[deciding]; target_ok = bool(player and player.alive())
+        dives = self.can_dive[behavior] & (rng.random(len(deciding)) < self.dive_chance[behavior]) & target_ok
+        shots = ~dives & self.can_shoot[behavior] & (rng.random(len(deciding)) < 0.6)
+        for i in deciding[dives].tolist():
+            sprite = self.sprites[i]; sprite.start_dive(player)
+            if sprite.state == 'diving' and self._set_dive(i, sprite): self.state[i] = DIVING
+            else: sprite.state = 'formation'
+        for i in deciding[shots].tolist(): self._shoot(i)
+
+enemy_swarm = None # Created in setup_game() when NUMPY_ENEMIES is enabled
+
+# --- 空間雜湊碰撞粗篩 ---
+# Uniform grid sized to the formation spacing, rebuilt each frame. Only sprites sharing a cell
+# reach collide_mask; pair counters show how much the broadphase prunes versus testing all pairs.
+def collide_mask_or_rect(left, right):
+    if getattr(left, 'mask', None) is not None and getattr(right, 'mask', None) is not None: return pygame.sprite.collide_mask(left, right)
+    return left.rect.colliderect(right.rect)
+
+class SpatialHash:
+    def __init__(self, cell_w=FORMATION_SPACING_X, cell_h=FORMATION_SPACING_Y):
+        self.cell_w = cell_w; self.cell_h = cell_h; self.cells = {}; self.count = 0
+        self.candidate_pairs = 0; self.naive_pairs = 0; self.total_candidate_pairs = 0; self.total_naive_pairs = 0
+    def _cell_range(self, rect):
+        return range(rect.left // self.cell_w, (rect.right - 1) // self.cell_w + 1), range(rect.top // self.cell_h, (rect.bottom - 1) // self.cell_h + 1)
+    def rebuild(self, *sprite_lists): # Insertion order is kept so ties resolve like pygame's group order
+        self.cells.clear(); self.count = 0; self.candidate_pairs = 0; self.naive_pairs = 0
+        for sprites in sprite_lists:
+            for sprite in sprites:
+                cols, rows = self._cell_range(sprite.rect); entry = (self.count, sprite); self.count += 1
+                for cx in cols:
+                    for cy in rows: self.cells.setdefault((cx, cy), []).append(entry)
+    def query(self, rect, count_naive=False): # Sprites whose cells overlap rect, in insertion order
+        if count_naive: self.naive_pairs += self.count; self.total_naive_pairs += self.count
+        cols, rows = self._cell_range(rect); found = {}
+        for cx in cols:
+            for cy in rows:
+                for index, sprite in self.cells.get((cx, cy), ()): found[index] = sprite
+        self.candidate_pairs += len(found); self.total_candidate_pairs += len(found)
+        return [found[i] for i in sorted(found)] if len(found) > 1 else list(found.values())
+    def collide_group(self, group, collided=collide_mask_or_rect, dokill=True): # Like groupcollide(grid sprites, group): {target: [hit sprites]}
+        hits = {}; moving = group.sprites(); self.naive_pairs += self.count * len(moving); self.total_naive_pairs += self.count * len(moving)
+        for sprite in moving:
+            for target in self.query(sprite.rect):
+                if target.alive() and collided(target, sprite): hits.setdefault(target, []).append(sprite); break
+        if dokill:
+            for hit_list in hits.values():
+                for sprite in hit_list: sprite.kill()
+        return hits
+    def stats(self):
+        return {'candidate_pairs': self.candidate_pairs, 'naive_pairs': self.naive_pairs, 'total_candidate_pairs': self.total_candidate_pairs,
+                'total_naive_pairs': self.total_naive_pairs, 'pruned_ratio': 1.0 - self.total_candidate_pairs / self.total_naive_pairs if self.total_naive_pairs else 0.0}
+
+target_grid = SpatialHash() # enemies + boss, queried by player bullets (diving enemies vs. the player go through enemy_index)
+bullet_grid = SpatialHash() # enemy bullets, queried by the player
+
 # --- Game Functions ---
-def spawn_wave(level_num_to_spawn): # (No changes needed in spawn_wave logic for "套皮" if filenames are same)
+def spawn_wave(level_num_to_spawn, prebuilt=None): # prebuilt: WaveBuilder.take() result, so only the swap happens here
     global difficulty_multiplier, loop_count, MAX_LEVELS, all_sprites, enemies, enemy_bullets, powerups, boss_group
-    print(f"開始生成關卡 {level_num_to_spawn + loop_count * MAX_LEVELS} (基礎 {level_num_to_spawn}, 循環 {loop_count}, 難度倍率 {difficulty_multiplier:.2f})...")
-    if level_num_to_spawn < 1 or level_num_to_spawn > MAX_LEVELS: print(f"錯誤:無效基礎關卡{level_num_to_spawn}"); return
+    log.info('spawn.wave', "開始生成關卡 %d (基礎 %d, 循環 %d, 難度倍率 %.2f)...", level_num_to_spawn + loop_count * MAX_LEVELS, level_num_to_spawn, loop_count, difficulty_multiplier)
+    if level_num_to_spawn < 1 or level_num_to_spawn > MAX_LEVELS: log.error('spawn.wave', "錯誤:無效基礎關卡%s", level_num_to_spawn); return
+    asset_manager.enter_level(level_num_to_spawn) # Usually already prefetched during the transition
     # Clear previous wave entities except player and skill animations
     for sprite in all_sprites:
         if not isinstance(sprite, Player) and not isinstance(sprite, SkillAnimation): # MODIFIED
             sprite.kill()
     enemies.empty(); enemy_bullets.empty(); powerups.empty(); boss_group.empty()
-    level_index = level_num_to_spawn - 1; data = level_data[level_index]; enemy_count = 0
+    if projectile_engine: projectile_engine.clear()
+    formation_grid.reset() # Every enemy was just cleared, including any emptied without kill()
+    level_index = level_num_to_spawn - 1; data = level_data[level_index]
+    if prebuilt is not None:
+        built_enemies, boss_obj = prebuilt
+        for enemy in built_enemies: formation_grid.claim(enemy.slot); all_sprites.add(enemy); enemies.add(enemy)
+        if boss_obj: log.info('spawn.boss', "  生成 Boss: %s", boss_obj.boss_id); all_sprites.add(boss_obj); boss_group.add(boss_obj)
+        return
     for enemy_id, count_num in data['enemies'].items():
         for _ in range(count_num):
-            row = enemy_count // FORMATION_COLS; col = enemy_count % FORMATION_COLS
-            # Try to find an empty spot if default is full (simple overflow handling)
-            if row >= FORMATION_ROWS:
-                found_pos = False
-                for r_try in range(max(0, FORMATION_ROWS - 2), FORMATION_ROWS): # Try last few rows
-                    for c_try in range(FORMATION_COLS):
-                        temp_pos_check = (FORMATION_START_X + c_try * FORMATION_SPACING_X, FORMATION_START_Y + r_try * FORMATION_SPACING_Y)
-                        is_occupied = any(e.formation_pos == temp_pos_check for e in enemies if hasattr(e, 'formation_pos'))
-                        if not is_occupied: row, col = r_try, c_try; found_pos = True; break
-                    if found_pos: break
-                if not found_pos: continue # Skip spawning if no space found after trying
-            pos_x = FORMATION_START_X + col * FORMATION_SPACING_X + random.randint(-5, 5); pos_y = FORMATION_START_Y + row * FORMATION_SPACING_Y + random.randint(-5, 5)
-            formation_target = (max(30, min(SCREEN_WIDTH - 30, pos_x)), max(30, min(SCREEN_HEIGHT - 150, pos_y)))
-            enemy = Enemy(enemy_id, formation_target); all_sprites.add(enemy); enemies.add(enemy); enemy_count += 1
+            slot = formation_grid.claim_next() # Fills row by row; skips spawning once the formation is full
+            if slot is None: continue
+            enemy = Enemy(enemy_id, formation_grid.slot_target(slot), slot); all_sprites.add(enemy); enemies.add(enemy)
     boss_id = data.get('boss')
-    if boss_id and not boss_group.sprite: print(f"  生成 Boss: {boss_id}"); boss_obj = Boss(boss_id); all_sprites.add(boss_obj); boss_group.add(boss_obj); print(f"  Boss {boss_id} 已加入 all_sprites 和 boss_group. boss_group.sprite: {boss_group.sprite}")
+    if boss_id and not boss_group.sprite: log.info('spawn.boss', "  生成 Boss: %s", boss_id); boss_obj = Boss(boss_id); all_sprites.add(boss_obj); boss_group.add(boss_obj); log.debug('spawn.boss_group', "  Boss %s 已加入 all_sprites 和 boss_group. boss_group.sprite: %s", boss_id, boss_obj)
 
-def spawn_powerup(center_pos): powerup = PowerUp(center_pos); all_sprites.add(powerup); powerups.add(powerup)
+# --- 分段生成 ---
+# Instead of creating the next wave in the frame LEVEL_TRANSITION ends, WaveBuilder creates it during the 2 s
+# transition, a few enemies per frame within SPAWN_BUDGET_MS, and spawn_wave() then only adds it to the groups.
+# Nothing draws from `random` during the transition, so the wave is the same one a synchronous spawn would
+# create (replays stay valid); timers set at construction are shifted to the tick the wave goes live.
+SPAWN_BUDGET_MS = get_option_value('--spawn-budget-ms', 'WEBGAME_SPAWN_BUDGET_MS', 1.0, cast=float) # 0: build the whole wave when it starts
+SUMMONS_PER_STEP = 2 # Boss minions created per simulation step; a tick count, not a time budget, since it runs mid-fight
 
-# --- Main Game Function (Async) ---
-async def main():
-    global screen, clock, player, all_sprites, enemies, player_bullets, enemy_bullets, boss_group, powerups
-    global game_state, current_level, score, click_times, level_transition_timer, loop_count, difficulty_multiplier
-    global is_fullscreen, fullscreen_button_rect, background_sound, cover_sound, main_font_path # MODIFIED: Added cover_sound
+class WaveBuilder:
+    def __init__(self):
+        self.level = None; self.queue = deque(); self.enemies = []; self.boss = None # enemies: [(Enemy, tick built)], boss: (Boss, tick built)
+        self.stats = {'prebuilt_waves': 0, 'finished_on_take': 0, 'build_ms': 0.0, 'max_step_ms': 0.0}
+    def start(self, level): # When LEVEL_TRANSITION begins; the cleared wave has already released every formation slot
+        self.cancel(); self.level = level; data = level_data[level - 1]; formation_grid.reset()
+        self.queue.extend(enemy_id for enemy_id, count in data['enemies'].items() for _ in range(count))
+        if data.get('boss'): self.queue.append(None) # None: the boss, built last as in spawn_wave
+    def _build_one(self):
+        enemy_id = self.queue.popleft(); now = game_clock.get_ticks()
+        if enemy_id is None: self.boss = (Boss(level_data[self.level - 1]['boss']), now); return
+        slot = formation_grid.claim_next()
+        if slot is not None: self.enemies.append((Enemy(enemy_id, formation_grid.slot_target(slot), slot), now))
+    def step(self, budget_ms=SPAWN_BUDGET_MS): # At least one item per call so the wave always finishes
+        if not self.queue or budget_ms <= 0: return
+        start = time.perf_counter(); deadline = start + budget_ms / 1000.0
+        while self.queue:
+            self._build_one()
+            if time.perf_counter() >= deadline: break
+        elapsed = (time.perf_counter() - start) * 1000.0; self.stats['build_ms'] += elapsed; self.stats['max_step_ms'] = max(self.stats['max_step_ms'], elapsed)
+    def take(self, level): # -> (enemies, boss) for spawn_wave, or None when nothing was started for this level
+        if self.level != level: return None
+        if self.queue: self.stats['finished_on_take'] += 1
+        while self.queue: self._build_one()
+        now = game_clock.get_ticks(); built = []
+        for enemy, built_at in self.enemies: enemy.last_action_time += now - built_at; built.append(enemy)
+        boss = None
+        if self.boss: boss, built_at = self.boss; boss.last_shot_time += now - built_at; boss.summon_timer += now - built_at
+        self.stats['prebuilt_waves'] += 1; self.level = None; self.enemies = []; self.boss = None
+        return built, boss
+    def cancel(self): self.level = None; self.queue.clear(); self.enemies = []; self.boss = None # Never added to a group, so nothing to kill
+
+wave_builder = WaveBuilder()
+
+def spawn_powerup(center_pos): powerup = PowerUp.pool.acquire(center_pos); all_sprites.add(powerup); powerups.add(powerup)
+def spawn_player_bullet(x, y, color):
+    if projectile_engine: projectile_engine.player.spawn(int(x) - 2, y, 0, -10 * FPS, prototypes.bullet(color, 4, 12)); return
+    bullet = Bullet.pool.acquire(x, y, c=color)
+    if all_sprites is not None: all_sprites.add(bullet)
+    if player_bullets is not None: player_bullets.add(bullet)
+def spawn_enemy_bullet(x, y, **kwargs):
+    if projectile_engine:
+        width = kwargs.get('width', 6); height = kwargs.get('height', 12); proto = prototypes.bullet(kwargs.get('color', RED), width, height)
+        projectile_engine.enemy.spawn(int(x) - width // 2, y, kwargs.get('speed_x', 0), kwargs.get('s', 5 * FPS), proto, kwargs.get('source')); return
+    bullet = EnemyBullet.pool.acquire(x, y, **kwargs); all_sprites.add(bullet); enemy_bullets.add(bullet)
+
+# --- 固定步長模擬 ---
+# update and collision always run with the same dt (SIM_DT) from a real-time accumulator; rendering draws
+# between the last two simulation states. A slow frame runs several steps before the next render (skipping
+# up to MAX_FRAME_SKIP render frames) so gameplay speed stays tied to wall time, not to the frame rate.
+SIM_HZ = get_option_value('--sim-hz', 'WEBGAME_SIM_HZ', FPS); SIM_DT = 1.0 / SIM_HZ
+MAX_FRAME_SKIP = 4 # Beyond 1 + MAX_FRAME_SKIP steps per rendered frame the backlog is dropped and the game slows down
+MAX_FRAME_TIME = 0.25 # s; longer stalls (tab in background, window drag) are treated as this long
+INTERP_MAX_JUMP = 64 # px per step; larger moves (respawns, formation resets) snap instead of sliding
+
+# --- 遊戲時鐘與輸入來源 ---
+# Game logic reads time and the mouse through game_clock / input_source instead of pygame directly,
+# so a headless run can swap in a fixed-step simulation clock and scripted input.
+class RealClock:
+    def get_ticks(self): return pygame.time.get_ticks()
+    def time(self): return time.time()
+
+class SimulationClock:
+    def __init__(self, step_ms=SIM_DT * 1000.0): self.step_ms = step_ms; self.ms = 0.0
+    def advance(self, ms=None): self.ms += self.step_ms if ms is None else ms
+    def get_ticks(self): return int(self.ms)
+    def time(self): return self.ms / 1000.0
+
+class PygameInput:
+    def begin_tick(self, tick): pass
+    def get_mouse_pos(self): return pygame.mouse.get_pos()
+    def get_events(self): return pygame.event.get()
+    def tick_events(self): return []
+
+def autopilot_mouse_x(tick): # Follow the lowest enemy (or the boss) so headless waves actually get cleared
+    targets = enemies.sprites() if enemies else []
+    if not targets and boss_group and boss_group.sprite: targets = [boss_group.sprite]
+    if not targets: return SCREEN_WIDTH / 2
+    return max(targets, key=lambda sp: sp.rect.bottom).rect.centerx
+
+class ScriptedInput:
+    def __init__(self, mouse_x=autopilot_mouse_x, clicks=None):
+        self.mouse_x = mouse_x; self.clicks = clicks or {}; self.pending = []; self.tick = 0 # clicks: {tick: [pos, ...]}, delivered while the clock reads that tick
+    def begin_tick(self, tick): self.tick = tick
+    def click(self, pos): self.pending.append(pos)
+    def get_mouse_pos(self): return (int(self.mouse_x(self.tick)), SCREEN_HEIGHT - 40)
+    def get_events(self):
+        positions = self.clicks.get(self.tick, []) + self.pending; self.pending = []
+        return [pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=pos) for pos in positions]
+    def tick_events(self): return []
+
+game_clock = RealClock(); input_source = PygameInput()
+
+# --- 輸入錄製與回放 ---
+# Every tick runs the same way live, headless and in playback: the clicks queued while the clock reads tick t-1
+# are handled, the clock advances to t, then update/collision run and Player.update reads the mouse once.
+# With the RNG seeded up front, the seed, one mouse x per tick and the clicks (tagged with the tick the clock
+# read) reproduce a session exactly. --record PATH writes them on exit; --replay PATH plays a file back in the
+# window at normal speed, or as fast as possible with --headless.
+# File: b'DQRP', version byte, varints (seed, sim Hz, start level, flags, ticks), mouse x as zigzag deltas with
+# runs of unchanged ticks collapsed, clicks as (tick delta, x, y), then a CRC of the final game state.
+RECORD_PATH = get_option_value('--record', 'WEBGAME_RECORD', None, cast=str)
+REPLAY_PATH = get_option_value('--replay', 'WEBGAME_REPLAY', None, cast=str)
+REPLAY_MAGIC = b'DQRP'; REPLAY_VERSION = 1
+REPLAY_FLAG_INVINCIBLE = 1; REPLAY_FLAG_NUMPY_ENEMIES = 2 # The two enemy engines draw their rolls differently
+
+def _put_varint(out, n):
+    while n >= 0x80: out.append((n & 0x7F) | 0x80); n >>= 7
+    out.append(n)
+
+def _get_varint(data, pos): # -> (value, next position)
+    n = shift = 0
+    while True:
+        b = data[pos]; pos += 1; n |= (b & 0x7F) << shift; shift += 7
+        if b < 0x80: return n, pos
+
+def encode_replay(replay):
+    out = bytearray(REPLAY_MAGIC); out.append(REPLAY_VERSION); mouse_x = replay['mouse_x']
+    flags = (REPLAY_FLAG_INVINCIBLE if replay['invincible'] else 0) | (REPLAY_FLAG_NUMPY_ENEMIES if replay.get('numpy_enemies') else 0)
+    for n in (replay['seed'], replay['sim_hz'], replay['start_level'], flags, len(mouse_x)): _put_varint(out, n)
+    prev = SCREEN_WIDTH // 2; i = 0
+    while i < len(mouse_x):
+        delta = mouse_x[i] - prev; prev = mouse_x[i]; i += 1; _put_varint(out, delta * 2 if delta >= 0 else -delta * 2 - 1) # Zigzag
+        if delta == 0: # Run length of the following unchanged ticks
+            run = 0
+            while i + run < len(mouse_x) and mouse_x[i + run] == prev: run += 1
+            _put_varint(out, run); i += run
+    _put_varint(out, len(replay['clicks'])); prev_tick = 0
+    for tick, x, y in replay['clicks']: _put_varint(out, tick - prev_tick); _put_varint(out, x); _put_varint(out, y); prev_tick = tick
+    _put_varint(out, replay['digest']); return bytes(out)
+
+def decode_replay(data):
+    if data[:4] != REPLAY_MAGIC or data[4] != REPLAY_VERSION: raise ValueError("不是支援的回放檔")
+    pos = 5; header = []
+    for _ in range(5): n, pos = _get_varint(data, pos); header.append(n)
+    seed, sim_hz, start_level, flags, ticks = header; mouse_x = array('i'); prev = SCREEN_WIDTH // 2
+    while len(mouse_x) < ticks:
+        z, pos = _get_varint(data, pos); prev += z >> 1 if not z & 1 else -(z >> 1) - 1; mouse_x.append(prev)
+        if z == 0: run, pos = _get_varint(data, pos); mouse_x.extend([prev] * run)
+    count, pos = _get_varint(data, pos); clicks = []; tick = 0
+    for _ in range(count):
+        delta, pos = _get_varint(data, pos); x, pos = _get_varint(data, pos); y, pos = _get_varint(data, pos); tick += delta; clicks.append((tick, x, y))
+    digest, pos = _get_varint(data, pos)
+    return {'seed': seed, 'sim_hz': sim_hz, 'start_level': start_level, 'invincible': bool(flags & REPLAY_FLAG_INVINCIBLE), 'numpy_enemies': bool(flags & REPLAY_FLAG_NUMPY_ENEMIES),
+            'mouse_x': mouse_x, 'clicks': clicks, 'digest': digest}
+
+def load_replay(path):
+    with open(path, 'rb') as f: return decode_replay(f.read())
+
+def state_digest(): # CRC of the gameplay state a replay has to reproduce
+    boss = boss_group.sprite if boss_group else None
+    parts = (game_state, current_level, loop_count, score, click_times, player.lives if player else None, player.skill_charges if player else None, player.rect.center if player else None,
+             [(e.rect.center, e.hp, e.state) for e in enemies], boss.hp if boss else None, sorted(group_counts().items()))
+    return zlib.crc32(repr(parts).encode('utf-8'))
+
+class InputRecorder: # Wraps the live (or scripted) input source and keeps what the game actually read from it
+    def __init__(self, inner, seed, start_level=0, invincible=False):
+        self.inner = inner; self.seed = seed; self.start_level = start_level; self.invincible = invincible
+        self.tick = 0; self.mouse_x = array('i'); self.clicks = [] # mouse_x[t - 1]: what Player.update read during tick t
+    def begin_tick(self, tick):
+        self.tick = tick; self.inner.begin_tick(tick)
+        self.mouse_x.append(self.mouse_x[-1] if self.mouse_x else SCREEN_WIDTH // 2) # Unread ticks repeat the last value
+    def get_mouse_pos(self):
+        pos = self.inner.get_mouse_pos()
+        if self.mouse_x: self.mouse_x[-1] = max(0, int(pos[0]))
+        return pos
+    def get_events(self):
+        events = self.inner.get_events()
+        for event in events:
+            if event.type != pygame.MOUSEBUTTONDOWN or event.button != 1: continue
+            if fullscreen_button_rect and fullscreen_button_rect.collidepoint(event.pos): continue # Display only, no gameplay effect
+            self.clicks.append((self.tick, max(0, int(event.pos[0])), max(0, int(event.pos[1]))))
+        return events
+    def tick_events(self): return self.inner.tick_events()
+    def click(self, pos): self.inner.click(pos)
+    def save(self, path):
+        data = encode_replay({'seed': self.seed, 'sim_hz': SIM_HZ, 'start_level': self.start_level, 'invincible': self.invincible, 'numpy_enemies': enemy_swarm is not None,
+                              'mouse_x': self.mouse_x, 'clicks': self.clicks, 'digest': state_digest()})
+        with open(path, 'wb') as f: f.write(data)
+        log.info('replay', "回放已儲存: %s (%d 個 tick, %d 次點擊, %d 位元組)", path, len(self.mouse_x), len(self.clicks), len(data))
+
+class ReplayInput: # Feeds a recording back; with passthrough the window's quit/keyboard events still work
+    def __init__(self, replay, passthrough=False):
+        self.replay = replay; self.passthrough = passthrough; self.tick = 0; self.next_click = 0
+    @property
+    def finished(self): return self.tick >= len(self.replay['mouse_x'])
+    def begin_tick(self, tick): self.tick = tick
+    def get_mouse_pos(self): return (self.replay['mouse_x'][self.tick - 1] if self.tick else SCREEN_WIDTH // 2, SCREEN_HEIGHT - 40)
+    def get_events(self):
+        if not self.passthrough: return []
+        events = [e for e in pygame.event.get() if e.type not in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP)]
+        if self.finished: log.info('replay', "回放結束."); events.append(pygame.event.Event(pygame.QUIT))
+        return events
+    def tick_events(self): # Recorded clicks for the tick the clock currently reads
+        clicks = self.replay['clicks']; events = []
+        while self.next_click < len(clicks) and clicks[self.next_click][0] <= self.tick:
+            _, x, y = clicks[self.next_click]; self.next_click += 1; events.append(pygame.event.Event(pygame.MOUSEBUTTONDOWN, button=1, pos=(x, y)))
+        return events
+
+def begin_replay(replay): # After setup_game(): recordings made headless start mid-game instead of at the menu
+    if replay['sim_hz'] != SIM_HZ: log.warning('replay', "警告: 回放以 %d Hz 錄製, 目前為 %d Hz (請加上 --sim-hz %d), 結果不會一致.", replay['sim_hz'], SIM_HZ, replay['sim_hz'])
+    if replay['numpy_enemies'] != (enemy_swarm is not None): log.warning('replay', "警告: 回放%s NumPy 敵人引擎錄製 (請%s --numpy-enemies), 結果不會一致.", '以' if replay['numpy_enemies'] else '未以', '加上' if replay['numpy_enemies'] else '移除')
+    if replay['start_level']: start_new_game(replay['start_level'])
+    if replay['invincible'] and player: player.lives = 10 ** 9
+
+def check_replay(replay):
+    digest = state_digest(); match = digest == replay['digest']
+    (log.info if match else log.warning)('replay', "回放結果%s: 狀態 CRC %08x (錄製時 %08x)", '一致' if match else '不一致', digest, replay['digest']); return match
+
+previous_positions = {} # sprite -> rect.topleft before the latest simulation step
+render_alpha = 1.0 # How far the renderer is between that previous state and the current one
+sim_stats = {'steps': 0, 'rendered_frames': 0, 'skipped_renders': 0, 'dropped_ms': 0.0}
+
+def capture_positions(): global previous_positions; previous_positions = {sp: sp.rect.topleft for sp in all_sprites}
+
+def interpolate_sprites(group, alpha): # Moves rects to their interpolated draw positions; returns what restore_sprites needs
+    moved = []
+    if alpha >= 1.0 or not previous_positions: return moved
+    for sp in group:
+        prev = previous_positions.get(sp)
+        if prev is None: continue
+        rect = sp.rect; x, y = rect.topleft; px, py = prev
+        if (x == px and y == py) or abs(x - px) + abs(y - py) > INTERP_MAX_JUMP: continue
+        moved.append((rect, x, y)); rect.topleft = (round(px + (x - px) * alpha), round(py + (y - py) * alpha))
+    return moved
+
+def restore_sprites(moved):
+    for rect, x, y in moved: rect.topleft = (x, y)
 
-    pygame.mixer.pre_init(44100, -16, 2, 512); pygame.init(); pygame.mixer.init()
+# --- 畫面按鈕與關卡轉場 ---
+LEVEL_TRANSITION_DELAY = 2000
+START_BUTTON_RECT = pygame.Rect(SCREEN_WIDTH / 2 - 100, SCREEN_HEIGHT * 0.75, 200, 50)
+CONTINUE_BUTTON_RECT = pygame.Rect(SCREEN_WIDTH / 2 - 150, SCREEN_HEIGHT / 2 + 50, 300, 50)
+MENU_BUTTON_RECT = pygame.Rect(SCREEN_WIDTH / 2 - 150, SCREEN_HEIGHT / 2 + 120, 300, 50)
+
+def _no_overlay(rect): pass
+
+# --- 遊戲初始化 ---
+def setup_game(headless=False):
+    global screen, clock, all_sprites, enemies, player_bullets, enemy_bullets, boss_group, powerups, player
+    global game_state, current_level, score, click_times, level_transition_timer, loop_count, difficulty_multiplier
+    global dirty_renderer, projectile_engine, enemy_swarm
+    if headless: pygame.init() # Dummy video driver, no mixer: sounds stay empty and every play() is guarded
+    else: pygame.mixer.pre_init(44100, -16, 2, 512); pygame.init(); pygame.mixer.init()
     screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT)); pygame.display.set_caption(GAME_TITLE); clock = pygame.time.Clock()
-    init_font(); load_assets(); load_sounds()
+    init_font(); load_assets()
+    if not headless: load_sounds(); audio.init()
+    prototypes.build_all()
 
-    all_sprites = pygame.sprite.Group(); enemies = pygame.sprite.Group(); player_bullets = pygame.sprite.Group()
+    all_sprites = pygame.sprite.RenderUpdates() if DIRTY_RENDERING and not headless else pygame.sprite.Group(); enemies = pygame.sprite.Group(); player_bullets = pygame.sprite.Group()
     enemy_bullets = pygame.sprite.Group(); boss_group = pygame.sprite.GroupSingle(); powerups = pygame.sprite.Group()
     game_state = "START_MENU"; current_level = 0; score = 0; player = None; click_times = []
-    level_transition_timer = 0; LEVEL_TRANSITION_DELAY = 2000; loop_count = 0; difficulty_multiplier = 1.0
-    continue_button_rect_local = pygame.Rect(SCREEN_WIDTH / 2 - 150, SCREEN_HEIGHT / 2 + 50, 300, 50)
-    menu_button_rect_local = pygame.Rect(SCREEN_WIDTH / 2 - 150, SCREEN_HEIGHT / 2 + 120, 300, 50)
+    level_transition_timer = 0; loop_count = 0; difficulty_multiplier = 1.0
+    enemy_index.clear() # Enemies of a previous headless run were never removed from their (now dropped) group
+    dirty_renderer = DirtyRectRenderer() if DIRTY_RENDERING and not headless else None
+    if dirty_renderer: log.info('setup', "使用髒矩形渲染模式.")
+    if NUMPY_PROJECTILES and np is None: log.warning('setup', "警告: 未安裝 NumPy, 改用一般子彈精靈.")
+    projectile_engine = ProjectileEngine() if NUMPY_PROJECTILES and np is not None else None
+    if projectile_engine: log.info('setup', "使用 NumPy 子彈引擎.")
+    if NUMPY_ENEMIES and np is None: log.warning('setup', "警告: 未安裝 NumPy, 改用逐精靈敵人 AI.")
+    enemy_swarm = EnemySwarm() if NUMPY_ENEMIES and np is not None else None
+    if enemy_swarm is not None: log.info('setup', "使用 NumPy 敵人引擎.")
+
+def start_new_game(start_level=1):
+    global player, game_state, current_level, score, loop_count, difficulty_multiplier, click_times
+    current_level = start_level; score = 0; loop_count = 0; difficulty_multiplier = 1.0; combat_stats['hits_taken'].clear(); combat_stats['powerups'].clear()
+    all_sprites.empty(); enemies.empty(); player_bullets.empty(); enemy_bullets.empty(); boss_group.empty(); powerups.empty()
+    wave_builder.cancel(); player = Player(); all_sprites.add(player); spawn_wave(current_level); game_state = "PLAYING"; click_times = []
+
+# --- 事件處理 ---
+def handle_event(event): # Returns False when the game should quit
+    global screen, player, game_state, current_level, score, click_times, loop_count, difficulty_multiplier, is_fullscreen
+    if event.type == pygame.QUIT: return False
+    if event.type == pygame.KEYDOWN and event.key == PROFILER_TOGGLE_KEY: profiler.toggle(); return True
+    if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1: # Left click
+        if fullscreen_button_rect and fullscreen_button_rect.collidepoint(event.pos):
+            is_fullscreen = not is_fullscreen; screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.FULLSCREEN if is_fullscreen else 0)
+            ui_layer.invalidate()
+            if dirty_renderer: dirty_renderer.invalidate()
+            audio.play('ui_click'); log.info('fullscreen', "Toggled fullscreen. Is fullscreen: %s", is_fullscreen); return True
+
+    if game_state == "START_MENU":
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if START_BUTTON_RECT.collidepoint(event.pos):
+                audio.play('ui_click'); audio.play_music('background') # Replaces the streamed cover music
+                start_new_game()
+
+    elif game_state == "PLAYING":
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+             now_time_sec = game_clock.time(); click_times.append(now_time_sec); click_times = [t for t in click_times if now_time_sec - t < TRIPLE_CLICK_INTERVAL]
+             if len(click_times) >= 3:
+                 if player and player.skill_charges > 0: # MODIFIED: pomeranian_charges -> skill_charges
+                     log.info('player.skill', "發動強力攻擊! 造成 %d 點傷害!", SKILL_DAMAGE); # MODIFIED
+                     audio.play('skill_activate') # MODIFIED: pom_skill -> skill_activate
+                     player.skill_charges -= 1; click_times = [] # MODIFIED
+                     for es in enemies: es.take_damage(SKILL_DAMAGE) if hasattr(es, 'take_damage') else None # MODIFIED: POMERANIAN_DAMAGE -> SKILL_DAMAGE
+                     if boss_group.sprite and hasattr(boss_group.sprite, 'take_damage'): boss_group.sprite.take_damage(SKILL_DAMAGE) # MODIFIED
+                     all_sprites.add(SkillAnimation(position_key="bottomleft")); all_sprites.add(SkillAnimation(position_key="bottomright")) # MODIFIED: Pomeranian -> SkillAnimation
+                 elif player: log.info('player.skill', "技能能量不足!"); click_times = [] # MODIFIED
+
+    elif game_state == "POST_VICTORY_CHOICE":
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if CONTINUE_BUTTON_RECT.collidepoint(event.pos):
+                audio.play('ui_click'); audio.play_music('background')
+
+                difficulty_multiplier = 1.0 + loop_count * 0.15; log.info('game.loop', "新難度倍率: %.2f", difficulty_multiplier); current_level = 1
+                player_bullets.empty(); enemy_bullets.empty(); powerups.empty(); boss_group.empty(); [se.kill() for se in enemies]
+                spawn_wave(current_level); game_state = "PLAYING"
+            elif MENU_BUTTON_RECT.collidepoint(event.pos):
+                audio.play('ui_click'); audio.stop_music() # Cover music is started by the START_MENU state logic
+                loop_count = 0; difficulty_multiplier = 1.0; game_state = "START_MENU"
+
+    elif game_state == "GAME_OVER":
+         if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+             audio.play('ui_click'); audio.stop_music() # Cover music is started by the START_MENU state logic
+             loop_count = 0; difficulty_multiplier = 1.0; game_state = "START_MENU"
+    return True
+
+# --- 遊戲狀態更新 ---
+def update_world(dt, now_ticks):
+    global game_state, current_level
+    if game_state == "START_MENU":
+        if 'cover' in music_paths and audio.music != 'cover': audio.play_music('cover') # Tracked state, no channel scan
+    elif game_state == "PLAYING":
+        all_sprites.update(dt)
+        if enemy_swarm is not None: enemy_swarm.step(dt, now_ticks)
+        if projectile_engine: projectile_engine.step(dt)
+    elif game_state == "LEVEL_TRANSITION":
+        if now_ticks - level_transition_timer > LEVEL_TRANSITION_DELAY:
+            current_level += 1; log.info('game.level', "開始載入關卡 %d...", current_level + loop_count * MAX_LEVELS); player_bullets.empty(); spawn_wave(current_level, wave_builder.take(current_level)); game_state = "PLAYING"
+
+def resolve_collisions(now_ticks):
+    global game_state, score, loop_count, level_transition_timer
+    if game_state != "PLAYING": return
+    if player and player.alive() and projectile_engine:
+        for enemy_hit, hit_count in projectile_engine.player.collide_sprites(enemies.sprites(), use_masks=quality.mask_collisions).items():
+            for _ in range(hit_count): enemy_hit.take_damage(1)
+        if boss_group.sprite and boss_group.sprite.alive():
+            for actual_boss, hit_count in projectile_engine.player.collide_sprites([boss_group.sprite], use_masks=quality.mask_collisions).items():
+                for _ in range(hit_count): actual_boss.take_damage(1)
+    elif player and player.alive():
+        target_grid.rebuild(enemies, boss_group) # Enemies first, then the boss, as in the old two groupcollide calls
+        for target_hit, bullets_that_hit in target_grid.collide_group(player_bullets, collided=collide_mask_or_rect if quality.mask_collisions else pygame.sprite.collide_rect).items():
+            if hasattr(target_hit, 'take_damage'):
+                for _ in bullets_that_hit: target_hit.take_damage(1) # Assuming 1 damage per bullet
+    if player and player.alive():
+        if not player.hidden:
+            p_coll_func = pygame.sprite.collide_mask if player.mask and quality.mask_collisions else pygame.sprite.collide_rect
+            if enemy_bullets:
+                bullet_grid.rebuild(enemy_bullets); hit_bullets = [b for b in bullet_grid.query(player.rect, count_naive=True) if p_coll_func(player, b)]
+                if hit_bullets: [b.kill() for b in hit_bullets]; player_hit(hit_bullets[0].source)
+            if projectile_engine and projectile_engine.enemy.collide_sprites([player], use_masks=bool(player.mask) and quality.mask_collisions): player_hit(projectile_engine.enemy.hit_sources[0])
+            if player.lives > 0 and not player.hidden: # Check again after bullet collision
+                # Check collision with diving enemies
+                diver = next((enemy_obj for enemy_obj in enemy_index.diving_near(player.rect) if p_coll_func(player, enemy_obj)), None)
+                if diver: player_hit(diver.behavior)
+            if player.lives > 0 and not player.hidden and boss_group.sprite and boss_group.sprite.alive(): # Check again
+                if p_coll_func(player, boss_group.sprite): player_hit('boss')
+            if player.lives <= 0:
+                log.info('game.over', "玩家生命耗盡! 遊戲結束.")
+                audio.stop_music()
+                audio.play('game_over')
+                player.kill(); game_state = "GAME_OVER"
+        for p_up in pygame.sprite.spritecollide(player, powerups, True, pygame.sprite.collide_circle_ratio(0.7)): player.apply_powerup(p_up.type) if hasattr(player, 'apply_powerup') else None
+    if player and player.alive() and game_state == "PLAYING": # Check if all enemies/boss defeated
+        is_boss_lvl = bool(level_data[current_level - 1]['boss']) if 0 < current_level <= MAX_LEVELS else False; boss_dead = not boss_group.sprite
+        if (not is_boss_lvl and not enemies) or (is_boss_lvl and boss_dead and not enemies): # Ensure regular enemies also cleared on boss levels if any spawn after boss
+             lvl_disp = current_level + loop_count * MAX_LEVELS; log.info('game.level', "關卡 %d 完成!", lvl_disp)
+             [b.kill() for b in enemy_bullets]; projectile_engine.enemy.clear() if projectile_engine else None; [p.kill() for p in powerups]; [e.kill() for e in enemies] if not is_boss_lvl else None # Clear non-boss enemies too
+             next_lvl = current_level + 1
+             if next_lvl > MAX_LEVELS:
+                 log.info('game.level', "最高基礎關卡完成...")
+                 audio.stop_music()
+                 loop_count += 1; game_state = "POST_VICTORY_CHOICE"
+             else:
+                 game_state = "LEVEL_TRANSITION"; level_transition_timer = now_ticks; asset_manager.schedule_prefetch(next_lvl)
+                 if SPAWN_BUDGET_MS > 0: wave_builder.start(next_lvl) # Built by wave_builder.step() over the transition frames
+
+def player_hit(cause): # cause: behavior of the enemy whose bullet or dive hit the player, or 'boss'
+    player.lives -= 1; player.hide(); hits = combat_stats['hits_taken']; hits[cause] = hits.get(cause, 0) + 1
+
+def step_simulation(dt, now_ticks): update_world(dt, now_ticks); resolve_collisions(now_ticks)
+
+# --- 繪圖 ---
+def draw_frame(surf):
+    if dirty_renderer: draw_needed = dirty_renderer.begin_frame(surf, game_state, all_sprites); mark = dirty_renderer.add_overlay; mark_all = dirty_renderer.add_overlays
+    else:
+        draw_needed = True; mark = mark_all = _no_overlay
+        if game_state not in STATIC_SCREENS: surf.fill(BLACK) # Cached static screens are opaque and cover everything
+    if not draw_needed: pass # Static screen unchanged since it was last presented
+    elif game_state in STATIC_SCREENS: surf.blit(ui_layer.screen_surface(game_state), (0, 0)) # Rebuilt only when what it shows changes
+    elif game_state == "PLAYING":
+        moved = interpolate_sprites(all_sprites, render_alpha); sprite_rects = all_sprites.draw(surf); restore_sprites(moved)
+        if projectile_engine: mark_all(projectile_engine.draw(surf, want_rects=dirty_renderer is not None, lag=(1.0 - render_alpha) * SIM_DT))
+        mark(draw_ui(surf, current_level, score, player.lives, player.skill_charges, loop_count)) if player and player.alive() else None # MODIFIED
+        if boss_group.sprite and hasattr(boss_group.sprite, 'hp') and hasattr(boss_group.sprite, 'max_hp') and boss_group.sprite.max_hp > 0: mark(draw_health_bar(surf, SCREEN_WIDTH / 2 - 150, 35, (boss_group.sprite.hp / boss_group.sprite.max_hp) * 100, bar_length=300, bar_height=15))
+        if dirty_renderer: dirty_renderer.add_rects(sprite_rects)
+    elif game_state == "LEVEL_TRANSITION":
+        moved = interpolate_sprites(all_sprites, render_alpha); sprite_rects = all_sprites.draw(surf); restore_sprites(moved)
+        if projectile_engine: mark_all(projectile_engine.draw(surf, want_rects=dirty_renderer is not None, lag=(1.0 - render_alpha) * SIM_DT))
+        mark(draw_ui(surf, current_level, score, player.lives, player.skill_charges, loop_count)) if player and player.alive() else None # MODIFIED
+        lvl_disp = current_level + loop_count * MAX_LEVELS; mark(draw_text(surf, f"關卡 {lvl_disp} 完成！", 54, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 - 40, YELLOW, align="center"))
+        next_lvl_disp = current_level + 1 + loop_count * MAX_LEVELS; mark(draw_text(surf, f"準備進入第 {next_lvl_disp} 關...", 28, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 + 40, WHITE, align="center")) if current_level + 1 <= MAX_LEVELS else None
+        if dirty_renderer: dirty_renderer.add_rects(sprite_rects)
+
+def paint_static_screen(surf, state): # Onto UILayer's cached screen surface
+    if state == "START_MENU":
+        surf.blit(asset_manager.image('cover'), (0, 0)) if asset_manager.image('cover') else draw_text(surf, GAME_TITLE, 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.15, align="center")
+        start_btn = START_BUTTON_RECT; pygame.draw.rect(surf, RED, start_btn, border_radius=10); draw_text(surf, "開始遊戲", 24, start_btn.centerx, start_btn.centery, WHITE, align="center"); draw_text(surf, "滑鼠移動 | 左鍵三連擊發動技能", 16, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.90, WHITE, align="center")
+    elif state == "POST_VICTORY_CHOICE":
+        draw_text(surf, f"第 {loop_count} 輪通關！", 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 4, GREEN, align="center"); draw_text(surf, f"總分數: {score}", 36, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 - 20, WHITE, align="center")
+        pygame.draw.rect(surf, GREEN, CONTINUE_BUTTON_RECT, border_radius=10); draw_text(surf, f"繼續遊戲 (關卡 {1 + loop_count * MAX_LEVELS})", 24, CONTINUE_BUTTON_RECT.centerx, CONTINUE_BUTTON_RECT.centery, BLACK, align="center")
+        pygame.draw.rect(surf, RED, MENU_BUTTON_RECT, border_radius=10); draw_text(surf, "返回主選單", 24, MENU_BUTTON_RECT.centerx, MENU_BUTTON_RECT.centery, WHITE, align="center")
+        tmp_l = player.lives if player and hasattr(player, 'lives') else 0; tmp_c = player.skill_charges if player and hasattr(player, 'skill_charges') else 0; draw_ui(surf, current_level, score, tmp_l, tmp_c, loop_count) # MODIFIED
+    elif state == "GAME_OVER":
+        draw_text(surf, "GAME OVER", 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 4, RED, align="center"); draw_text(surf, f"最終分數: {score}", 36, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, WHITE, align="center"); draw_text(surf, "按下滑鼠左鍵返回主選單", 22, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.75, WHITE, align="center"); draw_ui(surf, current_level, score, 0, 0, loop_count) # MODIFIED: skill_charges to 0
+    elif state == "WIN_SCREEN": # This state seems unused in original flow, but kept for completeness
+        draw_text(surf, "戰鬥仍將繼續！", 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 4, GREEN, align="center"); draw_text(surf, f"最終分數: {score}", 36, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, WHITE, align="center"); draw_text(surf, "按下滑鼠左鍵重新開始", 22, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.75, WHITE, align="center")
+        tmp_l = player.lives if player and hasattr(player, 'lives') else 0; tmp_c = player.skill_charges if player and hasattr(player, 'skill_charges') else 0; draw_ui(surf, current_level, score, tmp_l, tmp_c, loop_count) # MODIFIED
 
-    running = True
+def present_frame(): # Returns (pixels pushed to the display, whether it was a full flip)
+    if dirty_renderer: return dirty_renderer.present()
+    pygame.display.flip(); return SCREEN_WIDTH * SCREEN_HEIGHT, True
+
+def report_stats():
+    if dirty_renderer: log.info('stats.dirty', "髒矩形渲染統計: %s", dirty_renderer.stats())
+    log.info('stats.pools', "物件池統計: %s", pool_stats())
+    log.info('stats.grid', "碰撞粗篩統計: 目標 %s / 敵彈 %s", target_grid.stats(), bullet_grid.stats())
+    if sim_stats['rendered_frames']: log.info('stats.sim', "固定步長統計 (%d Hz): %s", SIM_HZ, dict(sim_stats))
+    if audio.channels: log.info('stats.audio', "音效管理統計: %s", audio.stats())
+    log.info('stats.assets', "圖片資源統計: %s", asset_manager.stats())
+    if asset_cache.enabled: log.info('stats.asset_cache', "解碼資源快取統計: %s", asset_cache.stats())
+    if ui_layer.counts['hud_blits'] or ui_layer.counts['screen_blits']: log.info('stats.ui', "介面快取統計: %s", ui_layer.stats())
+    if wave_builder.stats['prebuilt_waves']: log.info('stats.spawn', "分段生成統計: %s", dict(wave_builder.stats))
+    if quality.enabled: log.info('stats.quality', "自適應畫質統計: %s", quality.stats())
+    if log.stats['rate_limited'] or log.stats['dropped']: log.info('stats.log', "記錄統計: %s", dict(log.stats))
+
+# --- 效能分析器 ---
+# F3 toggles a per-phase frame profiler: an overlay with a rolling frame-time graph and sprite counts, and one JSON
+# record per frame, streamed to a JSONL file on desktop or kept in an in-memory ring buffer in pygbag builds.
+# While it is off every hook returns after a single attribute check.
+PROFILER_ENABLED = get_option('--profile', 'WEBGAME_PROFILE') # Start with the profiler on
+PROFILER_TOGGLE_KEY = pygame.K_F3
+PROFILER_LOG_PATH = get_option_value('--profile-log', 'WEBGAME_PROFILE_LOG', 'profile_frames.jsonl', cast=str)
+PROFILER_RING_FRAMES = 3600 # pygbag: keep the last minute at 60 FPS
+PROFILER_GRAPH_FRAMES = 120; PROFILER_GRAPH_MAX_MS = 50.0; PROFILER_TEXT_INTERVAL = 10 # Overlay text is re-rendered every N frames
+
+def group_counts(): # Live sprites per group; array-backed bullets count towards their sprite group
+    engine = projectile_engine
+    return {'enemies': len(enemies), 'player_bullets': len(player_bullets) + (len(engine.player) if engine else 0),
+            'enemy_bullets': len(enemy_bullets) + (len(engine.enemy) if engine else 0), 'powerups': len(powerups), 'boss': len(boss_group), 'all_sprites': len(all_sprites)}
+
+class FrameProfiler:
+    def __init__(self, log_path=PROFILER_LOG_PATH, ring_size=PROFILER_RING_FRAMES, enabled=False):
+        self.enabled = False; self.requested = enabled # Switching waits for the next begin_frame so no frame is half-timed
+        self.log_path = None if IS_WEB else log_path; self.log_file = None; self.records = deque(maxlen=ring_size)
+        self.frame_ms = deque(maxlen=PROFILER_GRAPH_FRAMES); self.phases = {}; self.frame_start = self.last_lap = 0.0; self.prev_frame_start = None
+        self.frames = 0; self.text_surfaces = []; self.box = pygame.Rect(SCREEN_WIDTH - 270, 40, 260, 145); self.pushed = (0, True)
+    def toggle(self): self.requested = not self.requested
+    def _switch(self):
+        self.enabled = self.requested; self.prev_frame_start = None; self.frame_ms.clear(); self.text_surfaces = []
+        if self.enabled and self.log_path and not self.log_file:
+            try: self.log_file = open(self.log_path, 'a', encoding='utf-8')
+            except OSError as e: log.warning('profiler', "警告: 無法開啟效能記錄檔 %s: %s, 改用記憶體環形緩衝.", self.log_path, e); self.log_path = None
+        elif not self.enabled and self.log_file: self.log_file.flush()
+        if dirty_renderer: dirty_renderer.invalidate() # Repaint whatever the overlay covered
+        log.info('profiler', "效能分析器: %s%s", '開啟' if self.enabled else '關閉', f" (記錄寫入 {self.log_path})" if self.enabled and self.log_path else "")
+    def begin_frame(self):
+        if self.requested is not self.enabled: self._switch()
+        if not self.enabled: return
+        now = time.perf_counter()
+        if self.prev_frame_start is not None: self.frame_ms.append((now - self.prev_frame_start) * 1000.0)
+        self.prev_frame_start = self.frame_start = self.last_lap = now; self.phases = {}
+    def lap(self, phase): # Time since the previous lap is charged to this phase
+        if not self.enabled: return
+        now = time.perf_counter(); self.phases[phase] = self.phases.get(phase, 0.0) + (now - self.last_lap) * 1000.0; self.last_lap = now # Summed over simulation steps
+    def end_frame(self, sim_steps=1, pushed=None): # pushed: present_frame()'s (pixels, full flip) for this frame
+        if not self.enabled: return
+        self.frames += 1; pushed = pushed or self.pushed; self.pushed = pushed
+        record = {'frame': self.frames, 'sim_steps': sim_steps, 'frame_ms': round(self.frame_ms[-1], 3) if self.frame_ms else None, 'work_ms': round((self.last_lap - self.frame_start) * 1000.0, 3),
+                  'phases': {phase: round(ms, 3) for phase, ms in self.phases.items()}, 'counts': group_counts(), 'game_state': game_state, 'current_level': current_level, 'loop_count': loop_count, 'quality_tier': quality.tier,
+                  'pushed_pixels': pushed[0], 'full_flip': pushed[1]}
+        if self.log_file: self.log_file.write(json.dumps(record) + "\n")
+        else: self.records.append(record)
+    def _render_text(self):
+        font = get_font(main_font_path, 14); recent = self.frame_ms or [0.0]; counts = group_counts(); ph = self.phases
+        lines = [f"frame {recent[-1]:.1f} ms  avg {sum(recent) / len(recent):.1f}  max {max(recent):.1f}",
+                 "  ".join(f"{name[:3]} {ph.get(name, 0.0):.2f}" for name in ('update', 'collision', 'draw', 'present')),
+                 f"enemies {counts['enemies']}  pb {counts['player_bullets']}  eb {counts['enemy_bullets']}  pu {counts['powerups']}",
+                 f"{game_state}  lv {current_level}  loop {loop_count}  q{quality.tier} {QUALITY_TIERS[quality.tier]}",
+                 f"pushed {self.pushed[0]} px ({self.pushed[0] / (SCREEN_WIDTH * SCREEN_HEIGHT):.0%}){'  full flip' if self.pushed[1] else ''}"]
+        self.text_surfaces = [font.render(line, True, WHITE) for line in lines] # Not via text_cache: these strings change constantly
+    def draw_overlay(self, surf): # Returns the covered rect for the dirty renderer
+        if not self.enabled: return None
+        box = self.box; surf.fill(BLACK, box); pygame.draw.rect(surf, GREEN, box, 1)
+        graph = pygame.Rect(box.x + 5, box.y + 5, box.width - 10, 50); scale = graph.height / PROFILER_GRAPH_MAX_MS
+        for budget_ms, color in ((1000.0 / FPS, GREEN), (2000.0 / FPS, YELLOW)): y = graph.bottom - budget_ms * scale; pygame.draw.line(surf, color, (graph.x, y), (graph.right, y))
+        if len(self.frame_ms) > 1:
+            step = graph.width / (PROFILER_GRAPH_FRAMES - 1)
+            pygame.draw.lines(surf, WHITE, False, [(graph.x + i * step, graph.bottom - min(graph.height, ms * scale)) for i, ms in enumerate(self.frame_ms)])
+        if not self.text_surfaces or self.frames % PROFILER_TEXT_INTERVAL == 0: self._render_text()
+        y = graph.bottom + 4
+        for text_surface in self.text_surfaces: surf.blit(text_surface, (box.x + 5, y)); y += text_surface.get_height()
+        return box
+    def export_jsonl(self): return "".join(json.dumps(record) + "\n" for record in self.records) # pygbag: copy the ring buffer out
+    def close(self):
+        if self.log_file: self.log_file.close(); self.log_file = None
+
+profiler = FrameProfiler(enabled=PROFILER_ENABLED)
+
+# --- 自適應畫質 ---
+# Watches a rolling average of per-frame work time (everything but the frame-cap sleep and the browser yield) and steps
+# through cumulative degradation tiers one at a time: a tier is dropped when the average goes over
+# QUALITY_DEGRADE_RATIO of the current frame budget, and restored only after it has stayed under QUALITY_RESTORE_RATIO
+# of the full-rate budget for QUALITY_RESTORE_DELAY_MS. Every change also waits for a full window of fresh samples.
+# Rect collisions change gameplay, so the controller stays off while input is recorded or replayed.
+ADAPTIVE_QUALITY = not get_option('--no-adaptive-quality', 'WEBGAME_NO_ADAPTIVE_QUALITY')
+QUALITY_TIERS = ('full', 'no_hit_flash', 'rect_collisions', 'sfx_throttle', 'half_render_rate') # Each tier includes the ones before it
+QUALITY_WINDOW = 60 # Frames in the rolling average
+QUALITY_DEGRADE_RATIO = 0.9; QUALITY_RESTORE_RATIO = 0.5
+QUALITY_RESTORE_DELAY_MS = 5000
+QUALITY_SFX_MAX_PRIORITY = 2 # 'sfx_throttle' limits shots, explosions and dives to one voice each...
+QUALITY_SFX_MIN_INTERVAL_MS = 150 # ...and at most one trigger per this many ms
+
+class QualityController:
+    def __init__(self, enabled=ADAPTIVE_QUALITY and not (RECORD_PATH or REPLAY_PATH)):
+        self.enabled = enabled; self.tier = 0; self.samples = deque(maxlen=QUALITY_WINDOW); self.total = 0.0; self.headroom_since = None
+        self.changes = 0; self.tier_frames = [0] * len(QUALITY_TIERS); self._apply()
+    def _apply(self): # The flags the hot paths read
+        self.hit_flash = self.tier < 1; self.mask_collisions = self.tier < 2; self.sfx_throttle = self.tier >= 3; self.render_rate = FPS // 2 if self.tier >= 4 else FPS
+    def sample(self, work_ms, now_ms):
+        if not self.enabled: return
+        self.tier_frames[self.tier] += 1
+        if len(self.samples) == self.samples.maxlen: self.total -= self.samples[0]
+        self.samples.append(work_ms); self.total += work_ms
+        if len(self.samples) < QUALITY_WINDOW: return
+        avg_ms = self.total / len(self.samples)
+        if avg_ms > QUALITY_DEGRADE_RATIO * 1000.0 / self.render_rate:
+            self.headroom_since = None
+            if self.tier < len(QUALITY_TIERS) - 1: self.set_tier(self.tier + 1, avg_ms)
+        elif avg_ms < QUALITY_RESTORE_RATIO * 1000.0 / FPS and self.tier > 0: # Full-rate budget, so the restored tier is not over budget again
+            if self.headroom_since is None: self.headroom_since = now_ms
+            elif now_ms - self.headroom_since >= QUALITY_RESTORE_DELAY_MS: self.set_tier(self.tier - 1, avg_ms)
+        else: self.headroom_since = None
+    def set_tier(self, tier, avg_ms=0.0):
+        self.tier = tier; self._apply(); self.samples.clear(); self.total = 0.0; self.headroom_since = None; self.changes += 1
+        if dirty_renderer: dirty_renderer.invalidate()
+        log.info('quality', "畫質等級 %d (%s), 平均工作時間 %.1f ms", tier, QUALITY_TIERS[tier], avg_ms)
+    def stats(self): return {'tier': QUALITY_TIERS[self.tier], 'changes': self.changes, 'frames_per_tier': dict(zip(QUALITY_TIERS, self.tier_frames))}
+
+quality = QualityController()
+
+# --- Main Game Function (Async) ---
+async def main():
+    global game_clock, render_alpha, input_source
+    replay = load_replay(REPLAY_PATH) if REPLAY_PATH else None
+    if replay: random.seed(replay['seed']); input_source = ReplayInput(replay, passthrough=True); log.info('replay', "播放回放: %s (%d 個 tick)", REPLAY_PATH, len(replay['mouse_x']))
+    elif RECORD_PATH:
+        seed = get_option_value('--seed', 'WEBGAME_SEED', None) or int.from_bytes(os.urandom(4), 'little')
+        random.seed(seed); input_source = InputRecorder(input_source, seed); log.info('replay', "錄製輸入 (種子 %d) -> %s", seed, RECORD_PATH)
+    game_clock = SimulationClock(SIM_DT * 1000.0); setup_game() # Game time only advances with simulation steps
+    if replay: begin_replay(replay)
+    log_task = asyncio.create_task(log.pump()) # Console writes leave the frame loop from here on
+    running = True; accumulator = 0.0; tick = 0
+    idle_fps = max(UI_IDLE_FPS, math.ceil(SIM_HZ / (1 + MAX_FRAME_SKIP))) # Slow enough to save work, fast enough that game time keeps up
     while running:
-        dt = clock.tick(FPS) / 1000.0
-        if dt == 0: dt = 1.0 / FPS # Prevent dt being zero if FPS is very high or tick returns 0
-        if dt > (1.0 / FPS) * 3: dt = (1.0 / FPS) * 3 # Cap dt to prevent large jumps
-
-        now_ticks = pygame.time.get_ticks()
-
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT: running = False
-            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1: # Left click
-                if fullscreen_button_rect and fullscreen_button_rect.collidepoint(event.pos):
-                    is_fullscreen = not is_fullscreen; screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.FULLSCREEN if is_fullscreen else 0)
-                    sounds['ui_click'].play() if sounds.get('ui_click') else None; print(f"Toggled fullscreen. Is fullscreen: {is_fullscreen}"); continue
-
-            if game_state == "START_MENU":
-                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                    start_button_rect = pygame.Rect(SCREEN_WIDTH/2 - 100, SCREEN_HEIGHT*0.75, 200, 50)
-                    if start_button_rect.collidepoint(event.pos):
-                        if sounds.get('ui_click'): sounds['ui_click'].play()
-                        # MODIFIED: Stop cover sound, start game background sound
-                        if cover_sound: cover_sound.stop()
-                        if background_sound:
-                            try:
-                                background_sound.stop() # Stop if already playing from a previous game over
-                                background_sound.play(loops=-1)
-                                print("遊戲背景音樂已開始.")
-                            except Exception as e:
-                                print(f"錯誤：播放遊戲背景 Sound 對象失敗: {e}")
-                        else:
-                            print("background_sound is None, cannot play BGM.")
-
-                        current_level = 1; score = 0; loop_count = 0; difficulty_multiplier = 1.0
-                        all_sprites.empty(); enemies.empty(); player_bullets.empty(); enemy_bullets.empty(); boss_group.empty(); powerups.empty()
-                        player = Player(); all_sprites.add(player); spawn_wave(current_level); game_state = "PLAYING"; click_times = []
-
-            elif game_state == "PLAYING":
-                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                     now_time_sec = time.time(); click_times.append(now_time_sec); click_times = [t for t in click_times if now_time_sec - t < TRIPLE_CLICK_INTERVAL]
-                     if len(click_times) >= 3:
-                         if player and player.skill_charges > 0: # MODIFIED: pomeranian_charges -> skill_charges
-                             print(f"發動強力攻擊! 造成 {SKILL_DAMAGE} 點傷害!"); # MODIFIED
-                             sounds['skill_activate'].play() if sounds.get('skill_activate') else None # MODIFIED: pom_skill -> skill_activate
-                             player.skill_charges -= 1; click_times = [] # MODIFIED
-                             for es in enemies: es.take_damage(SKILL_DAMAGE) if hasattr(es, 'take_damage') else None # MODIFIED: POMERANIAN_DAMAGE -> SKILL_DAMAGE
-                             if boss_group.sprite and hasattr(boss_group.sprite, 'take_damage'): boss_group.sprite.take_damage(SKILL_DAMAGE) # MODIFIED
-                             all_sprites.add(SkillAnimation(position_key="bottomleft")); all_sprites.add(SkillAnimation(position_key="bottomright")) # MODIFIED: Pomeranian -> SkillAnimation
-                         elif player: print("技能能量不足!"); click_times = [] # MODIFIED
-
-            elif game_state == "POST_VICTORY_CHOICE":
-                if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                    if continue_button_rect_local.collidepoint(event.pos):
-                        if sounds.get('ui_click'): sounds['ui_click'].play()
-                        # MODIFIED: Stop cover (if somehow playing), start game BGM
-                        if cover_sound: cover_sound.stop()
-                        if background_sound:
-                            try:
-                                background_sound.stop()
-                                background_sound.play(loops=-1)
-                                print("遊戲背景音樂已開始 (Post Victory).")
-                            except Exception as e:
-                                print(f"錯誤：播放遊戲背景 Sound 對象失敗 (Post Victory): {e}")
-                        else:
-                            print("background_sound is None (Post Victory), cannot play BGM.")
-
-                        difficulty_multiplier = 1.0 + loop_count * 0.15; print(f"新難度倍率: {difficulty_multiplier:.2f}"); current_level = 1
-                        player_bullets.empty(); enemy_bullets.empty(); powerups.empty(); boss_group.empty(); [se.kill() for se in enemies]
-                        spawn_wave(current_level); game_state = "PLAYING"
-                    elif menu_button_rect_local.collidepoint(event.pos):
-                        if sounds.get('ui_click'): sounds['ui_click'].play()
-                        if background_sound: background_sound.stop()
-                        # MODIFIED: Cover sound will be started by START_MENU state logic
-                        loop_count = 0; difficulty_multiplier = 1.0; game_state = "START_MENU"
-
-            elif game_state == "GAME_OVER":
-                 if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
-                     if sounds.get('ui_click'): sounds['ui_click'].play()
-                     if background_sound: background_sound.stop()
-                     # MODIFIED: Cover sound will be started by START_MENU state logic
-                     loop_count = 0; difficulty_multiplier = 1.0; game_state = "START_MENU"
-
-        # --- Game State Updates ---
-        if game_state == "START_MENU":
-            # MODIFIED: Play cover sound if not already playing
-            if cover_sound and not pygame.mixer.Channel(0).get_sound() == cover_sound : # A bit more robust check
-                # Check if any channel is playing cover_sound. This is tricky with Sound objects directly.
-                # A simpler check is if it was *meant* to be playing.
-                # Let's assume if we are in START_MENU, it should be playing.
-                # If game_music or other sounds are playing, this might conflict.
-                # For now, a simple play if not busy (assuming cover_sound has its own logic or dedicated channel if needed)
-                try:
-                    # Stop other main sounds first
-                    if background_sound and background_sound.get_num_channels() > 0: background_sound.stop()
-                    # Play cover sound if not already playing on some channel
-                    # This check is imperfect for Sound objects. Ideally, use a specific channel.
-                    # For simplicity, we'll just try to play it. If it's already playing, play() might restart or do nothing.
-                    if not any(pygame.mixer.Channel(i).get_sound() == cover_sound for i in range(pygame.mixer.get_num_channels())):
-                         cover_sound.play(loops=-1)
-                         print("封面音樂已開始.")
-                except Exception as e:
-                    print(f"錯誤：播放封面 Sound 對象失敗: {e}")
-
-
-        elif game_state == "PLAYING":
-            all_sprites.update(dt)
-            if player and player.alive():
-                hit_enemies_dict = pygame.sprite.groupcollide(enemies, player_bullets, False, True, pygame.sprite.collide_mask)
-                for enemy_hit, bullets_that_hit in hit_enemies_dict.items():
-                    if hasattr(enemy_hit, 'take_damage'):
-                        for _ in bullets_that_hit: enemy_hit.take_damage(1) # Assuming 1 damage per bullet
-                if boss_group.sprite and boss_group.sprite.alive():
-                    the_boss = boss_group.sprite; coll_func_boss = pygame.sprite.collide_mask if (hasattr(the_boss, 'mask') and the_boss.mask) else pygame.sprite.collide_rect
-                    boss_hits = pygame.sprite.groupcollide(boss_group, player_bullets, False, True, collided=coll_func_boss)
-                    if boss_hits:
-                        for actual_boss, bullets_hit in boss_hits.items():
-                            if hasattr(actual_boss, 'take_damage'):
-                                for _ in bullets_hit: actual_boss.take_damage(1) # Assuming 1 damage per bullet
-                if not player.hidden:
-                    p_coll_func = pygame.sprite.collide_mask if player.mask else pygame.sprite.collide_rect
-                    if pygame.sprite.spritecollide(player, enemy_bullets, True, p_coll_func): player.lives -= 1; player.hide()
-                    if player.lives > 0 and not player.hidden: # Check again after bullet collision
-                        # Check collision with diving enemies
-                        if any(p_coll_func(player, enemy_obj) and hasattr(enemy_obj, 'state') and enemy_obj.state == 'diving' for enemy_obj in enemies): player.lives -= 1; player.hide()
-                    if player.lives > 0 and not player.hidden and boss_group.sprite and boss_group.sprite.alive(): # Check again
-                        if p_coll_func(player, boss_group.sprite): player.lives -= 1; player.hide()
-                    if player.lives <= 0:
-                        print("玩家生命耗盡! 遊戲結束.")
-                        if background_sound: background_sound.stop()
-                        if cover_sound: cover_sound.stop() # MODIFIED: Stop cover sound on game over
-                        sounds['game_over'].play() if sounds.get('game_over') else None
-                        player.kill(); game_state = "GAME_OVER"
-                for p_up in pygame.sprite.spritecollide(player, powerups, True, pygame.sprite.collide_circle_ratio(0.7)): player.apply_powerup(p_up.type) if hasattr(player, 'apply_powerup') else None
-            if player and player.alive() and game_state == "PLAYING": # Check if all enemies/boss defeated
-                is_boss_lvl = bool(level_data[current_level - 1]['boss']) if 0 < current_level <= MAX_LEVELS else False; boss_dead = not boss_group.sprite
-                if (not is_boss_lvl and not enemies) or (is_boss_lvl and boss_dead and not enemies): # Ensure regular enemies also cleared on boss levels if any spawn after boss
-                     lvl_disp = current_level + loop_count * MAX_LEVELS; print(f"關卡 {lvl_disp} 完成!")
-                     [b.kill() for b in enemy_bullets]; [p.kill() for p in powerups]; [e.kill() for e in enemies] if not is_boss_lvl else None # Clear non-boss enemies too
-                     next_lvl = current_level + 1
-                     if next_lvl > MAX_LEVELS:
-                         print("最高基礎關卡完成...")
-                         if background_sound: background_sound.stop()
-                         if cover_sound: cover_sound.stop() # MODIFIED
-                         loop_count += 1; game_state = "POST_VICTORY_CHOICE"
-                     else: game_state = "LEVEL_TRANSITION"; level_transition_timer = now_ticks
-        elif game_state == "LEVEL_TRANSITION":
-            if now_ticks - level_transition_timer > LEVEL_TRANSITION_DELAY:
-                current_level += 1; print(f"開始載入關卡 {current_level + loop_count * MAX_LEVELS}..."); player_bullets.empty(); spawn_wave(current_level); game_state = "PLAYING"
-
-        # --- Drawing ---
-        screen.fill(BLACK)
-        if game_state == "START_MENU":
-            screen.blit(assets['cover'], (0, 0)) if assets.get('cover') else draw_text(screen, GAME_TITLE, 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.15, align="center")
-            start_btn = pygame.Rect(SCREEN_WIDTH / 2 - 100, SCREEN_HEIGHT * 0.75, 200, 50); pygame.draw.rect(screen, RED, start_btn, border_radius=10); draw_text(screen, "開始遊戲", 24, start_btn.centerx, start_btn.centery, WHITE, align="center"); draw_text(screen, "滑鼠移動 | 左鍵三連擊發動技能", 16, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.90, WHITE, align="center")
-        elif game_state == "PLAYING":
-            all_sprites.draw(screen); draw_ui(screen, current_level, score, player.lives, player.skill_charges, loop_count) if player and player.alive() else None # MODIFIED
-            if boss_group.sprite and hasattr(boss_group.sprite, 'hp') and hasattr(boss_group.sprite, 'max_hp') and boss_group.sprite.max_hp > 0: draw_health_bar(screen, SCREEN_WIDTH / 2 - 150, 35, (boss_group.sprite.hp / boss_group.sprite.max_hp) * 100, bar_length=300, bar_height=15)
-        elif game_state == "LEVEL_TRANSITION":
-            all_sprites.draw(screen); draw_ui(screen, current_level, score, player.lives, player.skill_charges, loop_count) if player and player.alive() else None # MODIFIED
-            lvl_disp = current_level + loop_count * MAX_LEVELS; draw_text(screen, f"關卡 {lvl_disp} 完成！", 54, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 - 40, YELLOW, align="center")
-            next_lvl_disp = current_level + 1 + loop_count * MAX_LEVELS; draw_text(screen, f"準備進入第 {next_lvl_disp} 關...", 28, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 + 40, WHITE, align="center") if current_level + 1 <= MAX_LEVELS else None
-        elif game_state == "POST_VICTORY_CHOICE":
-            draw_text(screen, f"第 {loop_count} 輪通關！", 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 4, GREEN, align="center"); draw_text(screen, f"總分數: {score}", 36, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2 - 20, WHITE, align="center")
-            pygame.draw.rect(screen, GREEN, continue_button_rect_local, border_radius=10); draw_text(screen, f"繼續遊戲 (關卡 {1 + loop_count * MAX_LEVELS})", 24, continue_button_rect_local.centerx, continue_button_rect_local.centery, BLACK, align="center")
-            pygame.draw.rect(screen, RED, menu_button_rect_local, border_radius=10); draw_text(screen, "返回主選單", 24, menu_button_rect_local.centerx, menu_button_rect_local.centery, WHITE, align="center")
-            tmp_l = player.lives if player and hasattr(player, 'lives') else 0; tmp_c = player.skill_charges if player and hasattr(player, 'skill_charges') else 0; draw_ui(screen, current_level, score, tmp_l, tmp_c, loop_count) # MODIFIED
-        elif game_state == "GAME_OVER":
-            draw_text(screen, "GAME OVER", 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 4, RED, align="center"); draw_text(screen, f"最終分數: {score}", 36, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, WHITE, align="center"); draw_text(screen, "按下滑鼠左鍵返回主選單", 22, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.75, WHITE, align="center"); draw_ui(screen, current_level, score, 0, 0, loop_count) # MODIFIED: skill_charges to 0
-        elif game_state == "WIN_SCREEN": # This state seems unused in original flow, but kept for completeness
-            draw_text(screen, "戰鬥仍將繼續！", 64, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 4, GREEN, align="center"); draw_text(screen, f"最終分數: {score}", 36, SCREEN_WIDTH / 2, SCREEN_HEIGHT / 2, WHITE, align="center"); draw_text(screen, "按下滑鼠左鍵重新開始", 22, SCREEN_WIDTH / 2, SCREEN_HEIGHT * 0.75, WHITE, align="center")
-            tmp_l = player.lives if player and hasattr(player, 'lives') else 0; tmp_c = player.skill_charges if player and hasattr(player, 'skill_charges') else 0; draw_ui(screen, current_level, score, tmp_l, tmp_c, loop_count) # MODIFIED
-
-        pygame.display.flip()
+        frame_rate = idle_fps if ui_layer.is_idle(game_state) and not profiler.enabled else quality.render_rate
+        accumulator += min(clock.tick(frame_rate) / 1000.0, MAX_FRAME_TIME); work_start = time.perf_counter()
+        profiler.begin_frame()
+        for event in input_source.get_events():
+            ui_layer.note_input(event)
+            if not handle_event(event): running = False
+        profiler.lap('events')
+        steps = min(int(accumulator / SIM_DT), MAX_FRAME_SKIP + 1)
+        if replay: steps = min(steps, len(replay['mouse_x']) - tick) # Stop on the recording's last tick
+        for i in range(steps):
+            for event in input_source.tick_events(): handle_event(event) # Played-back clicks land on their recorded tick
+            if i == steps - 1: capture_positions() # Interpolate between the last two states only
+            game_clock.advance(); tick += 1; input_source.begin_tick(tick); now_ticks = game_clock.get_ticks()
+            update_world(SIM_DT, now_ticks); profiler.lap('update')
+            resolve_collisions(now_ticks); profiler.lap('collision')
+        wave_builder.step(); profiler.lap('spawn') # No-op unless a transition is building the next wave
+        accumulator -= steps * SIM_DT
+        if accumulator >= SIM_DT: sim_stats['dropped_ms'] += (accumulator - accumulator % SIM_DT) * 1000.0; accumulator %= SIM_DT # Over the frame-skip budget
+        sim_stats['steps'] += steps; sim_stats['rendered_frames'] += 1; sim_stats['skipped_renders'] += max(0, steps - 1)
+        render_alpha = accumulator / SIM_DT
+        draw_frame(screen); profiler.lap('draw')
+        overlay_rect = profiler.draw_overlay(screen)
+        if overlay_rect and dirty_renderer: dirty_renderer.add_overlay(overlay_rect)
+        profiler.lap('overlay'); pushed = present_frame(); profiler.lap('present'); profiler.end_frame(sim_steps=steps, pushed=pushed)
+        quality.sample((time.perf_counter() - work_start) * 1000.0, pygame.time.get_ticks())
         await asyncio.sleep(0)
 
+    if replay:
+        for event in input_source.tick_events(): handle_event(event) # Clicks after the last tick
+        check_replay(replay)
+    elif RECORD_PATH: input_source.save(RECORD_PATH)
+    report_stats(); profiler.close(); log_task.cancel(); log.close()
     pygame.quit()
 
+# --- 無頭模擬模式 ---
+# --headless (or WEBGAME_HEADLESS=1): dummy video, no audio, fixed dt, seeded RNG and scripted input,
+# stepping the game logic as fast as the CPU allows. Stops on GAME OVER, after --loops full rounds,
+# or after --max-ticks simulation ticks. With --replay PATH it plays that recording back instead.
+HEADLESS = get_option('--headless', 'WEBGAME_HEADLESS')
+
+def begin_headless(seed=0, start_level=1, scripted_input=None):
+    global game_clock, input_source
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    random.seed(seed); game_clock = SimulationClock(); input_source = scripted_input or ScriptedInput()
+    setup_game(headless=True); start_new_game(start_level)
+
+def feed_headless_input(tick): # Deliver the scripted clicks queued for this tick, then advance the simulation clock
+    if game_state == "PLAYING" and player and player.skill_charges > 0 and len(enemies) >= 8: # Scripted triple-click
+        for _ in range(3): input_source.click((SCREEN_WIDTH // 2, SCREEN_HEIGHT // 2))
+    for event in input_source.get_events(): handle_event(event)
+    game_clock.advance(); input_source.begin_tick(tick)
+
+def run_headless(seed=0, start_level=1, loops=1, max_ticks=None, invincible=False, scripted_input=None, draw=False, record_path=None):
+    global input_source
+    begin_headless(seed, start_level, scripted_input)
+    if invincible: player.lives = 10 ** 9
+    if record_path: input_source = InputRecorder(input_source, seed, start_level, invincible)
+    dt = SIM_DT; tick = 0; wall_start = time.perf_counter()
+    while max_ticks is None or tick < max_ticks:
+        tick += 1; feed_headless_input(tick); wave_builder.step()
+        step_simulation(dt, game_clock.get_ticks())
+        if draw: draw_frame(screen)
+        if game_state == "GAME_OVER": break
+        if game_state == "POST_VICTORY_CHOICE":
+            if loop_count >= loops: break
+            input_source.click(CONTINUE_BUTTON_RECT.center) # Handled at the start of the next tick
+    wall_seconds = time.perf_counter() - wall_start
+    if record_path: input_source.save(record_path)
+    result = {'seed': seed, 'ticks': tick, 'sim_seconds': round(tick * dt, 2), 'wall_seconds': round(wall_seconds, 3), 'state': game_state,
+              'level': current_level, 'loop_count': loop_count, 'score': score}
+    pygame.quit(); return result
+
+def run_replay(path, draw=False): # Headless playback as fast as possible; reports whether the final state matches the recording
+    global game_clock, input_source
+    replay = load_replay(path)
+    os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+    random.seed(replay['seed']); game_clock = SimulationClock(); input_source = ReplayInput(replay)
+    setup_game(headless=True); begin_replay(replay)
+    ticks = len(replay['mouse_x']); wall_start = time.perf_counter()
+    for tick in range(1, ticks + 1):
+        for event in input_source.tick_events(): handle_event(event)
+        game_clock.advance(); input_source.begin_tick(tick); step_simulation(SIM_DT, game_clock.get_ticks())
+        if draw: draw_frame(screen)
+    for event in input_source.tick_events(): handle_event(event) # Clicks after the last tick (e.g. right before quitting)
+    wall_seconds = time.perf_counter() - wall_start
+    result = {'replay': path, 'seed': replay['seed'], 'ticks': ticks, 'sim_seconds': round(ticks * SIM_DT, 2), 'wall_seconds': round(wall_seconds, 3), 'state': game_state,
+              'level': current_level, 'loop_count': loop_count, 'score': score, 'match': check_replay(replay)}
+    pygame.quit(); return result
+
 if __name__ == '__main__':
-    try: asyncio.run(main())
-    except RuntimeError as e:
-        if "Event loop is closed" in str(e) or "Cannot run nested event loops" in str(e): print("Asyncio loop issue detected.") # Common in some environments
-        else: raise e
\ No newline at end of file
+    if HEADLESS and REPLAY_PATH: result = run_replay(REPLAY_PATH); log.flush(); print(result) # The result is the command's output, not a log record
+    elif HEADLESS:
+        max_ticks = get_option_value('--max-ticks', 'WEBGAME_MAX_TICKS', 0)
+        result = run_headless(seed=get_option_value('--seed', 'WEBGAME_SEED', 0), start_level=get_option_value('--start-level', 'WEBGAME_START_LEVEL', 1),
+                              loops=get_option_value('--loops', 'WEBGAME_LOOPS', 1), max_ticks=max_ticks or None, invincible=get_option('--invincible', 'WEBGAME_INVINCIBLE'), record_path=RECORD_PATH)
+        log.flush(); print(result)
+    else:
+        try: asyncio.run(main())
+        except RuntimeError as e:
+            if "Event loop is closed" in str(e) or "Cannot run nested event loops" in str(e): log.error('asyncio', "Asyncio loop issue detected.") # Common in some environments
+            else: raise e
@@ -0,0 +1,64 @@
+# tools/asset_cache.py - 解碼資源快取: 冷/熱啟動比較
+# -*- coding: utf-8 -*-
+#
+# Times desktop startup (load_assets + load_sounds, as setup_game runs them) and a full asset load (every image, its
+# collision mask and every SFX) in fresh processes: once with an empty decoded-asset cache (cold) and then with the
+# cache it just wrote (warm). Each round is a new interpreter, so nothing is shared but the files in the cache.
+#
+#   python tools/asset_cache.py                  # cold vs warm report (the cache is rebuilt)
+#   python tools/asset_cache.py --rounds 7
+#   python tools/asset_cache.py --clear          # just delete the cache
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pygame
+import main as game
+
+def measure(): # Runs inside the child process; prints one JSON line
+    pygame.mixer.pre_init(44100, -16, 2, 512); pygame.init(); pygame.mixer.init()
+    game.screen = pygame.display.set_mode((game.SCREEN_WIDTH, game.SCREEN_HEIGHT)); game.log.set_level('off')
+    start = time.perf_counter(); game.load_assets(); game.load_sounds(); startup_ms = (time.perf_counter() - start) * 1000.0
+    for key in game.IMAGE_FILES:
+        image = game.asset_manager.image(key)
+        if image is not None and key != 'cover': game.asset_manager.mask(key, image.get_size(), image) or pygame.mask.from_surface(image)
+    full_ms = (time.perf_counter() - start) * 1000.0
+    print(json.dumps({'startup_ms': startup_ms, 'full_ms': full_ms, 'cache': game.asset_cache.stats()})); pygame.quit()
+
+def run_child():
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child'], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def cache_bytes():
+    directory = game.asset_cache.directory
+    if not os.path.isdir(directory): return 0, 0
+    names = os.listdir(directory); return len(names), sum(os.path.getsize(os.path.join(directory, n)) for n in names)
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold vs warm startup with the decoded-asset cache")
+    parser.add_argument('--rounds', type=int, default=5, help="cold and warm runs each (medians are reported)")
+    parser.add_argument('--clear', action='store_true', help="delete the cache and exit")
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child: measure(); return 0
+    if not game.asset_cache.enabled: print("錯誤: 解碼資源快取已停用 (--no-asset-cache / 網頁版)."); return 1
+    if args.clear: print(f"已刪除 {game.asset_cache.clear()} 個快取檔案 ({game.asset_cache.directory})."); return 0
+    cold = []; warm = []
+    for _ in range(args.rounds):
+        game.asset_cache.clear(); cold.append(run_child()) # Writes the cache
+        warm.append(run_child())
+    files, size = cache_bytes()
+    for label, runs in (('冷啟動 (無快取)', cold), ('熱啟動 (快取)', warm)):
+        print(f"{label}: 啟動 {statistics.median(r['startup_ms'] for r in runs):.1f} ms, 全部資源 {statistics.median(r['full_ms'] for r in runs):.1f} ms  快取 {runs[-1]['cache']}")
+    print(f"快取: {files} 個檔案, {size / 1024 / 1024:.1f} MB -> {game.asset_cache.directory}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
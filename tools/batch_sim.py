@@ -0,0 +1,197 @@
+# tools/batch_sim.py - 平行批次模擬與關卡平衡掃描 (headless)
+# -*- coding: utf-8 -*-
+#
+# Runs many seeded games of main.py's logic in a process pool, each driven by an autopilot policy, and
+# records one row per (run, level): clear time, lives lost, lives lost per enemy behavior, powerups
+# collected and peak sprite counts. Writes the raw rows and a per-level summary as CSV (or Parquet when
+# pyarrow is installed and the path ends in .parquet).
+#
+#   python tools/batch_sim.py                                    # levels 1-50, loop 0, 8 seeds, dodge bot
+#   python tools/batch_sim.py --loops 0 1 2 --seeds 32 --policy track
+#   python tools/batch_sim.py --levels 40-50 --levels-per-run 1 --invincible
+#   python tools/batch_sim.py --start-levels 1 --levels-per-run 50        # full campaigns instead of single levels
+#   python tools/batch_sim.py --policy mybots:make_policy                  # any factory(game) -> mouse_x(tick)
+#
+# A job starts a fresh game at one level (fresh player, so no carried-over upgrades unless --levels-per-run > 1)
+# and plays until --levels-per-run levels are cleared, the player dies, or a level exceeds --max-level-seconds.
+
+import argparse
+import csv
+import importlib
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pygame
+import main as game
+
+BEHAVIORS = sorted({data['behavior'] for data in game.enemy_data.values()} | {'boss'})
+POWERUP_TYPES = ('S', 'N', 'W', 'H', 'P')
+PEAK_GROUPS = ('enemies', 'enemy_bullets', 'player_bullets', 'powerups', 'all_sprites')
+ROW_FIELDS = (['policy', 'seed', 'start_level', 'loop_count', 'level', 'cleared', 'outcome', 'clear_seconds', 'lives_lost', 'score_gained', 'powerups']
+              + [f'lost_{b}' for b in BEHAVIORS] + [f'powerup_{t}' for t in POWERUP_TYPES] + [f'peak_{g}' for g in PEAK_GROUPS])
+
+# --- 自動駕駛策略 ---
+# A policy factory takes the main module and returns mouse_x(tick). The skill is still triggered by
+# feed_headless_input's scripted triple-click.
+DODGE_LOOKAHEAD = 0.6 # s; threats reaching the player's row later than this are ignored
+DODGE_MARGIN = 3 # px around the player's rect
+DODGE_MAX_SPEED = 900 # px/s, roughly a quick human mouse flick
+DODGE_CANDIDATES = 24 # Evenly spaced x positions considered besides the target
+
+def make_center(g): return lambda tick: game.SCREEN_WIDTH // 2
+
+def make_track(g): return g.autopilot_mouse_x
+
+def enemy_threats(g): # (left, right, top, bottom, vx, vy) of every enemy bullet and diving enemy
+    threats = [(b.rect.left, b.rect.right, b.rect.top, b.rect.bottom, b.speedx_per_sec, b.speedy_per_sec) for b in g.enemy_bullets]
+    buf = g.projectile_engine.enemy if g.projectile_engine else None
+    if buf is not None and buf.n:
+        n = buf.n; threats += zip(buf.x[:n].tolist(), (buf.x[:n] + buf.w[:n]).tolist(), buf.y[:n].tolist(), (buf.y[:n] + buf.h[:n]).tolist(), buf.vx[:n].tolist(), buf.vy[:n].tolist())
+    threats += [(e.rect.left, e.rect.right, e.rect.top, e.rect.bottom, 0.0, e.dive_speed_pps) for e in g.enemy_index.in_state('diving')]
+    boss = g.boss_group.sprite if g.boss_group else None
+    if boss: threats.append((boss.rect.left, boss.rect.right, boss.rect.top, boss.rect.bottom, boss.speedx_pps, 0.0))
+    return threats
+
+def make_dodge(g): # Head for the x nearest the lowest enemy that nothing will sweep through soon, at mouse-like speed
+    state = {'x': game.SCREEN_WIDTH // 2, 'tick': 0}
+    def mouse_x(tick):
+        player = g.player; target = g.autopilot_mouse_x(tick)
+        if not player or not player.alive(): return target
+        half_w = player.rect.width // 2 + DODGE_MARGIN; top = player.rect.top - DODGE_MARGIN; bottom = player.rect.bottom
+        danger = [] # x spans threats cover while crossing the player's row within the lookahead
+        for left, right, t_top, t_bottom, vx, vy in enemy_threats(g):
+            if t_bottom > top and t_top < bottom: t_in = 0.0; t_out = DODGE_LOOKAHEAD if vy <= 0 else min(DODGE_LOOKAHEAD, (bottom - t_top) / vy) # Already level with the player
+            elif vy > 0 and t_bottom <= top: t_in = (top - t_bottom) / vy; t_out = min(DODGE_LOOKAHEAD, (bottom - t_top) / vy)
+            else: continue # Below the player or moving away
+            if t_in > DODGE_LOOKAHEAD: continue
+            danger.append((left + min(vx * t_in, vx * t_out), right + max(vx * t_in, vx * t_out)))
+        def clear(lo, hi, spans): return all(right <= lo - half_w or left >= hi + half_w for left, right in spans) # Nothing over [lo, hi] widened by the ship
+        current = state['x']; candidates = {target} | {half_w + i * (game.SCREEN_WIDTH - 2 * half_w) // (DODGE_CANDIDATES - 1) for i in range(DODGE_CANDIDATES)}
+        ahead = [span for span in danger if clear(current, current, [span])] # Threats not already on top of the ship must not be crossed
+        reachable = [x for x in candidates | {current} if clear(min(x, current), max(x, current), ahead)]
+        if len(ahead) == len(danger): goal = min(reachable, key=lambda x: (abs(x - target), x))
+        else: # Flee to the nearest safe spot, or failing that the one farthest from every threat
+            goal = min((x for x in reachable if clear(x, x, danger)), key=lambda x: (abs(x - current), x), default=None)
+            if goal is None: goal = max(reachable, key=lambda x: min(max(left - x, x - right) for left, right in danger))
+        step = DODGE_MAX_SPEED * game.SIM_DT * max(1, tick - state['tick']); state['tick'] = tick # The mouse keeps moving while the hit player is frozen and not read
+        state['x'] += max(-step, min(step, goal - state['x']))
+        return int(state['x'])
+    return mouse_x
+
+POLICIES = {'center': make_center, 'track': make_track, 'dodge': make_dodge}
+
+def load_policy(name): # Built-in name or 'module:factory'
+    if name in POLICIES: return POLICIES[name]
+    module_name, _, attr = name.partition(':')
+    if not attr: raise ValueError(f"unknown policy {name!r} (built-in: {', '.join(POLICIES)}; or module:factory)")
+    return getattr(importlib.import_module(module_name), attr)
+
+# --- 單一模擬工作 ---
+def run_job(job): # Runs in a worker process; returns a list of per-level rows
+    policy_name, seed, start_level, loop_count, levels_per_run, max_level_ticks, invincible, skill_charges = job
+    game.log.set_level('off') # The game narrates every spawn; thousands of runs would drown the console
+    game.begin_headless(seed=seed, start_level=start_level, scripted_input=game.ScriptedInput(mouse_x=load_policy(policy_name)(game)))
+    if loop_count: game.loop_count = loop_count; game.difficulty_multiplier = 1.0 + loop_count * 0.15; game.spawn_wave(start_level) # Difficulty applies at spawn
+    if invincible: game.player.lives = 10 ** 9
+    game.player.skill_charges = skill_charges # The scripted triple-click would otherwise clear most first waves on tick 1
+    rows = []; tick = 0; level_start = 0; score_at_start = game.score; peaks = {}
+    hits_at_start = {}; powerups_at_start = {}
+    def close_level(outcome):
+        hits = game.combat_stats['hits_taken']; got = game.combat_stats['powerups']
+        row = {'policy': policy_name, 'seed': seed, 'start_level': start_level, 'loop_count': game.loop_count, 'level': game.current_level,
+               'cleared': int(outcome == 'cleared'), 'outcome': outcome, 'clear_seconds': round((tick - level_start) * game.SIM_DT, 3),
+               'lives_lost': sum(hits.values()) - sum(hits_at_start.values()), 'score_gained': game.score - score_at_start,
+               'powerups': sum(got.values()) - sum(powerups_at_start.values())}
+        row.update({f'lost_{b}': hits.get(b, 0) - hits_at_start.get(b, 0) for b in BEHAVIORS})
+        row.update({f'powerup_{t}': got.get(t, 0) - powerups_at_start.get(t, 0) for t in POWERUP_TYPES})
+        row.update({f'peak_{g}': peaks.get(g, 0) for g in PEAK_GROUPS}); rows.append(row)
+    while True:
+        tick += 1; game.feed_headless_input(tick); game.step_simulation(game.SIM_DT, game.game_clock.get_ticks())
+        for group, count in game.group_counts().items(): peaks[group] = max(peaks.get(group, 0), count)
+        if game.game_state == "GAME_OVER": close_level('died'); break
+        if game.game_state == "PLAYING" and tick - level_start > max_level_ticks: close_level('timeout'); break
+        if game.game_state in ("LEVEL_TRANSITION", "POST_VICTORY_CHOICE"):
+            close_level('cleared')
+            if len(rows) >= levels_per_run or game.game_state == "POST_VICTORY_CHOICE": break
+            while game.game_state == "LEVEL_TRANSITION": tick += 1; game.feed_headless_input(tick); game.step_simulation(game.SIM_DT, game.game_clock.get_ticks())
+            if game.game_state != "PLAYING": break
+            level_start = tick; score_at_start = game.score; peaks = {}
+            hits_at_start = dict(game.combat_stats['hits_taken']); powerups_at_start = dict(game.combat_stats['powerups'])
+    pygame.quit()
+    return rows
+
+# --- 彙總與輸出 ---
+def summarize(rows): # One row per (policy, loop_count, level)
+    buckets = {}
+    for row in rows: buckets.setdefault((row['policy'], row['loop_count'], row['level']), []).append(row)
+    summary = []
+    for (policy, loop_count, level), group in sorted(buckets.items()):
+        cleared = [r['clear_seconds'] for r in group if r['cleared']]
+        out = {'policy': policy, 'loop_count': loop_count, 'level': level, 'runs': len(group), 'clear_rate': round(len(cleared) / len(group), 3),
+               'death_rate': round(sum(r['outcome'] == 'died' for r in group) / len(group), 3),
+               'clear_seconds_mean': round(statistics.fmean(cleared), 2) if cleared else '', 'clear_seconds_p50': round(statistics.median(cleared), 2) if cleared else '',
+               'clear_seconds_max': round(max(cleared), 2) if cleared else '', 'lives_lost_mean': round(statistics.fmean(r['lives_lost'] for r in group), 3),
+               'powerups_mean': round(statistics.fmean(r['powerups'] for r in group), 3)}
+        out.update({f'lost_{b}_mean': round(statistics.fmean(r[f'lost_{b}'] for r in group), 3) for b in BEHAVIORS})
+        out.update({f'peak_{g}_max': max(r[f'peak_{g}'] for r in group) for g in PEAK_GROUPS})
+        summary.append(out)
+    return summary
+
+def write_table(rows, path, fields=None): # Columnar Parquet via pyarrow when asked for and available, CSV otherwise
+    fields = list(fields or (rows[0].keys() if rows else []))
+    if path.endswith('.parquet'):
+        try: import pyarrow, pyarrow.parquet
+        except ImportError: path = path[:-len('.parquet')] + '.csv'; print(f"警告: 未安裝 pyarrow, 改寫 CSV: {path}")
+        else: pyarrow.parquet.write_table(pyarrow.table({f: [r.get(f) for r in rows] for f in fields}), path); return path
+    with open(path, 'w', newline='', encoding='utf-8') as f: writer = csv.DictWriter(f, fieldnames=fields); writer.writeheader(); writer.writerows(rows)
+    return path
+
+def parse_levels(text): # "1-50", "10,20,30" or "1-9,11"
+    levels = []
+    for part in text.split(','):
+        lo, _, hi = part.partition('-'); levels.extend(range(int(lo), int(hi or lo) + 1))
+    bad = [lvl for lvl in levels if not 1 <= lvl <= game.MAX_LEVELS]
+    if bad: raise argparse.ArgumentTypeError(f"levels must be within 1-{game.MAX_LEVELS}: {bad}")
+    return levels
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel headless batch simulator for level balancing")
+    parser.add_argument('--levels', '--start-levels', type=parse_levels, default=parse_levels(f'1-{game.MAX_LEVELS}'), help="start levels, e.g. 1-50 or 10,20,30")
+    parser.add_argument('--loops', type=int, nargs='+', default=[0], help="loop_count values to sweep (difficulty +15%% each)")
+    parser.add_argument('--seeds', type=int, default=8, help="seeded runs per (level, loop_count, policy)")
+    parser.add_argument('--seed-base', type=int, default=1)
+    parser.add_argument('--policy', nargs='+', default=['dodge'], help=f"built-in ({', '.join(POLICIES)}) or module:factory")
+    parser.add_argument('--levels-per-run', type=int, default=1)
+    parser.add_argument('--max-level-seconds', type=float, default=180.0)
+    parser.add_argument('--skill-charges', type=int, default=0, help="skill charges at the start of each run (the game gives %d; the headless script spends them on the first big wave)" % game.PLAYER_INITIAL_SKILL_CHARGES)
+    parser.add_argument('--invincible', action='store_true', help="never die: clear times for every level, lives lost still counted")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--output', default='batch_runs.csv', help="per-level rows (.csv or .parquet)")
+    parser.add_argument('--summary', default='batch_summary.csv', help="per (policy, loop, level) aggregates (.csv or .parquet)")
+    args = parser.parse_args()
+    for name in args.policy: load_policy(name) # Fail before starting the pool
+
+    max_level_ticks = int(args.max_level_seconds / game.SIM_DT)
+    jobs = [(policy, args.seed_base + s, level, loop, args.levels_per_run, max_level_ticks, args.invincible, args.skill_charges)
+            for policy in args.policy for loop in args.loops for level in args.levels for s in range(args.seeds)]
+    print(f"{len(jobs)} 個模擬 ({len(args.policy)} 策略 x {len(args.loops)} 輪 x {len(args.levels)} 關 x {args.seeds} 種子), {args.workers} 個行程...")
+    start = time.perf_counter(); rows = []
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i, job_rows in enumerate(pool.map(run_job, jobs, chunksize=max(1, len(jobs) // (args.workers * 8))), 1):
+            rows.extend(job_rows)
+            if i % max(1, len(jobs) // 10) == 0: print(f"  {i}/{len(jobs)} ({time.perf_counter() - start:.1f} s)")
+    elapsed = time.perf_counter() - start; sim_seconds = sum(r['clear_seconds'] for r in rows)
+    print(f"完成: {len(rows)} 筆關卡紀錄, 模擬 {sim_seconds / 3600:.1f} 小時遊戲時間, 實際 {elapsed:.1f} s ({sim_seconds / max(elapsed, 1e-9):.0f}x 即時)")
+    print(f"逐關紀錄 -> {write_table(rows, args.output, ROW_FIELDS)}")
+    summary = summarize(rows); print(f"關卡彙總 -> {write_table(summary, args.summary)}")
+    for row in summary:
+        if row['clear_rate'] < 0.5: print(f"  低通關率: {row['policy']} 輪 {row['loop_count']} 關卡 {row['level']}: 通關 {row['clear_rate']:.0%}, 平均失命 {row['lives_lost_mean']}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
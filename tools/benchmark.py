@@ -0,0 +1,188 @@
+# tools/benchmark.py - 場景效能基準測試 (headless)
+# -*- coding: utf-8 -*-
+#
+# Runs named scenarios through main.py's headless mode and times the update, collision, draw
+# and present phases of every tick. Reports p50/p95/p99 per phase, peak sprite counts per group
+# and allocation pressure, writes JSON, and compares against a stored baseline.
+# Each scenario runs --repeat times and every timing statistic is the median over the runs, so one
+# noisy run cannot fail the comparison. Allocations are measured in a separate tracemalloc pass
+# (tracing slows everything down, so it never overlaps the timed runs): per frame, the peak of
+# Python-allocated memory above the frame's starting level, which counts objects built and thrown
+# away within the frame, and the bytes still held when the frame ends.
+#
+#   python tools/benchmark.py                                   # all scenarios -> bench_results.json
+#   python tools/benchmark.py --repeat 9 swarm240
+#   python tools/benchmark.py --save-baseline tools/bench_baseline.json
+#   python tools/benchmark.py --baseline tools/bench_baseline.json --threshold 0.15
+#
+# Exit code 1 means at least one metric regressed past its threshold.
+
+import argparse
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pygame
+import main as game
+
+PHASES = ('update', 'collision', 'draw', 'present')
+PERCENTILES = (50, 95, 99)
+WARMUP_TICKS = 60
+ALLOC_METRICS = ('alloc_peak_kb', 'retained_kb') # Per frame, from the tracemalloc pass
+
+# --- 場景設定 ---
+def _continuous_summons(g):
+    boss = g.boss_group.sprite
+    if boss: boss.summon_delay = 2000 # Summon every 2 s instead of every 10 s
+
+def _max_upgrades(g): g.player.bullet_level_n = 3; g.player.bullet_level_w = 5; g.player.shoot_delay = 80
+
+def _loop5(g): # Difficulty is applied when the wave spawns, so respawn after setting it (hold_level keeps loop_count)
+    g.loop_count = 5; g.difficulty_multiplier = 1.0 + g.loop_count * 0.15; g.spawn_wave(g.current_level)
+
+def _swarm240(g): # 240 enemies (the formation holds 50): extra rows share the grid's slot targets without claiming them
+    for i in range(240 - len(g.enemies)):
+        enemy_id = ('p03', 'p04', 'p07', 'p08')[i % 4]; enemy = g.Enemy(enemy_id, g.formation_grid.slot_target(i % (g.FORMATION_COLS * g.FORMATION_ROWS)))
+        enemy.hp = enemy.max_hp = 10 ** 6; g.all_sprites.add(enemy); g.enemies.add(enemy)
+
+SCENARIOS = {
+    'level1_baseline': {'start_level': 1},
+    'p08x28_wave': {'start_level': 49},
+    'boss50_summons': {'start_level': 50, 'per_tick': _continuous_summons},
+    'powered_spam': {'start_level': 49, 'setup': _max_upgrades},
+    'loop5_difficulty': {'start_level': 45, 'setup': _loop5},
+    'swarm240': {'start_level': 49, 'setup': _swarm240},
+}
+
+def hold_level(g, level): # Keep measuring the same wave: no screen-clearing skill, respawn when it is cleared
+    if g.player: g.player.skill_charges = 0
+    if g.game_state == "LEVEL_TRANSITION": g.current_level = level; g.spawn_wave(level); g.game_state = "PLAYING"
+
+def percentile(sorted_values, pct):
+    if not sorted_values: return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0; lo = int(k); hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def summarize(samples_ms):
+    ordered = sorted(samples_ms); summary = {f'p{p}': round(percentile(ordered, p), 4) for p in PERCENTILES}
+    summary['mean'] = round(sum(ordered) / len(ordered), 4) if ordered else 0.0; summary['max'] = round(ordered[-1], 4) if ordered else 0.0
+    return summary
+
+# --- 執行單一場景 ---
+def begin_scenario(spec, seed):
+    game.begin_headless(seed=seed, start_level=spec['start_level']); game.player.lives = 10 ** 9 # Keep the scenario running
+    if spec.get('setup'): spec['setup'](game)
+
+def prepare_tick(spec, tick):
+    hold_level(game, spec['start_level']); game.feed_headless_input(tick)
+    if spec.get('per_tick'): spec['per_tick'](game)
+
+def run_scenario(name, spec, ticks, seed): # One timed run
+    begin_scenario(spec, seed); dt = game.SIM_DT; clock = time.perf_counter_ns
+    samples = {phase: [] for phase in PHASES}; frame_ms = []; peaks = {}
+    gc_before = sum(s['collections'] for s in gc.get_stats())
+    for tick in range(1, WARMUP_TICKS + ticks + 1):
+        prepare_tick(spec, tick); now = game.game_clock.get_ticks()
+        t0 = clock(); game.update_world(dt, now)
+        t1 = clock(); game.resolve_collisions(now)
+        t2 = clock(); game.draw_frame(game.screen)
+        t3 = clock(); game.present_frame()
+        t4 = clock()
+        if tick <= WARMUP_TICKS: continue
+        for phase, start, end in zip(PHASES, (t0, t1, t2, t3), (t1, t2, t3, t4)): samples[phase].append((end - start) / 1e6)
+        frame_ms.append((t4 - t0) / 1e6)
+        for group, count in game.group_counts().items(): peaks[group] = max(peaks.get(group, 0), count)
+    gc_collections = sum(s['collections'] for s in gc.get_stats()) - gc_before
+    result = {'ticks': ticks, 'phases': {phase: summarize(samples[phase]) for phase in PHASES}, 'frame': summarize(frame_ms), 'peak_counts': peaks,
+              'gc_collections_per_1k_frames': round(gc_collections * 1000.0 / ticks, 2), 'final_state': game.game_state, 'final_level': game.current_level}
+    pygame.quit(); return result
+
+def measure_allocations(spec, ticks, seed): # Same ticks as a timed run, but under tracemalloc and untimed
+    begin_scenario(spec, seed); dt = game.SIM_DT; samples = {metric: [] for metric in ALLOC_METRICS}
+    tracemalloc.start()
+    try:
+        for tick in range(1, WARMUP_TICKS + ticks + 1):
+            prepare_tick(spec, tick); now = game.game_clock.get_ticks()
+            start = tracemalloc.get_traced_memory()[0]; tracemalloc.reset_peak()
+            game.update_world(dt, now); game.resolve_collisions(now); game.draw_frame(game.screen); game.present_frame()
+            if tick <= WARMUP_TICKS: continue
+            current, peak = tracemalloc.get_traced_memory()
+            samples['alloc_peak_kb'].append((peak - start) / 1024.0); samples['retained_kb'].append((current - start) / 1024.0)
+    finally: tracemalloc.stop()
+    pygame.quit(); return {metric: summarize(values) for metric, values in samples.items()}
+
+def median_of_runs(runs): # Every timing statistic is the median over the runs; peaks are the maximum
+    def merge(summaries): return {stat: round(statistics.median(s[stat] for s in summaries), 4) for stat in summaries[0]}
+    first = runs[0]
+    return {'ticks': first['ticks'], 'runs': len(runs), 'phases': {phase: merge([r['phases'][phase] for r in runs]) for phase in PHASES}, 'frame': merge([r['frame'] for r in runs]),
+            'peak_counts': {group: max(r['peak_counts'].get(group, 0) for r in runs) for group in first['peak_counts']},
+            'gc_collections_per_1k_frames': statistics.median(r['gc_collections_per_1k_frames'] for r in runs), 'final_state': first['final_state'], 'final_level': first['final_level']}
+
+# --- 基準比較 ---
+def compare(results, baseline, thresholds, min_delta_ms=0.05, alloc_threshold=0.25, min_delta_kb=4.0): # Returns a list of human-readable regressions
+    regressions = []
+    for name, scenario in results['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base: continue
+        for phase in PHASES + ('frame',):
+            current = scenario['phases'][phase] if phase != 'frame' else scenario['frame']; previous = base['phases'][phase] if phase != 'frame' else base['frame']
+            for metric, limit in thresholds.items():
+                old = previous.get(metric, 0.0); new = current.get(metric, 0.0)
+                if old > 0 and new > old * (1.0 + limit) and new - old >= min_delta_ms: regressions.append(f"{name}.{phase}.{metric}: {old:.3f} -> {new:.3f} ms (+{(new / old - 1) * 100:.1f}%, limit {limit * 100:.0f}%)")
+        for metric in ALLOC_METRICS: # Allocation is near-deterministic for a seed, so only a real change in bytes counts
+            old = base.get('allocations', {}).get(metric, {}).get('p95'); new = scenario.get('allocations', {}).get(metric, {}).get('p95')
+            if old is None or new is None: continue
+            if new > old * (1.0 + alloc_threshold) and new - old >= min_delta_kb: regressions.append(f"{name}.{metric}.p95: {old:.1f} -> {new:.1f} KB (limit {alloc_threshold * 100:.0f}% and {min_delta_kb:g} KB)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless scenario benchmark for main.py")
+    parser.add_argument('scenarios', nargs='*', help=f"scenario names (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--ticks', type=int, default=1200, help="measured ticks per scenario (after %d warm-up ticks)" % WARMUP_TICKS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per scenario; statistics are medians over the runs (default 5)")
+    parser.add_argument('--no-alloc', action='store_true', help="skip the tracemalloc allocation pass")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="baseline JSON to compare against")
+    parser.add_argument('--save-baseline', help="also write the results to this baseline path")
+    parser.add_argument('--threshold', type=float, default=0.15, help="allowed relative slowdown for p50/p95 (default 0.15 = 15%%)")
+    parser.add_argument('--threshold-p99', type=float, default=0.30, help="allowed relative slowdown for p99 (tail latency is noisier)")
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help="ignore slowdowns smaller than this many ms (timer noise on tiny phases)")
+    parser.add_argument('--alloc-threshold', type=float, default=0.25, help="allowed relative growth of per-frame allocation p95")
+    parser.add_argument('--min-delta-kb', type=float, default=4.0, help="ignore allocation growth smaller than this many KB per frame")
+    args = parser.parse_args()
+
+    game.log.set_level('off') # The game's spawn/hit narration would otherwise be flushed after the results table at exit
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown: parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    results = {'meta': {'python': platform.python_version(), 'pygame': pygame.version.ver, 'platform': platform.platform(), 'ticks': args.ticks, 'seed': args.seed,
+                        'numpy_projectiles': game.NUMPY_PROJECTILES, 'numpy_enemies': game.NUMPY_ENEMIES, 'dirty_rendering': game.DIRTY_RENDERING, 'repeat': args.repeat}, 'scenarios': {}}
+    for name in names:
+        scenario = results['scenarios'][name] = median_of_runs([run_scenario(name, SCENARIOS[name], args.ticks, args.seed) for _ in range(max(1, args.repeat))])
+        if not args.no_alloc: scenario['allocations'] = measure_allocations(SCENARIOS[name], args.ticks, args.seed)
+        phases = '  '.join(f"{p} {scenario['phases'][p]['p50']:.3f}/{scenario['phases'][p]['p95']:.3f}/{scenario['phases'][p]['p99']:.3f}" for p in PHASES)
+        alloc = scenario.get('allocations'); alloc = f"  alloc {alloc['alloc_peak_kb']['p50']:.1f}/{alloc['alloc_peak_kb']['p95']:.1f} KB" if alloc else ""
+        print(f"{name:18s} {phases}  (p50/p95/p99 ms){alloc}  peak {scenario['peak_counts']}")
+    with open(args.output, 'w', encoding='utf-8') as f: json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"結果已寫入 {args.output}")
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f: json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"基準已寫入 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f: baseline = json.load(f)
+        regressions = compare(results, baseline, {'p50': args.threshold, 'p95': args.threshold, 'p99': args.threshold_p99}, args.min_delta_ms, args.alloc_threshold, args.min_delta_kb)
+        for line in regressions: print(f"  效能退步: {line}")
+        if regressions: return 1
+        print("未偵測到效能退步.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
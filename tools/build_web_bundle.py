@@ -0,0 +1,175 @@
+# tools/build_web_bundle.py - 網頁版資源打包 (圖集 / 音效轉檔 / 碰撞遮罩)
+# -*- coding: utf-8 -*-
+#
+# Run before `pygbag --build main.py`. Writes web_bundle/, which AssetManager in main.py reads when present:
+#   atlas_sprites.png, atlas_boss*.png   shelf-packed sprite atlas and one page per boss (the cover JPEG stays loose),
+#                                        re-encoded with per-row adaptive filtering over None/Sub/Up, which decode
+#                                        as fast as the unfiltered originals (Average/Paeth save ~1% more but decode
+#                                        up to 1.5x slower); a page that is not smaller than the loose files it
+#                                        replaces is left out and those images load as before
+#   masks.bin                            collision masks, each a zlib-compressed plane of one 0/1 byte per pixel
+#   sfx/*.ogg                            SFX re-encoded to mono at a low sample rate (needs ffmpeg; skipped without it)
+#   manifest.json                        image -> page/rect/mask offset, SFX key -> file
+# Prints bundle size, file count and load time before and after.
+# --prune-loose first decodes every manifest entry through AssetManager and compares it with the loose file
+# (pixels, mask, SFX load); on any mismatch it keeps the loose files and exits 1.
+#
+#   python tools/build_web_bundle.py
+#   python tools/build_web_bundle.py --prune-loose     # CI only: verify, then delete the loose files the bundle replaces
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import time
+import zlib
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pygame
+import main as game
+
+ATLAS_GROUPS = {'sprites': ['player', 'skill_icon', 'skill_anim1', 'skill_anim2'] + [f'p{i:02d}' for i in range(1, 10)]}
+ATLAS_GROUPS.update({f'boss{i*10}': [f'boss{i*10}'] for i in range(1, 6)}) # One page per boss: only one is resident at a time (AssetManager evicts the rest)
+ATLAS_MAX_WIDTH = 1024
+PNG_FILTERS = (0, 1, 2) # None, Sub, Up
+TIMING_ROUNDS = 25
+
+# --- 圖集打包 ---
+def shelf_pack(sizes, max_width): # sizes: {key: (w, h)} -> ({key: (x, y)}, page_w, page_h)
+    positions = {}; x = y = shelf_h = page_w = 0
+    for key in sorted(sizes, key=lambda k: (-sizes[k][1], k)):
+        w, h = sizes[key]
+        if x + w > max_width and x > 0: y += shelf_h; x = shelf_h = 0
+        positions[key] = (x, y); x += w; shelf_h = max(shelf_h, h); page_w = max(page_w, x)
+    return positions, page_w, y + shelf_h
+
+def mask_plane(mask): # One 0/1 byte per pixel, zlib-compressed; the game turns it back into a Mask in C
+    w, h = mask.get_size()
+    return zlib.compress(bytes(1 if mask.get_at((x, y)) else 0 for y in range(h) for x in range(w)), 9)
+
+def filter_row(t, line, prev, bpp=4): # PNG filter type t (0 None, 1 Sub, 2 Up) applied to one row of RGBA bytes
+    if t == 0: return line
+    if t == 1: return bytes((x - a) & 0xFF for x, a in zip(line, bytes(bpp) + line[:-bpp]))
+    return bytes((x - b) & 0xFF for x, b in zip(line, prev))
+
+def encode_png(surface): # RGBA PNG, each row with the filter of smallest absolute sum (libpng's heuristic), smallest zlib strategy
+    w, h = surface.get_size(); pixels = pygame.image.tobytes(surface, 'RGBA'); stride = w * 4; prev = bytes(stride); rows = []
+    for y in range(h):
+        line = pixels[y * stride:(y + 1) * stride]
+        rows.append(min((bytes([t]) + filter_row(t, line, prev) for t in PNG_FILTERS), key=lambda row: sum(v if v < 128 else 256 - v for v in row[1:]))); prev = line
+    raw = b''.join(rows); idat = None
+    for strategy in (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9, strategy); data = compressor.compress(raw) + compressor.flush()
+        if idat is None or len(data) < len(idat): idat = data
+    def chunk(tag, data): return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, 6, 0, 0, 0)) + chunk(b'IDAT', idat) + chunk(b'IEND', b'')
+
+def build_atlases(out_dir, manifest, blob):
+    for page_name, keys in ATLAS_GROUPS.items():
+        images = {}; paths = []
+        for key in keys:
+            path = os.path.join(game.IMG_DIR, game.IMAGE_FILES[key])
+            if os.path.exists(path): images[key] = game.load_image_file(path); paths.append(path)
+            else: print(f"  警告: 找不到 {path}, 不打包 {key}")
+        if not images: continue
+        positions, page_w, page_h = shelf_pack({k: im.get_size() for k, im in images.items()}, ATLAS_MAX_WIDTH)
+        page = pygame.Surface((page_w, page_h), pygame.SRCALPHA); page.fill((0, 0, 0, 0))
+        for key, image in images.items(): page.blit(image, positions[key], special_flags=pygame.BLEND_RGBA_ADD) # Adding onto zero copies RGBA exactly (no alpha blending)
+        png = encode_png(page); loose_bytes = sum(os.path.getsize(p) for p in paths); file_name = f'atlas_{page_name}.png'
+        if len(png) >= loose_bytes: print(f"  圖集 {file_name}: {len(png) / 1024:.1f} KB 不小於個別檔案 {loose_bytes / 1024:.1f} KB, 不打包"); continue
+        for key, image in images.items():
+            plane = mask_plane(pygame.mask.from_surface(image)) # Same threshold as SpritePrototype
+            manifest['images'][key] = {'page': page_name, 'rect': [*positions[key], *image.get_size()], 'mask': [len(blob), len(plane)]}
+            blob.extend(plane)
+        with open(os.path.join(out_dir, file_name), 'wb') as f: f.write(png)
+        manifest['pages'][page_name] = {'file': file_name, 'size': [page_w, page_h]}
+        print(f"  圖集 {file_name}: {page_w}x{page_h}, {len(images)} 張圖片, {len(png) / 1024:.1f} KB (個別檔案 {loose_bytes / 1024:.1f} KB)")
+
+# --- 音效轉檔 ---
+def transcode_sfx(out_dir, manifest, rate, bitrate):
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg: print("  警告: 找不到 ffmpeg, 音效維持原檔 (執行期使用個別檔案)."); return
+    os.makedirs(os.path.join(out_dir, 'sfx'), exist_ok=True)
+    for key, filename in game.SOUND_FILES.items():
+        src = os.path.join(game.SND_DIR, filename); rel = f'sfx/{filename}'; dst = os.path.join(out_dir, rel)
+        if not os.path.exists(src): continue
+        result = subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-i', src, '-ac', '1', '-ar', str(rate), '-c:a', 'libvorbis', '-b:a', bitrate, dst], capture_output=True, text=True)
+        if result.returncode != 0: print(f"  警告: {filename} 轉檔失敗: {result.stderr.strip()}"); continue
+        if os.path.getsize(dst) >= os.path.getsize(src): os.remove(dst); print(f"  {filename}: 轉檔後未變小, 保留原檔"); continue
+        manifest['sounds'][key] = rel
+
+# --- 前後比較 ---
+def bundled_sources(manifest): # Loose files the bundle replaces
+    images = [os.path.join(game.IMG_DIR, game.IMAGE_FILES[k]) for k in manifest['images']]
+    return images + [os.path.join(game.SND_DIR, game.SOUND_FILES[k]) for k in manifest['sounds']]
+
+def bundle_files(out_dir, manifest):
+    return [os.path.join(out_dir, name) for name in [game.BUNDLE_MANIFEST, manifest['masks']] + [p['file'] for p in manifest['pages'].values()] + list(manifest['sounds'].values())]
+
+def time_loading(manifest): # Median ms to decode every bundled image (+ mask) and SFX, as the game does: (loose files, bundle)
+    samples = {False: [], True: []}
+    for _ in range(TIMING_ROUNDS):
+        for use_bundle in (False, True): # Interleaved, so drift and cache warmth hit both sides alike
+            game.assets.clear(); manager = game.AssetManager(); start = time.perf_counter()
+            if use_bundle: manager.load_manifest()
+            for key in manifest['images']:
+                image = manager._decode(key)
+                mask = manager.mask(key, image.get_size()) if use_bundle else None
+                if mask is None: pygame.mask.from_surface(image)
+            for key in manifest['sounds']: pygame.mixer.Sound(manager.sound_path(key, game.SOUND_FILES[key]))
+            samples[use_bundle].append((time.perf_counter() - start) * 1000.0)
+    game.assets.clear(); return statistics.median(samples[False]), statistics.median(samples[True])
+
+def verify_bundle(manifest): # Every bundled image must decode to the loose file's pixels and mask, every SFX must load
+    game.assets.clear(); manager = game.AssetManager(); problems = []
+    if not manager.load_manifest(): return ["manifest"]
+    for key in manifest['images']:
+        loose = game.load_image_file(os.path.join(game.IMG_DIR, game.IMAGE_FILES[key])); image = manager._from_bundle(key)
+        if image is None or image.get_size() != loose.get_size() or pygame.image.tobytes(image, 'RGBA') != pygame.image.tobytes(loose, 'RGBA'): problems.append(f"{key} 圖片"); continue
+        mask = manager.mask(key, image.get_size())
+        if mask is None or mask.overlap_area(pygame.mask.from_surface(loose), (0, 0)) != mask.count() or mask.count() != pygame.mask.from_surface(loose).count(): problems.append(f"{key} 遮罩")
+    for key, rel in manifest['sounds'].items():
+        try: pygame.mixer.Sound(os.path.join(game.BUNDLE_DIR, rel))
+        except Exception as e: problems.append(f"{key} 音效 ({e})")
+    game.assets.clear(); return problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack images/SFX into web_bundle/ for the pygbag build")
+    parser.add_argument('--out', default=game.BUNDLE_DIR)
+    parser.add_argument('--sfx-rate', type=int, default=22050)
+    parser.add_argument('--sfx-bitrate', default='32k')
+    parser.add_argument('--prune-loose', action='store_true', help="delete the loose files now covered by the bundle (CI checkouts only)")
+    args = parser.parse_args()
+
+    pygame.init(); pygame.display.set_mode((1, 1)); pygame.mixer.init()
+    game.asset_cache.enabled = False # Compare real decodes, not the desktop decoded-asset cache
+    game.log.set_level('warning') # time_loading re-reads the manifest every round; keep only problems
+    if os.path.isdir(args.out): shutil.rmtree(args.out)
+    os.makedirs(args.out)
+    manifest = {'version': 1, 'pages': {}, 'images': {}, 'masks': 'masks.bin', 'sounds': {}}; blob = bytearray()
+    print("打包圖集與碰撞遮罩..."); build_atlases(args.out, manifest, blob)
+    with open(os.path.join(args.out, manifest['masks']), 'wb') as f: f.write(blob)
+    print("音效轉檔..."); transcode_sfx(args.out, manifest, args.sfx_rate, args.sfx_bitrate)
+    with open(os.path.join(args.out, game.BUNDLE_MANIFEST), 'w', encoding='utf-8') as f: json.dump(manifest, f, indent=1)
+
+    game.BUNDLE_DIR = args.out # time_loading goes through AssetManager, which reads this
+    before_files = bundled_sources(manifest); after_files = bundle_files(args.out, manifest)
+    before_bytes = sum(os.path.getsize(p) for p in before_files); after_bytes = sum(os.path.getsize(p) for p in after_files)
+    before_ms, after_ms = time_loading(manifest)
+    game.log.flush() # Buffered game warnings go out before the summary, not after it at exit
+    print(f"打包前: {len(before_files)} 個檔案, {before_bytes / 1024:.1f} KB, 載入 {before_ms:.1f} ms")
+    print(f"打包後: {len(after_files)} 個檔案, {after_bytes / 1024:.1f} KB, 載入 {after_ms:.1f} ms")
+    if args.prune_loose:
+        problems = verify_bundle(manifest)
+        if problems: print(f"錯誤: 資源包驗證失敗 ({', '.join(problems)}), 保留個別檔案."); pygame.quit(); return 1
+        for path in before_files: os.remove(path)
+        print(f"已刪除 {len(before_files)} 個被資源包取代的個別檔案.")
+    pygame.quit(); return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
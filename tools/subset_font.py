@@ -0,0 +1,119 @@
+# tools/subset_font.py - CJK 字體子集化 (建置時)
+# -*- coding: utf-8 -*-
+#
+# Cubic_11 is 2.7 MB, but the game only draws a few dozen distinct CJK characters. This collects every string
+# literal passed to draw_text() in main.py (f-string literal parts and names bound to string constants included)
+# and the PowerUp letters, adds digits, ASCII letters and punctuation, and writes a subset TTF next to the full
+# font. init_font() prefers the subset; text with a glyph the subset lacks is rendered with the full font.
+# Without the full font there is no fallback, so --drop-full first checks coverage and exits 1, keeping the font,
+# when a collected character is missing from the subset or a draw_text() argument cannot be resolved statically
+# (a parameter, call or attribute). f-string substitutions are not checked: they format scores, levels and counts.
+#
+#   pip install fonttools
+#   python tools/subset_font.py                  # writes fonts/Cubic_11_1.000_R.subset.ttf
+#   python tools/subset_font.py --drop-full      # CI only: check coverage, then delete the full font
+
+import argparse
+import ast
+import os
+import string
+import sys
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy'); os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import pygame
+import pygame.freetype
+import main as game
+
+try: from fontTools import subset as ft_subset # Build-time only dependency
+except ImportError: ft_subset = None
+
+TEXT_FUNCTIONS = ('draw_text',)
+EXTRA_CHARS = string.digits + string.ascii_letters + string.punctuation + " " + "，。！？：；、（）「」…－"
+ASCII_TEXT_NAMES = ('enemy_id', 'boss_id') # Placeholder labels drawn from enemy_data / level_data keys, ASCII by construction
+
+def string_constants(node): # Every str constant inside an expression (f-string literal parts, both IfExp branches, ...)
+    return [n.value for n in ast.walk(node) if isinstance(n, ast.Constant) and isinstance(n.value, str)]
+
+def name_bindings(scope): # name -> [value expressions] for simple assignments directly in this scope (not nested functions)
+    bindings = {}; todo = list(ast.iter_child_nodes(scope))
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)): continue
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name): bindings.setdefault(target.id, []).append(node.value)
+        todo.extend(ast.iter_child_nodes(node))
+    return bindings
+
+def unresolved_text(arg, names): # Parts of a text argument whose characters the collector cannot know
+    todo = [arg]; unresolved = []
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.Constant, ast.FormattedValue)): continue
+        if isinstance(node, ast.JoinedStr): todo.extend(node.values)
+        elif isinstance(node, ast.IfExp): todo.extend((node.body, node.orelse))
+        elif isinstance(node, ast.BinOp): todo.extend((node.left, node.right))
+        elif isinstance(node, ast.Name):
+            if node.id not in names and node.id not in ASCII_TEXT_NAMES: unresolved.append(node.id)
+        else: unresolved.append(ast.unparse(node))
+    return unresolved
+
+def collect_text(source): # Returns (strings, [(line, expression) the collector could not resolve])
+    tree = ast.parse(source); module_names = name_bindings(tree); texts = []; unresolved = {} # call -> parts unresolved in every scope that reaches it
+    scopes = [tree] + [n for n in ast.walk(tree) if isinstance(n, (ast.FunctionDef, ast.AsyncFunctionDef))]
+    for scope in scopes:
+        local_names = name_bindings(scope) if scope is not tree else {}
+        for call in ast.walk(scope):
+            if not isinstance(call, ast.Call) or getattr(call.func, 'id', getattr(call.func, 'attr', None)) not in TEXT_FUNCTIONS: continue
+            for arg in call.args[1:2] or call.args: # draw_text(surf, text, ...): the text argument
+                texts.extend(string_constants(arg)); parts = unresolved_text(arg, set(local_names) | set(module_names))
+                unresolved[call] = [part for part in unresolved[call] if part in parts] if call in unresolved else parts
+                for name in (n.id for n in ast.walk(arg) if isinstance(n, ast.Name)):
+                    for value in local_names.get(name, []) + module_names.get(name, []): texts.extend(string_constants(value))
+    for cls in (n for n in ast.walk(tree) if isinstance(n, ast.ClassDef) and n.name == 'PowerUp'): # random.choice(['S', 'N', ...])
+        for call in (n for n in ast.walk(cls) if isinstance(n, ast.Call) and getattr(n.func, 'attr', None) == 'choice'):
+            texts.extend(string_constants(call))
+    return texts, sorted((call.lineno, part) for call, parts in unresolved.items() for part in parts)
+
+def time_font_load(path, sample, rounds=5): # Median ms to open the font and render a first line (FreeType parses lazily)
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter(); pygame.font.Font(path, 18).render(sample, True, (255, 255, 255)); samples.append((time.perf_counter() - start) * 1000.0)
+    return sorted(samples)[rounds // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description="Subset the CJK font to the characters main.py can draw")
+    parser.add_argument('--drop-full', action='store_true', help="delete the full font afterwards (CI checkouts only)")
+    args = parser.parse_args()
+    if ft_subset is None: print("錯誤: 需要 fontTools (pip install fonttools)."); return 1
+    full_path = os.path.join(game.FONT_DIR, game.CUSTOM_FONT_FILENAME); subset_path = os.path.join(game.FONT_DIR, game.SUBSET_FONT_FILENAME)
+    if not os.path.exists(full_path): print(f"錯誤: 找不到字體 {full_path}"); return 1
+    with open(os.path.join(ROOT, 'main.py'), encoding='utf-8') as f: texts, unresolved = collect_text(f.read())
+    chars = sorted(set("".join(texts) + EXTRA_CHARS) - set("\n\r\t"))
+    cjk = [c for c in chars if ord(c) > 0x7F]
+    print(f"收集到 {len(texts)} 個字串, {len(chars)} 個字元 (非 ASCII {len(cjk)} 個): {''.join(cjk)}")
+
+    options = ft_subset.Options(); options.name_IDs = ['*']; options.notdef_outline = True; options.glyph_names = False
+    font = ft_subset.load_font(full_path, options); subsetter = ft_subset.Subsetter(options)
+    subsetter.populate(text="".join(chars)); subsetter.subset(font); ft_subset.save_font(font, subset_path, options)
+
+    pygame.init()
+    full_kb = os.path.getsize(full_path) / 1024; subset_kb = os.path.getsize(subset_path) / 1024
+    sample = "".join(cjk) + string.digits
+    print(f"完整字體: {full_kb:.1f} KB, 載入+首次繪製 {time_font_load(full_path, sample):.1f} ms")
+    print(f"子集字體: {subset_kb:.1f} KB, 載入+首次繪製 {time_font_load(subset_path, sample):.1f} ms ({full_kb / subset_kb:.0f}x 較小) -> {subset_path}")
+    pygame.freetype.init() # pygame.font reports .notdef metrics for missing glyphs; freetype reports None
+    missing = [c for c, m in zip(chars, pygame.freetype.Font(subset_path).get_metrics("".join(chars), size=18)) if m is None and not c.isspace()]
+    if missing: print(f"警告: 子集缺少字元: {''.join(missing)}")
+    for line, part in unresolved: print(f"警告: main.py:{line} draw_text 的文字 '{part}' 無法靜態解析, 字元可能不在子集中")
+    pygame.quit()
+    if args.drop_full:
+        if missing or unresolved: print(f"錯誤: 子集無法涵蓋所有文字, 保留完整字體 {full_path} (請補上字串或擴充 ASCII_TEXT_NAMES)."); return 1
+        os.remove(full_path); print(f"已刪除完整字體 {full_path}.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())